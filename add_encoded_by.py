@@ -4,20 +4,16 @@ import sys
 from mutagen.mp3 import MP3
 from mutagen.id3 import ID3, TENC
 from mutagen.flac import FLAC
+from collections import Counter
+from multiprocessing import Pool
+from itertools import islice
 import argparse
 from utils import *
+from library_walker import LibraryWalker
 
 __author__ = "Thanasis Serntedakis"
 
 
-def count_files(target_path):
-    sum = 0
-    print(target_path)
-    for path, dirs, files in os.walk(target_path):
-        sum += len(files)
-    return sum
-
-
 def parent_path(path, target_path):
     newpath = path[len(target_path) + 1:]
     basename = str(os.path.basename(newpath))
@@ -30,49 +26,154 @@ def parent_path(path, target_path):
     return owner
 
 
-def mutagen_fun(track_path, track, enc):
-    if track.endswith(".mp3"):
-        audio = MP3(track_path)
-        audio["TENC"] = TENC(encoding=3, text=enc)
-        audio.save()
-    elif track.endswith(".flac"):
-        audio = FLAC(track_path)
-        audio["Encoded by"] = enc
-        audio.save()
-    else:
-        bcolors.print('Operation not_supported!', bcolors.WARNING)
+def read_encoded_by(audio):
+    """ The current "encoded by" value of an opened file, None when it is missing """
+    if isinstance(audio, MP3):
+        frame = audio.tags.get('TENC') if audio.tags is not None else None
+        return str(frame.text[0]) if frame is not None and len(frame.text) > 0 else None
+
+    values = audio.get('Encoded by')
+    return values[0] if values else None
 
 
-def print_progress(file_path, cnt, n_total_files):
+def write_encoded_by(audio, enc):
+    if isinstance(audio, MP3):
+        if audio.tags is None:
+            audio.add_tags()
+        audio.tags['TENC'] = TENC(encoding=3, text=enc)
+    else:
+        audio['Encoded by'] = enc
+    audio.save()
+
+
+# Extension: mutagen class. The other files are never opened.
+TAGGED_TYPES = {'.mp3': MP3, '.flac': FLAC}
+
+# Files checked against the journal and handed to the pool at a time
+BATCH_FILES = 1024
+
+
+def mutagen_fun(job):
+    """ Worker: sets the tag of a file only when its current value differs. Returns the job with status and mtime. """
+    track_path, enc, dry_run = job
+    try:
+        audio = TAGGED_TYPES[os.path.splitext(track_path)[1]](track_path)
+        if read_encoded_by(audio) == enc:
+            status = 'unchanged'
+        elif dry_run:
+            status = 'would write'
+        else:
+            write_encoded_by(audio, enc)
+            status = 'written'
+        return track_path, enc, status, os.stat(track_path).st_mtime_ns
+    except Exception as e:
+        return track_path, enc, 'error: {0}'.format(e), None
+
+
+class Journal(object):
+    """
+    Append only log of the files which already have the tag, with the value and the mtime they had then. A file is
+    skipped on a later run if both are unchanged, so an interrupted run resumes without opening the finished files.
+    """
+    def __init__(self, journal_path):
+        self._done = {}
+        if os.path.exists(journal_path):
+            with open(journal_path, encoding='utf-8', errors='surrogateescape') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 3:
+                        self._done[fields[0]] = (fields[1], int(fields[2]))
+
+        self._f = open(journal_path, 'a', encoding='utf-8', errors='surrogateescape')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._f.close()
+
+    def is_done(self, track_path, enc):
+        if track_path not in self._done:
+            return False
+        try:
+            return self._done[track_path] == (enc, os.stat(track_path).st_mtime_ns)
+        except OSError:
+            return False
+
+    def add(self, track_path, enc, mtime_ns):
+        self._f.write('{0}\t{1}\t{2}\n'.format(track_path, enc, mtime_ns))
+        self._f.flush()
+
+
+def print_progress(file_path, cnt, walker):
     sys.stdout.write(file_path)
-    sys.stdout.write("\r %d out of %d \n" % (cnt, n_total_files))
+    sys.stdout.write("\r %d files, folder %d out of ~%d \n" % (cnt, walker.scanned_dirs,
+                                                              walker.estimated_total_dirs()))
     sys.stdout.flush()
 
 
 def main(args):
-    accepted_files_list = ['mp3', 'wav', 'flac', 'ogg', 'mp4', 'aac']
-
-    cnt = 1
-    n_total_files = count_files(args.target_path)
-    bcolors.print(n_total_files, bcolors.OKGREEN)
-    for path, dirs, files in os.walk(args.target_path):
-        enc = args.encoded_by if len(args.encoded_by) > 0 else parent_path(path, args.target_path)
-        for f in files:
-            file_path = path + "/" + f
-
-            if not f.endswith(tuple(accepted_files_list)):
-                print_progress(file_path, cnt, n_total_files)
-
-            mutagen_fun(file_path, f, enc)
-            cnt += 1
-
-
-if __name__ == "__main__":
+    journal_dir = os.path.dirname(args.journal_path)
+    if journal_dir != '' and not os.path.exists(journal_dir):
+        os.makedirs(journal_dir)
+
+    bcolors.print(args.target_path, bcolors.OKGREEN)
+    walker = LibraryWalker(args.target_path, list(TAGGED_TYPES))
+    counts = Counter()
+
+    def files():
+        for album in walker:
+            enc = args.encoded_by if len(args.encoded_by) > 0 else parent_path(album.path, args.target_path)
+            for album_files in album.audio_files.values():
+                for f in album_files:
+                    yield album.path + "/" + f, enc
+
+    with Journal(args.journal_path) as journal, Pool(args.workers) as pool:
+        pending_files = files()
+        while True:
+            batch = list(islice(pending_files, BATCH_FILES))
+            if len(batch) == 0:
+                break
+
+            # The journal and the counts are only used by this thread, the pool is fed a plain list
+            jobs = []
+            for file_path, enc in batch:
+                if journal.is_done(file_path, enc):
+                    counts['journaled'] += 1
+                else:
+                    jobs.append((file_path, enc, args.dry_run))
+
+            for file_path, enc, status, mtime_ns in pool.imap_unordered(mutagen_fun, jobs, chunksize=16):
+                counts[status.split(':')[0]] += 1
+                if status.startswith('error'):
+                    bcolors.print('{0}: {1}'.format(file_path, status), bcolors.FAIL)
+                elif status != 'would write':
+                    journal.add(file_path, enc, mtime_ns)
+
+                if status in ['written', 'would write']:
+                    print_progress('{0} ({1})'.format(file_path, status), sum(counts.values()), walker)
+
+    print('{0} written, {1} would be written, {2} already tagged, {3} skipped by the journal, {4} errors'.format(
+        counts['written'], counts['would write'], counts['unchanged'], counts['journaled'], counts['error']))
+
+
+def cli(argv=None, prog=None):
     parser = argparse.ArgumentParser(
-        description='Add tag "encoded by" to files in the specified target folder')
+        prog=prog, description='Add tag "encoded by" to files in the specified target folder')
     parser.add_argument('--target_path', nargs='?', type=str, default=".",
                         help='The directory to search and put the tag.')
     parser.add_argument('--encoded_by', nargs='?', type=str, default="",
                         help='The name to put to the tag.')
-    args = parser.parse_args()
+    parser.add_argument('--workers', nargs='?', type=int, default=4,
+                        help='Number of processes which read and write the tags.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report the files whose tag would change without writing them.')
+    parser.add_argument('--journal_path', nargs='?', type=str,
+                        default=os.path.expanduser('~/.cache/ark/encoded_by.journal'),
+                        help='Log of the finished files, which an interrupted run skips when it is run again.')
+    args = parser.parse_args(argv)
     main(args)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Air check of a stream: the latest minutes of the encoded stream, as received, in a fixed size in-memory ring buffer.
+
+Nothing is written to disk while the stream plays and the memory use is fixed when the buffer is created, however long
+the process runs. Incident clips are cut from the buffer as they were received, without decoding or re-encoding: an mp3
+clip is a plain byte range (decoders resync on the next frame), an Ogg clip is the header pages of the stream followed
+by the pages of the range.
+"""
+
+import os
+import struct
+import time
+import numpy as np
+
+
+def ogg_header_length(data):
+    """
+    The length of the header pages (identification, comment, setup) at the start of an Ogg stream, i.e. the pages of
+    granule position 0. None if data does not contain all of them yet.
+    """
+    offset = 0
+    while len(data) >= offset + 27:
+        if data[offset:offset + 4] != b'OggS':
+            return offset
+        if struct.unpack('<q', data[offset + 6:offset + 14])[0] != 0:
+            return offset
+        n_segments = data[offset + 26]
+        if len(data) < offset + 27 + n_segments:
+            return None
+        offset += 27 + n_segments + sum(data[offset + 27:offset + 27 + n_segments])
+
+    return None
+
+
+class AirCheck(object):
+    def __init__(self, capacity, duration, mark_interval=1.0, container='mp3'):
+        """
+        :param capacity: Size of the buffer in bytes
+        :param duration: Seconds that the buffer is expected to hold, for the number of time marks
+        :param mark_interval: Seconds between the time marks, i.e. the precision of the start of the clips
+        :param container: 'mp3' or 'ogg'
+        """
+        self.container = container
+        self._buffer = bytearray(capacity)
+        # Total bytes written, the buffer holds the bytes [max(0, written - capacity), written)
+        self.written = 0
+
+        # Ring of (time, offset) marks, one per mark_interval seconds of received data
+        self._mark_interval = mark_interval
+        self._mark_times = np.zeros(int(duration / mark_interval) + 2)
+        self._mark_offsets = np.zeros(len(self._mark_times), dtype=np.int64)
+        self._marks = 0
+
+        # Ogg header pages of the current connection, which every clip needs
+        self._header_offset = 0
+        self._header = bytearray() if container == 'ogg' else None
+        self.header = b''
+
+    @property
+    def capacity(self):
+        return len(self._buffer)
+
+    @property
+    def oldest(self):
+        return max(0, self.written - len(self._buffer))
+
+    def new_stream(self):
+        """ The next write is the start of a new connection, i.e. of a new Ogg header """
+        self._header_offset = self.written
+        self._header = bytearray() if self.container == 'ogg' else None
+        self.header = b''
+
+    def write(self, data, now=None):
+        now = time.time() if now is None else now
+        if self._marks == 0 or now - self._mark_times[(self._marks - 1) % len(self._mark_times)] >= self._mark_interval:
+            self._mark_times[self._marks % len(self._mark_times)] = now
+            self._mark_offsets[self._marks % len(self._mark_times)] = self.written
+            self._marks += 1
+
+        if self._header is not None:
+            self._header += data
+            length = ogg_header_length(self._header)
+            if length is not None:
+                self.header = bytes(self._header[:length])
+                self._header = None
+
+        # Only the last capacity bytes of a chunk can be kept
+        tail = memoryview(data)[-len(self._buffer):]
+        start = (self.written + len(data) - len(tail)) % len(self._buffer)
+        first = min(len(tail), len(self._buffer) - start)
+        self._buffer[start:start + first] = tail[:first]
+        self._buffer[:len(tail) - first] = tail[first:]
+        self.written += len(data)
+
+    def offset_at(self, t):
+        """ The offset of the data received at time t, or of the oldest data still in the buffer """
+        n = min(self._marks, len(self._mark_times))
+        idx = (self._marks - n + np.arange(n)) % len(self._mark_times)
+        times, offsets = self._mark_times[idx], self._mark_offsets[idx]
+
+        i = np.searchsorted(times, t, side='right') - 1
+        offset = int(offsets[i]) if i >= 0 else 0
+        return max(offset, self.oldest)
+
+    def read(self, start, end=None):
+        """ The bytes [start, end) which are still in the buffer """
+        end = self.written if end is None else min(end, self.written)
+        start = max(start, self.oldest)
+        if end <= start:
+            return b''
+
+        a, b = start % len(self._buffer), end % len(self._buffer)
+        if a < b:
+            return bytes(self._buffer[a:b])
+        return bytes(self._buffer[a:]) + bytes(self._buffer[:b])
+
+    def clip(self, start, end=None):
+        """ A playable clip of the bytes [start, end) """
+        start = max(start, self.oldest)
+        data = self.read(start, end)
+        if self.container == 'ogg' and start > self._header_offset:
+            # The header pages, then the range from its first page on
+            page = data.find(b'OggS')
+            data = self.header + (data[page:] if page >= 0 else b'')
+        return data
+
+
+def write_clip(path, data):
+    """ Writes a clip atomically, so a partial clip never has the final name """
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.part')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
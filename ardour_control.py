@@ -87,8 +87,8 @@ def main(args):
             print('Remote was already off.')
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+def cli(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
     parser.add_argument("--ardour-ip", default="127.0.0.1",
                         help="The ip of the OSC server")
     parser.add_argument("--ardour-port", type=int, default=3819,
@@ -105,7 +105,10 @@ if __name__ == "__main__":
     parser.add_argument("--reset", action='store_true',
                         help="The ardour id of the vlc fader")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     main(args)
 
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ark: a single entry point for the library and radio air management tools.
+
+    ark <command> [options]
+
+Each command lives in its own module, which is imported only when the command is invoked. Thus heavy dependencies
+(mutagen, numpy, pydrive etc.) are not paid by `ark --help` or by the light commands run from cron/systemd.
+The options of a command are parsed by its module, see `ark <command> --help`.
+
+The script may be symlinked e.g. as ~/bin/ark.
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+
+# command: (module path relative to the repository root, short description)
+COMMANDS = {
+    'inspect': ('library_inspector.py', 'Statistics, tagging and consistency report of a music library'),
+    'catalog': ('library_catalog.py', 'Query the catalog saved by inspect without rescanning'),
+    'compare': ('compare_mb_libraries.py', 'Report albums of a source library which are not in a target library'),
+    'duplicates': ('duplicate_finder.py', 'Find duplicate albums and tracks of a library and rank their copies'),
+    'unrepresented': ('non_represented_albums.py', 'Report albums which are not in any playlist'),
+    'search': ('search_playlist.py', 'Find the playlists which contain a term'),
+    'fetch': ('fetch_playlist.py', 'Copy the files of a playlist to a folder'),
+    'playlist': ('playlist_io.py', 'List the entries of a playlist or benchmark the playlist parser'),
+    'encoded-by': ('add_encoded_by.py', 'Add the "encoded by" tag to the files of a folder'),
+    'migrate': ('playlist_migration_tool/main.py', 'Migrate playlists into the new library'),
+    'silence': ('silence_detector.py', 'Detect silence on the stream and restart the scheduler'),
+    'stream-bench': ('stream_bench.py', 'Serve test streams and benchmark the silence detector against them'),
+    'schedule-show': ('dynamic_playlist/update_playlist.py', 'Schedule the next show of a dynamic show folder'),
+    'upload': ('upload_to_gdrive.py', 'Upload recordings to Google Drive'),
+    'remote': ('ardour_control.py', 'Switch between a remote stream and the autopilot'),
+}
+
+
+def load(relative_path):
+    """ Imports a tool by path. Its directory becomes importable, as when the tool is run as a script. """
+    import importlib.util
+
+    path = os.path.join(ROOT, relative_path)
+    directory = os.path.dirname(path)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+
+    name = os.path.splitext(relative_path)[0].replace('/', '.')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered before running, so that e.g. process pools can pickle functions of the module
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def usage():
+    lines = ['usage: ark <command> [options]', '', 'commands:']
+    for command, (_, description) in COMMANDS.items():
+        lines.append('  {0:<15}{1}'.format(command, description))
+    lines += ['', 'Run `ark <command> --help` for the options of a command.']
+    return '\n'.join(lines)
+
+
+def main(argv):
+    if len(argv) == 0 or argv[0] in ['-h', '--help']:
+        print(usage())
+        return 0
+
+    command, argv = argv[0], argv[1:]
+    if command not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        print('\nark: unknown command \'{0}\''.format(command), file=sys.stderr)
+        return 2
+
+    module = load(COMMANDS[command][0])
+    return module.cli(argv, 'ark ' + command)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -4,96 +4,174 @@
 Given two directories containing music libraries, source and target, compare and report albums in source
 that there are not in target. It is assumed that each leaf directory represents an album and the track is tagged with
 MusicBrainz group release id and/or MusicBrainz release id
+
+The ids of each library are kept in a persisted MBID index, one small SQLite file per library, which is taken from the
+first audio file of each album. On later runs only the albums whose directory or first audio file changed are read
+again, so a comparison is a set difference of two indexes. More than two libraries are compared pairwise.
 """
 
 import os
-from mutagen.oggvorbis import OggVorbis
-from mutagen.id3 import ID3
-from mutagen.flac import FLAC
+import hashlib
+import sqlite3
 import argparse
-
-
-def safe_get(dictionary, key):
-    # return the string representation, because sometimes the value is an object, rather than the required string
-    if key in dictionary:
-        val = dictionary[key]
-        return str(val) if not isinstance(val, list) else val
-    else:
-        return ''
-
-
-def squeeze(l):
-    if isinstance(l, list):
-        return ", ".join(str(x) for x in l)
-    elif isinstance(l, str):
-        return l
-    else:
-        return ''
-
-
-def parse_library(library_path):
-    library_albums_set = set()
-
-    # Parse library
-    for root, dirs, files in os.walk(library_path):
-        if len(files) == 0:
-            continue
-        else:
-            # Get the leaf directory
-            if not dirs:
-                # Add the album path without the trailing slash
-                library_albums_set.add(os.path.join(root, os.path.dirname(files[0]))[:-1])
-
-    return library_albums_set
-
-
-def find_release_mbids(albums):
-    albums_aid_map = {}
-    albums_gid_map = {}
-    without_info = []
-    for a in albums:
-        filepath = os.path.join(a, os.listdir(a)[0])
-        file_extension = filepath.split('.')[-1]
-        if file_extension == 'mp3':
-            id3_metadata = ID3(filepath)
-            album_id = safe_get(id3_metadata, 'TXXX:MusicBrainz Album Id')
-            album_gid = safe_get(id3_metadata, 'TXXX:MusicBrainz Release Group Id')
-        elif file_extension == 'flac' or file_extension == 'ogg':
-            vorbis_metadata = FLAC(filepath) if file_extension == 'flac' else OggVorbis(filepath)
-            album_id = squeeze(safe_get(vorbis_metadata, 'musicbrainz_albumid'))
-            album_gid = squeeze(safe_get(vorbis_metadata, 'musicbrainz_releasegroupid'))
-        else:
-            print('Unsupported file extension [{}] in album {}'.format(file_extension, a))
-            continue
-
-        if len(album_id) == 0 and len(album_gid) == 0:
-            without_info.append(a)
-        else:
-            if len(album_id) != 0:
-                albums_aid_map[album_id] = a
-            if len(album_gid) != 0:
-                albums_gid_map[album_gid] = a
-
-    return albums_aid_map, albums_gid_map, without_info
-
-
-def main(source_library_path, target_library_path):
-    source_albums_id_map, source_albums_gid_map, source_without_info = \
-        find_release_mbids(parse_library(source_library_path))
-    target_albums_id_map, target_albums_gid_map, target_without_info = \
-        find_release_mbids(parse_library(target_library_path))
-
-    non_existing_albums = []
-    for k in source_albums_gid_map.keys():
-        if k not in target_albums_gid_map:
-            non_existing_albums.append(source_albums_gid_map[k])
-
-    possibly_non_existing_albums = []
-    for k in source_albums_id_map.keys():
-        if k not in target_albums_id_map:
-            p = source_albums_id_map[k]
-            if p not in non_existing_albums:
-                possibly_non_existing_albums.append(source_albums_id_map[k])
+from itertools import permutations
+from library_walker import LibraryWalker, is_leaf
+from metadata_cache import MetadataCache
+from tag_reader import read_tags, is_supported
+
+
+class MbidIndex(object):
+    """ Release and release group ids of the albums of a library """
+    def __init__(self, library_path, dbfile):
+        self._library_path = os.path.abspath(library_path)
+
+        self.db_handle = sqlite3.connect(dbfile)
+        self.db_handle.execute(
+            "CREATE TABLE IF NOT EXISTS albums (path TEXT PRIMARY KEY, mtime_ns INTEGER, track_path TEXT, "
+            "track_mtime_ns INTEGER, album_id TEXT, releasegroup_id TEXT)")
+        self.db_handle.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.db_handle is not None:
+            self.db_handle.close()
+            self.db_handle = None
+
+    def _in_library(self, path):
+        # The rows of another library are ignored, e.g. of an index file which was shared by mistake
+        return path == self._library_path or path.startswith(self._library_path.rstrip(os.sep) + os.sep)
+
+    def refresh(self, cache=None):
+        """
+        Reads the ids of the albums which are new, or whose directory or first audio file changed, and drops the
+        deleted albums. Returns the number of albums read and dropped.
+        """
+        read = cache.get if cache is not None else read_tags
+        known = {row[0]: row[1:] for row in self.db_handle.execute(
+            "SELECT path, mtime_ns, track_path, track_mtime_ns FROM albums") if self._in_library(row[0])}
+        unchanged = set()
+
+        def is_unchanged(path):
+            if path not in known:
+                return False
+            mtime_ns, track_path, track_mtime_ns = known[path]
+            try:
+                # Retagging a file does not change the mtime of its directory
+                if os.stat(path).st_mtime_ns != mtime_ns or os.stat(track_path).st_mtime_ns != track_mtime_ns:
+                    return False
+            except OSError:
+                return False
+            unchanged.add(path)
+            return True
+
+        updated = []
+        for album in LibraryWalker(self._library_path, prune=is_unchanged):
+            # Each leaf directory which contains audio files is an album
+            if not is_leaf(album) or len(album.audio_files) == 0:
+                continue
+
+            track_path = os.path.join(album.path, min(f for files in album.audio_files.values() for f in files))
+            if not is_supported(track_path):
+                continue
+
+            try:
+                tags = read(track_path)
+                album_id, releasegroup_id = tags.album_id, tags.releasegroup_id
+            except Exception:
+                print('Could not read {0}'.format(track_path))
+                album_id, releasegroup_id = '', ''
+
+            updated.append((album.path, os.stat(album.path).st_mtime_ns, track_path, os.stat(track_path).st_mtime_ns,
+                            album_id, releasegroup_id))
+
+        removed = known.keys() - unchanged - set(u[0] for u in updated)
+
+        with self.db_handle:
+            self.db_handle.executemany(
+                "INSERT OR REPLACE INTO albums(path, mtime_ns, track_path, track_mtime_ns, album_id, releasegroup_id) "
+                "VALUES(?, ?, ?, ?, ?, ?)", updated)
+            self.db_handle.executemany("DELETE FROM albums WHERE path = ?", [(p,) for p in removed])
+
+        return len(updated), len(removed)
+
+    def release_mbids(self):
+        """ The release id to album map, the release group id to album map and the albums without ids """
+        albums_aid_map = {}
+        albums_gid_map = {}
+        without_info = []
+        for path, album_id, album_gid in self.db_handle.execute(
+                "SELECT path, album_id, releasegroup_id FROM albums ORDER BY path"):
+            if not self._in_library(path):
+                continue
+            if len(album_id) == 0 and len(album_gid) == 0:
+                without_info.append(path)
+            else:
+                if len(album_id) != 0:
+                    albums_aid_map[album_id] = path
+                if len(album_gid) != 0:
+                    albums_gid_map[album_gid] = path
+
+        return albums_aid_map, albums_gid_map, without_info
+
+
+def index_path_of(index_dir, library_path):
+    # One index file per library, named after the hash of the absolute path of the library, as e.g. /a/b_c and /a_b/c
+    # would collide if separators were replaced
+    library_path = os.path.abspath(library_path)
+    name = os.path.basename(library_path) or 'root'
+    return os.path.join(index_dir, '{0}-{1}.mbid.db'.format(
+        name, hashlib.sha1(library_path.encode('utf-8', 'surrogateescape')).hexdigest()[:16]))
+
+
+def load_release_mbids(library_path, index_dir, cache=None):
+    with MbidIndex(library_path, index_path_of(index_dir, library_path)) as index:
+        read, removed = index.refresh(cache)
+        print('{0}: read {1} new or modified albums, dropped {2}'.format(library_path, read, removed))
+        return index.release_mbids()
+
+
+def compare(source, target):
+    """ The albums of source which are definitely not in target (by release group) and possibly not (by release) """
+    source_albums_id_map, source_albums_gid_map, _ = source
+    target_albums_id_map, target_albums_gid_map, _ = target
+
+    non_existing_albums = [source_albums_gid_map[k] for k in source_albums_gid_map.keys() - target_albums_gid_map.keys()]
+
+    definitely_missing = set(non_existing_albums)
+    possibly_non_existing_albums = [source_albums_id_map[k] for k in source_albums_id_map.keys() - target_albums_id_map.keys()
+                                    if source_albums_id_map[k] not in definitely_missing]
+
+    return sorted(non_existing_albums), sorted(possibly_non_existing_albums)
+
+
+def main(library_paths, cache_path=None, index_dir=os.path.expanduser('~/.cache/ark/mbid')):
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    cache = MetadataCache(cache_path) if cache_path is not None else None
+    mbids = [load_release_mbids(library_path, index_dir, cache) for library_path in library_paths]
+    if cache is not None:
+        cache.close()
+
+    if len(library_paths) > 2:
+        print('\n\nAlbums of source library, definitely/possibly not in target library:\n')
+        for (source, source_mbids), (target, target_mbids) in permutations(zip(library_paths, mbids), 2):
+            non_existing_albums, possibly_non_existing_albums = compare(source_mbids, target_mbids)
+            print('{0} -> {1}: {2}/{3}'.format(source, target, len(non_existing_albums),
+                                               len(possibly_non_existing_albums)))
+
+        for library_path, (_, _, without_info) in zip(library_paths, mbids):
+            print('\n\nAlbums of {0}, without info:\n'.format(library_path))
+            print(*without_info, sep='\n')
+        return
+
+    source_mbids, target_mbids = mbids
+    non_existing_albums, possibly_non_existing_albums = compare(source_mbids, target_mbids)
 
     print('\n\nAlbums of source library, definitely not in target library:\n')
     print(*non_existing_albums, sep='\n')
@@ -102,17 +180,36 @@ def main(source_library_path, target_library_path):
     print(*possibly_non_existing_albums, sep='\n')
 
     print('\n\nAlbums of source library, without info:\n')
-    print(*source_without_info, sep='\n')
+    print(*source_mbids[2], sep='\n')
 
     print('\n\nAlbums of target library, without info:\n')
-    print(*target_without_info, sep='\n')
+    print(*target_mbids[2], sep='\n')
 
 
-if __name__ == "__main__":
+def cli(argv=None, prog=None):
     parser = argparse.ArgumentParser(
-        description='Compare two music libraries and report albums of source not in target library.')
-    parser.add_argument('--source', nargs='?', required=True, help='Source library path')
-    parser.add_argument('--target', nargs='?', required=True, help='Target library path')
-    args = parser.parse_args()
+        prog=prog, description='Compare two music libraries and report albums of source not in target library.')
+    parser.add_argument('--source', nargs='?', help='Source library path')
+    parser.add_argument('--target', nargs='?', help='Target library path')
+    parser.add_argument('--libraries', nargs='+', default=None,
+                        help='Compare more than two libraries pairwise, instead of --source and --target')
+    parser.add_argument('--cache_path', nargs='?', default=None,
+                        help='Metadata cache file. Only new or modified files are parsed on subsequent runs.')
+    parser.add_argument('--index_dir', nargs='?', default=os.path.expanduser('~/.cache/ark/mbid'),
+                        help='Directory of the MBID indexes of the libraries')
+    args = parser.parse_args(argv)
+
+    if args.libraries is not None:
+        if len(args.libraries) < 2:
+            parser.error('--libraries requires at least two libraries')
+        library_paths = args.libraries
+    elif args.source is not None and args.target is not None:
+        library_paths = [args.source, args.target]
+    else:
+        parser.error('either --source and --target or --libraries are required')
 
-    main(args.source, args.target)
+    main(library_paths, args.cache_path, args.index_dir)
+
+
+if __name__ == "__main__":
+    cli()
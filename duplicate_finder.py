@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Finds the albums and the tracks which are in a music library more than once, e.g. with different bitrates/file formats.
+
+Duplicates are found in stages, each one cheaper than the next:
+(1) Albums with the same MusicBrainz release id or release group id.
+(2) Albums with the same normalized artist, album title and number of tracks, and durations within a tolerance.
+(3) Tracks with identical audio, i.e. the hash of the audio payload with the tag headers left out. Only the files whose
+    format and duration collide with another file are opened, and only those whose payload size collides too are
+    hashed, which is a small fraction of the library.
+
+The copies of every duplicate are ranked by format (lossless first) and bitrate, the first one is the copy to keep.
+"""
+
+import os
+import re
+import struct
+import hashlib
+import argparse
+import unicodedata
+from collections import namedtuple, defaultdict
+from library_walker import walk_albums
+from metadata_cache import MetadataCache
+from tag_reader import read_tags, is_supported
+
+
+# Durations of copies of the same album, in seconds, may differ that much (encoder padding etc)
+ALBUM_DURATION_TOLERANCE = 2.0
+
+# Higher is better
+FORMAT_RANK = {'flac': 2, 'ogg': 1, 'mp3': 0}
+
+Track = namedtuple('Track', ['path', 'format', 'bitrate', 'length'])
+
+AlbumCopy = namedtuple('AlbumCopy', ['path', 'album_id', 'releasegroup_id', 'artist', 'album', 'tracks'])
+
+
+def album_length(album: AlbumCopy):
+    return sum(t.length for t in album.tracks)
+
+
+def album_bitrate(album: AlbumCopy):
+    return sum(t.bitrate for t in album.tracks) / max(1, len(album.tracks))
+
+
+def album_formats(album: AlbumCopy):
+    return sorted(set(t.format for t in album.tracks), key=lambda f: FORMAT_RANK.get(f, -1), reverse=True)
+
+
+def rank_key(fmt, bitrate):
+    return FORMAT_RANK.get(fmt, -1), bitrate
+
+
+def normalize(name):
+    """ Lowercase, without accents, bracketed qualifiers (e.g. '(Remastered)'), punctuation or a leading 'the' """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c)).lower()
+    name = re.sub(r'[(\[].*?[)\]]', ' ', name)
+    name = re.sub(r'[\W_]+', ' ', name).strip()
+    return re.sub(r'^the ', '', name)
+
+
+def _synchsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def audio_span(path):
+    """
+    The (start, end) byte offsets of the audio payload of a file, i.e. the file without its tag headers:
+    flac: after the metadata blocks, mp3: between the ID3v2 header and the ID3v1/APEv2 trailers, ogg: from the first
+    audio page, after the identification, comment and setup headers.
+    """
+    ext = os.path.splitext(path)[1]
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as f:
+        if ext == '.flac':
+            if f.read(4) != b'fLaC':
+                return 0, size
+            last = False
+            while not last:
+                header = f.read(4)
+                if len(header) < 4:
+                    break
+                last = header[0] & 0x80 != 0
+                f.seek(int.from_bytes(header[1:], 'big'), os.SEEK_CUR)
+            return f.tell(), size
+
+        if ext == '.mp3':
+            start = 0
+            header = f.read(10)
+            if header[:3] == b'ID3':
+                # Header, tag and optional footer
+                start = 10 + _synchsafe(header[6:10]) + (10 if header[5] & 0x10 else 0)
+
+            end = size
+            if end - start >= 128:
+                f.seek(end - 128)
+                if f.read(3) == b'TAG':
+                    end -= 128
+            if end - start >= 32:
+                f.seek(end - 32)
+                footer = f.read(32)
+                if footer[:8] == b'APETAGEX':
+                    # The size of the tag excludes the header, which is present when the flag bit 31 is set
+                    tag_size, flags = struct.unpack('<II', footer[12:20])
+                    end -= tag_size + (32 if flags & 0x80000000 else 0)
+            return start, max(start, end)
+
+        if ext == '.ogg':
+            offset = 0
+            while True:
+                f.seek(offset)
+                header = f.read(27)
+                if len(header) < 27 or header[:4] != b'OggS':
+                    return 0, size
+                # Header packets are on pages of granule position 0
+                if struct.unpack('<q', header[6:14])[0] != 0:
+                    return offset, size
+                segments = f.read(header[26])
+                offset += 27 + header[26] + sum(segments)
+
+    return 0, size
+
+
+def payload_hash(path):
+    start, end = audio_span(path)
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+    return h.hexdigest()
+
+
+class _DisjointSets(object):
+    def __init__(self):
+        self._parent = {}
+
+    def find(self, x):
+        self._parent.setdefault(x, x)
+        while self._parent[x] != x:
+            self._parent[x] = self._parent[self._parent[x]]
+            x = self._parent[x]
+        return x
+
+    def union(self, x, y):
+        self._parent[self.find(x)] = self.find(y)
+
+
+class DuplicateFinder(object):
+    def __init__(self):
+        self.albums = []
+        self.stats = defaultdict(int)
+
+    def scan(self, library_path, cache=None):
+        read = cache.get if cache is not None else read_tags
+
+        for album in walk_albums(library_path):
+            album_id = releasegroup_id = artist = title = ''
+            tracks = []
+            for filename in sorted(f for files in album.audio_files.values() for f in files):
+                path = os.path.join(album.path, filename)
+                if not is_supported(path):
+                    continue
+                try:
+                    tags = read(path)
+                except Exception:
+                    print('Could not read {0}'.format(path))
+                    continue
+
+                # The album level values of the first track that has them
+                album_id = album_id or tags.album_id
+                releasegroup_id = releasegroup_id or tags.releasegroup_id
+                artist = artist or tags.artist
+                title = title or tags.album
+                tracks.append(Track(path, tags.format, tags.bitrate, tags.length))
+
+            if len(tracks) > 0:
+                self.albums.append(AlbumCopy(album.path, album_id, releasegroup_id, artist, title, tracks))
+
+    def duplicate_albums(self):
+        """ Groups of copies of the same album, best copy first, each with the stages which matched it """
+        sets = _DisjointSets()
+        reasons = defaultdict(set)
+
+        def link(group, reason):
+            for a in group[1:]:
+                sets.union(a, group[0])
+            for a in group:
+                reasons[a].add(reason)
+
+        # (1) MusicBrainz ids
+        for field, reason in [('album_id', 'release'), ('releasegroup_id', 'release group')]:
+            by_id = defaultdict(list)
+            for i, a in enumerate(self.albums):
+                if getattr(a, field) != '':
+                    by_id[getattr(a, field)].append(i)
+            for group in by_id.values():
+                if len(group) > 1:
+                    link(group, reason)
+
+        # (2) Normalized names and number of tracks, then durations within the tolerance
+        by_name = defaultdict(list)
+        for i, a in enumerate(self.albums):
+            if a.artist != '' and a.album != '':
+                by_name[(normalize(a.artist), normalize(a.album), len(a.tracks))].append(i)
+        for group in by_name.values():
+            group.sort(key=lambda i: album_length(self.albums[i]))
+            cluster = group[:1]
+            for prev, i in zip(group, group[1:]):
+                if album_length(self.albums[i]) - album_length(self.albums[prev]) > ALBUM_DURATION_TOLERANCE:
+                    if len(cluster) > 1:
+                        link(cluster, 'artist/album/duration')
+                    cluster = []
+                cluster.append(i)
+            if len(cluster) > 1:
+                link(cluster, 'artist/album/duration')
+
+        groups = defaultdict(list)
+        for i in reasons:
+            groups[sets.find(i)].append(i)
+
+        result = []
+        for group in groups.values():
+            members = sorted((self.albums[i] for i in group),
+                             key=lambda a: rank_key(album_formats(a)[0], album_bitrate(a)), reverse=True)
+            result.append((members, sorted(set.union(*(reasons[i] for i in group)))))
+        return sorted(result, key=lambda r: r[0][0].path)
+
+    def duplicate_tracks(self):
+        """ Groups of tracks with identical audio, best copy first """
+        # (3) Only the tracks whose format and duration collide are opened for their payload size
+        by_length = defaultdict(list)
+        for a in self.albums:
+            for t in a.tracks:
+                self.stats['tracks'] += 1
+                by_length[(t.format, round(t.length, 2))].append(t)
+
+        by_size = defaultdict(list)
+        for key, group in by_length.items():
+            if len(group) < 2:
+                continue
+            for t in group:
+                try:
+                    start, end = audio_span(t.path)
+                except OSError:
+                    print('Could not read {0}'.format(t.path))
+                    continue
+                by_size[key + (end - start,)].append(t)
+
+        # and only the tracks whose payload size collides too are hashed
+        by_hash = defaultdict(list)
+        for key, group in by_size.items():
+            if len(group) < 2:
+                continue
+            for t in group:
+                self.stats['hashed'] += 1
+                self.stats['hashed_bytes'] += key[-1]
+                try:
+                    by_hash[(t.format, payload_hash(t.path))].append(t)
+                except OSError:
+                    print('Could not read {0}'.format(t.path))
+
+        result = [sorted(group, key=lambda t: rank_key(t.format, t.bitrate), reverse=True)
+                  for group in by_hash.values() if len(group) > 1]
+        return sorted(result, key=lambda g: g[0].path)
+
+
+def main(library_path, cache_path=None):
+    finder = DuplicateFinder()
+    if cache_path is not None:
+        with MetadataCache(cache_path) as cache:
+            finder.scan(library_path, cache)
+    else:
+        finder.scan(library_path)
+
+    album_groups = finder.duplicate_albums()
+    print('\n\nDuplicate albums, best copy first:\n')
+    for members, reasons in album_groups:
+        print('Matched by {0}'.format(', '.join(reasons)))
+        for rank, a in enumerate(members):
+            print('\t{0} {1} [{2}, {3:.0f} kbps, {4} tracks, {5:.0f}s]'.format(
+                'keep' if rank == 0 else '    ', a.path, '/'.join(album_formats(a)), album_bitrate(a) / 1000,
+                len(a.tracks), album_length(a)))
+
+    track_groups = finder.duplicate_tracks()
+    print('\n\nDuplicate tracks (identical audio), best copy first:\n')
+    for group in track_groups:
+        for rank, t in enumerate(group):
+            print('\t{0} {1} [{2}, {3:.0f} kbps]'.format('keep' if rank == 0 else '    ', t.path, t.format,
+                                                          t.bitrate / 1000))
+        print()
+
+    print('{0} albums in {1} duplicate groups, {2} tracks in {3} duplicate groups'.format(
+        sum(len(m) for m, _ in album_groups), len(album_groups), sum(len(g) for g in track_groups), len(track_groups)))
+    print('Hashed {0} of {1} tracks ({2:.1f} MB)'.format(finder.stats['hashed'], finder.stats['tracks'],
+                                                        finder.stats['hashed_bytes'] / 1e6))
+
+
+def cli(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Find duplicate albums and tracks of a music library and rank their copies.')
+    parser.add_argument('--library_path', nargs='?', required=True, help='The directory which contains the music library.')
+    parser.add_argument('--cache_path', nargs='?', default=None,
+                        help='Metadata cache file. Only new or modified files are parsed on subsequent runs.')
+    args = parser.parse_args(argv)
+
+    main(args.library_path, args.cache_path)
+
+
+if __name__ == "__main__":
+    cli()
@@ -9,6 +9,13 @@ from dataclasses import dataclass
 from typing import Optional
 import shlex
 import subprocess
+import argparse
+import sys
+import time
+
+# Shared modules live in the root of the repository
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from playlist_io import read_playlist, write_playlist
 
 def find_scheduled_times(schedule_path, playlist_path):
     scheduled_times = []
@@ -37,12 +44,106 @@ class ShowSource:
     online_source: Optional[str]
 
 
+# Suffixes of files which are still being downloaded or copied
+PARTIAL_SUFFIXES = ['.part', '.ytdl', '.tmp', '.crdownload']
+
+
+def is_partial(filename):
+    """ Hidden files and files which are still being downloaded or copied are not shows (yet) """
+    return filename.startswith('.') or os.path.splitext(filename)[1] in PARTIAL_SUFFIXES
+
+
+class ShowInventory:
+    """
+    Snapshot of the files of a local show source, keyed by the mtimes of its directories and persisted as JSON. A
+    refresh stats every directory but lists only those whose mtime changed, i.e. which had files added or removed.
+    """
+    def __init__(self, local_source, snapshot_path):
+        self._local_source = os.path.abspath(local_source)
+        self._snapshot_path = Path(snapshot_path)
+        # Directory path: [mtime_ns, files, subdirectories]
+        self._dirs = {}
+        self.rescanned = 0
+
+        if self._snapshot_path.is_file():
+            try:
+                with open(self._snapshot_path, 'r') as f:
+                    snapshot = json.load(f)
+                if snapshot.get('local_source') == self._local_source:
+                    self._dirs = snapshot['directories']
+            except (ValueError, KeyError):
+                print('Invalid inventory snapshot, the local source is listed again.')
+
+    @property
+    def directories(self):
+        return len(self._dirs)
+
+    def shows(self):
+        """ Filename: path of every complete file of the snapshot """
+        return {name: Path(directory) / name for directory, (_, files, _) in self._dirs.items() for name in files
+                if not is_partial(name)}
+
+    def add(self, path):
+        """ Records a file which landed after the last refresh, its directory is listed again on the next refresh """
+        directory, name = os.path.split(os.path.abspath(path))
+        files = self._dirs.setdefault(directory, [-1, [], []])[1]
+        if name not in files:
+            files.append(name)
+            files.sort()
+
+    def refresh(self):
+        """ Updates the snapshot with the directories which changed. Returns the shows. """
+        # A directory modified within the mtime granularity of the scan may change again unnoticed, it is listed again
+        # on the next refresh
+        racy_ns = time.time_ns() - 2 * 10 ** 9
+        directories = {}
+        self.rescanned = 0
+
+        stack = [self._local_source]
+        while len(stack) > 0:
+            path = stack.pop()
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+
+            known = self._dirs.get(path)
+            if known is not None and known[0] == mtime_ns:
+                files, subdirectories = known[1], known[2]
+            else:
+                self.rescanned += 1
+                files, subdirectories = [], []
+                try:
+                    with os.scandir(path) as it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirectories.append(entry.name)
+                            elif entry.is_file():
+                                files.append(entry.name)
+                except OSError:
+                    continue
+
+            directories[path] = [mtime_ns if mtime_ns < racy_ns else -1, sorted(files), sorted(subdirectories)]
+            stack.extend(os.path.join(path, d) for d in subdirectories)
+
+        self._dirs = directories
+        return self.shows()
+
+    def save(self):
+        # Replaced atomically, an interrupted save leaves the previous snapshot
+        tmp_path = self._snapshot_path.with_name('.' + self._snapshot_path.name + '.part')
+        with open(tmp_path, 'w') as f:
+            json.dump({'local_source': self._local_source, 'directories': self._dirs}, f)
+        os.replace(tmp_path, self._snapshot_path)
+
+
 class ShowScheduler:
     def __init__(self,
                  show_root_directory,
                  playlist_path,
                  shows_source: ShowSource,
-                 selection_policy: SelectionPolicy = SelectionPolicy.RANDOM):
+                 selection_policy: SelectionPolicy = SelectionPolicy.RANDOM,
+                 inventory_path=None):
         """
 
         :param show_root_directory: The directory of the show under (inside DynamicShowsRoot directory)
@@ -50,6 +151,7 @@ class ShowScheduler:
         :param shows_source: The source(s) from which new shows are populated
         :param selection_policy: Policy about which show to select from the upcoming folder. Maybe overridden if
                                     priority file is not empty.
+        :param inventory_path: The snapshot of the local source, .inventory.json in the show directory by default
         """
         self._show_root_directory = Path(show_root_directory)
         self._playlist_path = Path(playlist_path)
@@ -59,6 +161,8 @@ class ShowScheduler:
         self._upcoming_dir = self._show_root_directory / 'upcoming'
         self._scheduled_dir = self._show_root_directory / 'scheduled'
         self._priority_filepath = self._show_root_directory / 'priority.txt'
+        self._inventory_path = Path(inventory_path) if inventory_path is not None else \
+            self._show_root_directory / '.inventory.json'
         self._check_directory_integrity()
 
     def _check_directory_integrity(self):
@@ -86,21 +190,15 @@ class ShowScheduler:
                 raise AssertionError
 
     def _update_pls(self, show_path):
-        with open(self._playlist_path, 'r') as f:
-            pls_lines = f.readlines()
-
-        # Change the last entry to the path of the new show
-        for i, l in enumerate(pls_lines[::-1]):
-            if l.startswith('File'):
-                file_label, _ = l.split('=', maxsplit=1)
-                pls_lines[-(i + 1)] = f'{file_label}={show_path}'
+        entries = list(read_playlist(self._playlist_path))
+        if len(entries) == 0:
+            raise AssertionError('Invalid pls file')
 
-                with open(self._playlist_path, 'w') as f:
-                    f.writelines(pls_lines)
+        # Change the last entry to the path of the new show, the title and length of the previous show do not apply
+        entries[-1] = entries[-1]._replace(path=str(show_path), title=None, length=None)
 
-                break
-        else:
-            raise AssertionError('Invalid pls file')
+        # The playlist is replaced atomically, the audio scheduler may read it at any time
+        write_playlist(self._playlist_path, entries)
 
     def choose_show(self):
         with open(self._priority_filepath, 'r') as f:
@@ -136,7 +234,16 @@ class ShowScheduler:
         if new_path.exists():
             self._update_pls(new_path)
 
-    def _populate_shows(self):
+    def _link_show(self, show_path: Path):
+        """ Links a show to the upcoming directory, unless it is already upcoming or scheduled """
+        # We assume unique filenames
+        if os.path.lexists(self._upcoming_dir / show_path.name) or os.path.lexists(self._scheduled_dir / show_path.name):
+            return False
+
+        (self._upcoming_dir / show_path.name).symlink_to(show_path)
+        return True
+
+    def populate_shows(self):
         def populate_from_online_source(local_source, online_source):
             if not local_source.is_dir():
                 print('Invalid local path for downloading available shows.')
@@ -148,42 +255,109 @@ class ShowScheduler:
             # TODO: Check output
             subprocess.run(args)
 
-        def populate_from_local_source(local_source):
-            if not local_source.is_dir():
-                print('Invalid local path for populating shows.')
-                return
-
-            # Populated shows are the concatenation of upcoming + scheduled
-            # We assume unique filenames
-            populated_shows = set([p.name for p in self._upcoming_dir.iterdir()] +
-                                  [p.name for p in self._scheduled_dir.iterdir()])
-
-            all_shows_dict = {p.name: p for p in local_source.rglob('*') if p.is_file()}
-
-            new_shows = all_shows_dict.keys() - populated_shows
-
-            # Create symbolic links from each new show to the upcoming directory
-            for show_filename in new_shows:
-                (self._upcoming_dir / show_filename).symlink_to(all_shows_dict[show_filename])
-
         online_source = self._shows_source.online_source
-        local_source = Path(self._shows_source.local_source)
+        local_source = Path(self._shows_source.local_source) if self._shows_source.local_source is not None else None
 
         # Populate shows from online source to local source
-        if online_source is not None:
-            populate_from_online_source()
+        if online_source is not None and local_source is not None:
+            populate_from_online_source(local_source, online_source)
 
         # Populate shows from local source to upcoming directory
         if local_source is not None:
-            populate_from_local_source()
-
+            if not local_source.is_dir():
+                print('Invalid local path for populating shows.')
+                return
 
-show_root_directory = '/storage/Repository/Zones2.0/SHOWS/DynamicShowsRoot/Loskop'
-show_playlist_path = '/storage/Repository/Zones2.0/CONTEMPORARY/kolaz.pls'
-show_source = ShowSource(online_source=None, local_source='/storage/Library/Unsorted/Loskop')
-show_scheduler = ShowScheduler(show_root_directory, show_playlist_path, show_source)
+            self._populate_from_local_source(ShowInventory(local_source, self._inventory_path))
+
+    def _populate_from_local_source(self, inventory: ShowInventory):
+        known_shows = inventory.shows()
+        all_shows_dict = inventory.refresh()
+
+        # Only the shows which are not in the snapshot may be new, each of them is linked unless it is already
+        # upcoming or scheduled
+        new_shows = all_shows_dict.keys() - known_shows.keys()
+
+        # Create symbolic links from each new show to the upcoming directory
+        linked = sum(self._link_show(all_shows_dict[show_filename]) for show_filename in sorted(new_shows))
+        inventory.save()
+        print(f'{linked} new shows, {inventory.rescanned} of {inventory.directories} directories listed')
+
+    def watch_shows(self):
+        """ Links each new show of the local source to the upcoming directory as soon as it lands, until interrupted """
+        try:
+            import inotify.adapters
+        except ImportError:
+            raise RuntimeError('The watch mode requires the inotify package (pip install inotify)')
+
+        if self._shows_source.local_source is None or not Path(self._shows_source.local_source).is_dir():
+            raise FileNotFoundError('Local source directory does not exist')
+
+        # Catch up with the shows which landed while not watching. The online source is left to populate_shows.
+        inventory = ShowInventory(self._shows_source.local_source, self._inventory_path)
+        self._populate_from_local_source(inventory)
+
+        notifier = inotify.adapters.InotifyTree(str(self._shows_source.local_source))
+        for _, type_names, watch_path, filename in notifier.event_gen(yield_nones=False):
+            path = Path(os.fsdecode(watch_path)) / os.fsdecode(filename)
+            if 'IN_ISDIR' in type_names:
+                # The files of a directory which is moved in raise no events of their own
+                if 'IN_MOVED_TO' in type_names:
+                    self._populate_from_local_source(inventory)
+                continue
+
+            # A show has landed once it is closed after writing or renamed into place, e.g. from a .part file
+            if ('IN_CLOSE_WRITE' in type_names or 'IN_MOVED_TO' in type_names) and not is_partial(path.name):
+                if self._link_show(path):
+                    print(f'Linked {path.name}')
+                # So that the next populate does not take it for a new show
+                inventory.add(path)
+                inventory.save()
+
+
+def main(args):
+    show_source = ShowSource(online_source=args.online_source, local_source=args.local_source)
+    show_scheduler = ShowScheduler(args.show_root_directory, args.playlist_path, show_source,
+                                   SelectionPolicy[args.selection_policy], args.inventory_path)
+    if args.mode == 'watch':
+        show_scheduler.watch_shows()
+        return
+
+    show_scheduler.populate_shows()
+    if args.mode == 'schedule':
+        show_scheduler.choose_show()
 
 # schedule_path = '../.test/schedule.xml'
 # show_playlist_path = '/storage/Repository/Zones2.0/CONTEMPORARY/ExpDM.pls'
 # scheduled_times = find_scheduled_times(schedule_path, show_playlist_path)
 # print(scheduled_times)
+
+
+def cli(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Schedules the next show of a dynamic show folder into its playlist.')
+    parser.add_argument('--show_root_directory', nargs='?', type=str,
+                        default='/storage/Repository/Zones2.0/SHOWS/DynamicShowsRoot/Loskop',
+                        help='The directory of the show, containing upcoming, scheduled and priority.txt')
+    parser.add_argument('--playlist_path', nargs='?', type=str,
+                        default='/storage/Repository/Zones2.0/CONTEMPORARY/kolaz.pls',
+                        help='The playlist whose last entry is replaced by the scheduled show')
+    parser.add_argument('--local_source', nargs='?', type=str, default='/storage/Library/Unsorted/Loskop',
+                        help='Local directory where new shows appear')
+    parser.add_argument('--online_source', nargs='?', type=str, default=None,
+                        help='A playlist url that yt-dlp can handle')
+    parser.add_argument('--selection_policy', nargs='?', type=str, default='RANDOM',
+                        choices=[p.name for p in SelectionPolicy])
+    parser.add_argument('--mode', nargs='?', type=str, default='schedule', choices=['schedule', 'populate', 'watch'],
+                        help='schedule: populate upcoming from the sources and schedule the next show, '
+                             'populate: only populate upcoming, '
+                             'watch: link new shows of the local source to upcoming as soon as they land (inotify)')
+    parser.add_argument('--inventory_path', nargs='?', type=str, default=None,
+                        help='Snapshot of the local source, .inventory.json in the show root directory by default')
+    args = parser.parse_args(argv)
+
+    main(args)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,33 +1,162 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""
+Exports the files of a playlist to a folder, e.g. a USB disk or a backup volume.
+
+Files are transferred concurrently and a file which is already in the folder with the same size and mtime is skipped,
+so an export can be repeated or resumed cheaply. Besides copying, files may be hardlinked or reflinked (copy on write
+clone, falling back to an in-kernel copy_file_range) when the folder is on the same filesystem as the library.
+
+Files with the same name are exported as 'name (2).ext', 'name (3).ext' etc in playlist order, so the name of each
+entry is the same on every export of the same playlist.
+"""
+
 import os
+import time
+import fcntl
 import shutil
 import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from playlist_io import is_playlist, playlist_paths
+
+
+EXPORT_MODES = ['copy', 'hardlink', 'reflink']
+
+# ioctl of a copy on write clone of a whole file (btrfs, xfs), from linux/fs.h
+FICLONE = 0x40049409
+
+# FAT and exFAT keep mtimes at a 2 second resolution
+MTIME_TOLERANCE_NS = 2 * 10 ** 9
+
+
+def export_names(filepaths):
+    """
+    The (source, exported name) of each distinct source, in playlist order. Later sources with an already taken name
+    get a numbered suffix.
+    """
+    taken = set()
+    names = []
+    for filepath in dict.fromkeys(filepaths):
+        stem, ext = os.path.splitext(os.path.basename(filepath))
+        name = stem + ext
+        n = 1
+        while name.lower() in taken:  # Case insensitive, as the filesystems of most USB disks
+            n += 1
+            name = '{0} ({1}){2}'.format(stem, n, ext)
+        taken.add(name.lower())
+        names.append((filepath, name))
+
+    return names
+
+
+def is_identical(source_stat, target_path):
+    try:
+        target_stat = os.stat(target_path)
+    except FileNotFoundError:
+        return False
+
+    if (source_stat.st_dev, source_stat.st_ino) == (target_stat.st_dev, target_stat.st_ino):
+        return True
+    return (source_stat.st_size == target_stat.st_size and
+            abs(source_stat.st_mtime_ns - target_stat.st_mtime_ns) < MTIME_TOLERANCE_NS)
 
 
-def main(playlist_path: str, output_path):
-    if not playlist_path.endswith('.pls'):
-        raise RuntimeError('Only pls filetype is currently supported!')
+def reflink(source_path, target_path):
+    with open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            # No copy on write support, the data is still copied by the kernel without passing through Python
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                n = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if n == 0:
+                    break
+                remaining -= n
+    shutil.copystat(source_path, target_path)
+
+
+def export_file(source_path, target_path, mode):
+    """ Returns the status of the export and the bytes transferred """
+    try:
+        source_stat = os.stat(source_path)
+    except FileNotFoundError:
+        return 'missing', 0
+
+    if is_identical(source_stat, target_path):
+        return 'identical', 0
+
+    # Replace atomically, an interrupted export never leaves a truncated file with the final name
+    tmp_path = os.path.join(os.path.dirname(target_path), '.' + os.path.basename(target_path) + '.part')
+    try:
+        if mode == 'hardlink':
+            os.link(source_path, tmp_path)
+        elif mode == 'reflink':
+            reflink(source_path, tmp_path)
+        else:
+            shutil.copy2(source_path, tmp_path)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    return mode, 0 if mode == 'hardlink' else source_stat.st_size
+
+
+def main(playlist_path: str, output_path, mode='copy', workers=4):
+    if not is_playlist(playlist_path):
+        raise RuntimeError('Only pls, m3u and m3u8 filetypes are currently supported!')
 
     if not os.path.exists(output_path):
         os.mkdir(output_path)
 
-    with open(playlist_path) as f:
-        lines = f.readlines()
+    names = export_names(playlist_paths(playlist_path))
 
-    for l in tqdm(lines):
-        if l.startswith('File'):
-            filepath = l[:-1].split('=')[1]
-            if os.path.exists(filepath):
-                shutil.copy2(filepath, output_path)
+    def export(job):
+        source_path, name = job
+        target_path = os.path.join(output_path, name)
+        try:
+            return export_file(source_path, target_path, mode)
+        except OSError:
+            if mode == 'copy':
+                raise
+            # e.g. a link across filesystems
+            return export_file(source_path, target_path, 'copy')
 
+    counts = Counter()
+    transferred = 0
+    start = time.time()
+    with ThreadPoolExecutor(workers) as pool:
+        for status, n_bytes in tqdm(pool.map(export, names), total=len(names)):
+            counts[status] += 1
+            transferred += n_bytes
+    elapsed = time.time() - start
 
-if __name__ == "__main__":
+    if mode != 'copy' and counts['copy'] > 0:
+        print('{0} files could not be {1}ed, probably on another filesystem, and were copied'.format(counts['copy'], mode))
+    print('{0} files: {1} exported ({2}), {3} already identical, {4} missing'.format(
+        len(names), sum(counts[m] for m in EXPORT_MODES), ', '.join('{0} {1}'.format(counts[m], m)
+                                                                   for m in EXPORT_MODES if counts[m] > 0) or '-',
+        counts['identical'], counts['missing']))
+    print('{0:.1f} MB in {1:.1f}s ({2:.1f} MB/s)'.format(transferred / 1e6, elapsed,
+                                                        transferred / 1e6 / max(elapsed, 1e-9)))
+
+
+def cli(argv=None, prog=None):
     parser = argparse.ArgumentParser(
-        description='Copies files contained in a playlist  to a specified folder.')
-    parser.add_argument('--playlist_path', nargs='?', required=True, help='PLS playlist path')
+        prog=prog, description='Copies files contained in a playlist  to a specified folder.')
+    parser.add_argument('--playlist_path', nargs='?', required=True, help='PLS/M3U playlist path')
     parser.add_argument('--output_path', nargs='?', required=True, help='Target directory')
-    args = parser.parse_args()
+    parser.add_argument('--mode', nargs='?', default='copy', choices=EXPORT_MODES,
+                        help='hardlink and reflink need the target directory on the filesystem of the library')
+    parser.add_argument('--workers', nargs='?', type=int, default=4, help='Number of concurrent transfers')
+    args = parser.parse_args(argv)
 
-    main(args.playlist_path, args.output_path)
+    main(args.playlist_path, args.output_path, args.mode, args.workers)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,14 +1,10 @@
 import os
+from playlist_io import playlist_paths
 
 orig_root_path = '/storage/raid/'
 my_root_path = '/mnt/rastapank/'
 
 filepath = '/mnt/rastapank/Repository/Zones/Punky_Reggae_Party/Punky_Reggae_Party.pls'
-with open(filepath, 'r') as f:
-    lines = f.readlines()
-
-lines = lines[2:]
-for l in lines:
-    _, path = l[:-1].split('=')
+for path in playlist_paths(filepath):
     path = path.replace(orig_root_path, my_root_path)
     print(os.path.exists(path))
\ No newline at end of file
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A columnar catalog of a scanned music library.
+
+Per track values (format, stream info, tagging state) are kept in a NumPy structured array and multi valued genres in
+a CSR like pair of arrays, so that all the statistics are vectorized operations over the catalog. A catalog is saved
+as a directory of .npy files which are memory mapped on load, so report queries run without rescanning the library:
+
+    python library_catalog.py --catalog_path /tmp/catalog --query genres
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from tag_reader import TrackTags
+
+
+TRACK_DTYPE = np.dtype([
+    ('format', 'U4'),
+    ('bitrate', 'i4'),
+    ('sample_rate', 'i4'),
+    ('bits_per_sample', 'i2'),
+    ('channels', 'i2'),
+    ('length', 'f8'),
+    ('tagged', '?')
+])
+
+
+class CatalogBuilder(object):
+    """ Accumulates scan results row by row. Partial builders of different processes are merged with extend(). """
+    def __init__(self):
+        self.rows = []
+        self.paths = []
+        self.genres = []
+
+    def add(self, tags: TrackTags, tagged: bool):
+        self.rows.append((tags.format, tags.bitrate, tags.sample_rate, tags.bits_per_sample, tags.channels,
+                          tags.length, tagged))
+        self.paths.append(tags.path)
+        self.genres.append(tags.genres)
+
+    def extend(self, other):
+        self.rows.extend(other.rows)
+        self.paths.extend(other.paths)
+        self.genres.extend(other.genres)
+
+    def build(self):
+        tracks = np.array(self.rows, dtype=TRACK_DTYPE)
+
+        # Genres are encoded in the order they are first seen
+        vocabulary = {}
+        codes = [vocabulary.setdefault(g, len(vocabulary)) for track_genres in self.genres for g in track_genres]
+        offsets = np.zeros(len(self.genres) + 1, dtype=np.int64)
+        np.cumsum([len(track_genres) for track_genres in self.genres], out=offsets[1:])
+
+        return LibraryCatalog(tracks, np.array(codes, dtype=np.int32), offsets, list(self.paths), list(vocabulary))
+
+
+class LibraryCatalog(object):
+    def __init__(self, tracks, genre_codes, genre_offsets, paths, genre_names):
+        self.tracks = tracks
+        self.genre_codes = genre_codes
+        self.genre_offsets = genre_offsets
+        self.paths = paths
+        self.genre_names = genre_names
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def save(self, catalog_path):
+        if not os.path.exists(catalog_path):
+            os.makedirs(catalog_path)
+
+        np.save(os.path.join(catalog_path, 'tracks.npy'), self.tracks)
+        np.save(os.path.join(catalog_path, 'genre_codes.npy'), self.genre_codes)
+        np.save(os.path.join(catalog_path, 'genre_offsets.npy'), self.genre_offsets)
+        with open(os.path.join(catalog_path, 'names.json'), 'w') as f:
+            json.dump({'paths': self.paths, 'genres': self.genre_names}, f)
+
+    @staticmethod
+    def load(catalog_path, mmap_mode='r'):
+        def load_array(name):
+            return np.load(os.path.join(catalog_path, name), mmap_mode=mmap_mode)
+
+        with open(os.path.join(catalog_path, 'names.json')) as f:
+            names = json.load(f)
+
+        return LibraryCatalog(load_array('tracks.npy'), load_array('genre_codes.npy'),
+                              load_array('genre_offsets.npy'), names['paths'], names['genres'])
+
+    def _mask(self, file_format=None):
+        if file_format is None:
+            return np.ones(len(self.tracks), dtype=bool)
+        return self.tracks['format'] == file_format
+
+    def count(self, file_format=None):
+        return int(np.count_nonzero(self._mask(file_format)))
+
+    def untagged_paths(self, file_format=None):
+        idx = np.flatnonzero(self._mask(file_format) & ~self.tracks['tagged'])
+        return [self.paths[i] for i in idx]
+
+    def bitrate_histogram(self, file_format, bins):
+        """ Number of tracks per bin (kbps), each track counted in its closest bin, ties going to the lower one """
+        bins = np.asarray(bins)
+        kbps = self.tracks['bitrate'][self._mask(file_format)] // 1000
+
+        pos = np.clip(np.searchsorted(bins, kbps, side='left'), 1, len(bins) - 1)
+        closer_to_next = bins[pos] - kbps < kbps - bins[pos - 1]
+        idx = np.where(closer_to_next, pos, pos - 1)
+
+        return np.bincount(idx, minlength=len(bins))
+
+    def _value_counts(self, column, file_format=None):
+        values, counts = np.unique(self.tracks[column][self._mask(file_format)], return_counts=True)
+        return dict(zip(values.tolist(), counts.tolist()))
+
+    def sample_rate_histogram(self, file_format=None):
+        return self._value_counts('sample_rate', file_format)
+
+    def bit_depth_histogram(self, file_format=None):
+        return self._value_counts('bits_per_sample', file_format)
+
+    def duration_per_format(self):
+        """ Total duration in seconds per file format """
+        formats, inverse = np.unique(self.tracks['format'], return_inverse=True)
+        totals = np.bincount(inverse, weights=self.tracks['length'], minlength=len(formats))
+        return dict(zip(formats.tolist(), totals.tolist()))
+
+    def genre_counts(self, file_format=None):
+        """ Tracks per genre, in the order the genres were first seen in tracks of file_format """
+        codes = self.genre_codes
+        if file_format is not None:
+            # Expand the per track mask to the genre entries of each track
+            per_track = np.diff(self.genre_offsets)
+            codes = codes[np.repeat(self._mask(file_format), per_track)]
+
+        genres, first, counts = np.unique(codes, return_index=True, return_counts=True)
+        return {self.genre_names[genres[i]]: int(counts[i]) for i in np.argsort(first, kind='stable')}
+
+
+def main(catalog_path, query, file_format):
+    catalog = LibraryCatalog.load(catalog_path)
+
+    if query == 'genres':
+        counts = catalog.genre_counts(file_format)
+        for g in sorted(counts, key=counts.get, reverse=True):
+            if not g.isspace():
+                print('{0} {1}'.format(g, counts[g]))
+    elif query == 'sample_rates':
+        print(catalog.sample_rate_histogram(file_format))
+    elif query == 'bit_depths':
+        print(catalog.bit_depth_histogram(file_format))
+    elif query == 'durations':
+        for f, seconds in catalog.duration_per_format().items():
+            print('{0}: {1:.1f} hours'.format(f, seconds / 3600))
+    elif query == 'untagged':
+        print(*catalog.untagged_paths(file_format), sep='\n')
+    else:
+        print('{0} tracks'.format(catalog.count(file_format)))
+
+
+def cli(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Query the catalog saved by library_inspector.py without rescanning the library')
+    parser.add_argument('--catalog_path', nargs='?', required=True, help='Catalog directory')
+    parser.add_argument('--query', nargs='?', default='count',
+                        choices=['count', 'genres', 'sample_rates', 'bit_depths', 'durations', 'untagged'])
+    parser.add_argument('--format', nargs='?', default=None, help='Restrict the query to a format, e.g. flac')
+    args = parser.parse_args(argv)
+
+    main(args.catalog_path, args.query, args.format)
+
+
+if __name__ == "__main__":
+    cli()
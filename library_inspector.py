@@ -5,86 +5,55 @@ Currently supported functionality:
 a) Statistics: how many files of a type (flac, mp3, etc), genres and bitrates
 b) Musicbrainz tagged and untagged files
 c) Consistency of an album, i.e. if the number of album tracks corresponds to the files in the directory
-    - May have the same album multiple times, and with different bitrates/file formats
+    - May have the same album multiple times, and with different bitrates/file formats (see duplicate_finder.py)
     - May miss a track
     - May have wrongly tagged the album
     - An album may have a ghost track
 """
 
-import sys
 import os
-import configparser
-import os
-import re
 from collections import Counter
-from mutagen.mp3 import MP3
-from mutagen.oggvorbis import OggVorbis
-from mutagen.id3 import ID3, TENC
-from mutagen.flac import FLAC
 from mutagen import MutagenError
-from bisect import bisect_left
-import numpy as np
 from abc import ABC
 import argparse
+from multiprocessing import Pool
 
 from utils import *
+from metadata_cache import MetadataCache
+from tag_reader import TrackTags, read_tags
+from library_walker import LibraryWalker
+from library_catalog import CatalogBuilder, LibraryCatalog
 
 # Options
 MP3_MAX_BITATE = 512
 MP3_N_BINS = 64
 
 
-def get_closest_idx(l: list, n: int):
-    ''' Assumes that input list is sorted '''
-    pos = bisect_left(l, n)
-
-    if pos == 0:
-        return 0
-    if pos == len(l):
-        return len(l) - 1
-
-    prev = l[pos - 1]
-    next = l[pos]
-
-    return pos if next - n < n - prev else pos - 1
-
-
 def find_closest(l: list, n: int):
     min(l, key=lambda x: abs(x - n))
 
 
 class GenericFileTypeStat(ABC):
     def __init__(self):
-        self._total_files = 0
         self._name = 'gen'
-        self._untagged_list = []
-        self._genres = dict()
 
-    def add_file(self, track_path: str):
-        self._total_files += 1
-
-    def size(self):
-        return self._total_files
+    def add_file(self, tags: TrackTags, catalog: CatalogBuilder):
+        catalog.add(tags, self.is_tagged(tags))
 
     def name(self):
         return self._name
 
-    def contains_tag(self, tags_dict: dict, tag: str):
-        pass
-
-    def _inspect(self, metadata: dict, track_path: str):
+    def is_tagged(self, tags: TrackTags):
         pass
 
-    def directory_is_consistent(self, album_path: str):
-        pass
-
-    def get_genres(self):
-        return self._genres
+    def directory_is_consistent(self, n_files: int, tags: TrackTags):
+        ''' Checks the number of files of an album against the total tracks of its first file '''
+        if tags.total_tracks is None:
+            return False, n_files, None
 
-    def get_untagged(self):
-        return self._untagged_list
+        return tags.total_tracks == n_files, n_files, tags.total_tracks
 
-    def get_stats(self):
+    def get_stats(self, catalog: LibraryCatalog, total_files: int):
         pass
 
 
@@ -93,49 +62,19 @@ class FlacFileTypeHolder(GenericFileTypeStat):
         GenericFileTypeStat.__init__(self)
         self._name = 'flac'
 
-    def add_file(self, track_path: str):
-        GenericFileTypeStat.add_file(self, track_path)
-
-        audio = FLAC(track_path)
-        kbps = audio.info.sample_rate * audio.info.bits_per_sample * audio.info.channels / 1000
+    def is_tagged(self, tags: TrackTags):
+        return tags.album_id != '' and tags.recording_id != ''
 
-        self._inspect(audio, track_path)
-
-    def contains_tag(self, tags_dict: dict, tag: str):
-        return True if tag in tags_dict and len(tags_dict[tag]) > 0 else False
-
-    def _inspect(self, metadata: dict, track_path: str):
-        if not self.contains_tag(metadata, 'musicbrainz_albumid') or \
-                not self.contains_tag(metadata, 'musicbrainz_trackid'):
-            self._untagged_list.append(track_path)
-        if self.contains_tag(metadata, 'genre'):
-            for g in metadata['genre']:
-                trimmed_genres = re.split('; |;', g)  # handle additional splits
-                for gg in trimmed_genres:
-                    if gg not in self._genres:
-                        self._genres[gg] = 0
-                    self._genres[gg] += 1
-
-    def directory_is_consistent(self, album_path: str):
-        files = os.listdir(album_path)
-
-        flac = FLAC(os.path.join(album_path, files[0]))
-
-        total_tracks = 0
-        if self.contains_tag(flac, 'TOTALTRACKS'):
-            try:
-                total_tracks = int(flac['TOTALTRACKS'][0])
-            except IndexError:
-                return False, len(files), None
-
-        return total_tracks == len(files), len(files), total_tracks
+    def directory_is_consistent(self, n_files: int, tags: TrackTags):
+        # A missing total is reported as 0 tracks
+        total_tracks = tags.total_tracks or 0
+        return total_tracks == n_files, n_files, total_tracks
 
 
 class Mp3FileTypeHolder(GenericFileTypeStat):
     def __init__(self):
         GenericFileTypeStat.__init__(self)
         self._name = 'mp3'
-        self.__mp3_bitrates = np.zeros(int(MP3_MAX_BITATE / MP3_N_BINS + 1))  # fill zeros
         self.__mp3_bins = []
         self.__fill_bins()
 
@@ -143,49 +82,13 @@ class Mp3FileTypeHolder(GenericFileTypeStat):
         for i in range(0, MP3_MAX_BITATE + 1, MP3_N_BINS):
             self.__mp3_bins.append(i)
 
-    def add_file(self, track_path: str):
-        GenericFileTypeStat.add_file(self, track_path)
-
-        audio = MP3(track_path)
-        kbps = int(audio.info.bitrate / 1000)
-
-        idx = get_closest_idx(self.__mp3_bins, kbps)
-        self.__mp3_bitrates[idx] += 1
-
-        self._inspect(ID3(track_path), track_path)
-
-    def contains_tag(self, tags_dict: dict, tag: str):
-        return True if tag in tags_dict and len(tags_dict[tag].text) > 0 else False
-
-    def _inspect(self, metadata: dict, track_path: str):
-        if not self.contains_tag(metadata, 'TXXX:MusicBrainz Album Id'):
-                # Commented out because some don't have at the time they were tagged
-                #or not self.contains_tag(metadata, 'TXXX:MusicBrainz Release Track Id'):
-            self._untagged_list.append(track_path)
-        if self.contains_tag(metadata, 'TCON'):
-            for g in metadata['TCON'].text:
-                trimmed_genres = re.split('; |;', g)  # handle additional splits
-                for gg in trimmed_genres:
-                    if gg not in self._genres:
-                        self._genres[gg] = 0
-                    self._genres[gg] += 1
-
-    def get_stats(self):
-        if self._total_files > 0:
-            return dict(zip(self.__mp3_bins, self.__mp3_bitrates / self._total_files))
+    def is_tagged(self, tags: TrackTags):
+        # The release track id is not required because some don't have it at the time they were tagged
+        return tags.album_id != ''
 
-    def directory_is_consistent(self, album_path: str):
-        files = os.listdir(album_path)
-
-        id3 = ID3(os.path.join(album_path, files[0]))
-
-        if self.contains_tag(id3, 'TRCK'):
-            try:
-                total_tracks = int(id3['TRCK'].text[0].split('/')[1])
-            except IndexError:
-                return False, len(files), None
-
-        return total_tracks == len(files), len(files), total_tracks
+    def get_stats(self, catalog: LibraryCatalog, total_files: int):
+        if total_files > 0:
+            return dict(zip(self.__mp3_bins, catalog.bitrate_histogram(self._name, self.__mp3_bins) / total_files))
 
 
 FlacFileTypeHolder = SingletonDecorator(FlacFileTypeHolder)
@@ -201,8 +104,12 @@ class LibraryInspector:
                 '.mp3': Mp3FileTypeHolder()
             }
 
+        self.__catalog = CatalogBuilder()
         self.__inconsistent_directories = []
         self.__unknown_errors = []
+        # Files which could not be read still count in the number of files of their format
+        self.__unreadable = Counter()
+        self.__read = read_tags
 
         # Options
         self.__accepted_extensions = None
@@ -210,76 +117,150 @@ class LibraryInspector:
         self.__output_file = None
 
     """
-
+    Inspects the library found under library_path and writes the report to output_file. When workers > 1, albums
+    are sharded across a process pool and the partial statistics are merged in walk order, so that the report is
+    identical to the one of a serial run. When cache_path is given, metadata of unchanged files is served from the
+    metadata cache instead of reparsing the files. Statistics are computed over the columnar catalog of the scan, which
+    is also saved to catalog_path when given, for later queries with library_catalog.py.
     """
-    def run(self, library_path, accepted_extensions, detail_level, output_file):
+    def run(self, library_path, accepted_extensions, detail_level, output_file, workers=1, cache_path=None,
+            catalog_path=None):
         self.__accepted_extensions = ['.' + s for s in accepted_extensions]
         self.__detail_level = detail_level
         self.__output_file = output_file
 
-        # A quick look ahead in order to report processing status
-        n_children_dirs = \
-            len([ None for path, dirs, files in os.walk(library_path)])
+        if workers > 1:
+            self.__run_parallel(library_path, workers, cache_path)
+        elif cache_path is not None:
+            with MetadataCache(cache_path) as cache:
+                self.use_cache(cache)
+                self.__run_serial(library_path)
+                self.use_cache(None)
+            print('Metadata cache: {0} hits, {1} misses'.format(cache.hits, cache.misses))
+        else:
+            self.__run_serial(library_path)
 
-        print('Root directory contains: {0} folders'.format(n_children_dirs))
+        catalog = self.__catalog.build()
+        if catalog_path is not None:
+            catalog.save(catalog_path)
 
-        total_processed_dirs = 0
-        for path, dirs, files in os.walk(library_path):
-            total_processed_dirs += 1
-
-            print("Processing path {1}/{2}\n{0} ".format(path, total_processed_dirs, n_children_dirs))
-
-            if len(files) == 0:
-                continue
-            else:
-
-                # Directory specific inspection, by examining the first file
-                track_path = os.path.join(path, files[0])
-                filename, ext = os.path.splitext(track_path)
-
-                if ext not in self.__accepted_extensions:
-                    # Here we continue, because we want to report only the invalid directory
-                    self.__inconsistent_directories.append((path, 'Unsupported filetype'))
-                    continue
-
-                is_consistent = False
-
-                if ext in self.__holders.keys():
-                    try:
-                        is_consistent, existing, expected = self.__holders[ext].directory_is_consistent(path)
-                    except:
-                        is_consistent, existing, expected = False, 0, 0
-                        self.__unknown_errors.append('Error occured for track {0}'.format(track_path))
-                else:
-                    continue
-
-                if not is_consistent:
-                    self.__inconsistent_directories.append(
-                        (path, 'Total tracks not consistent: {0}/{1} '.format(existing, expected)))
-
-            for f in files:
-                track_path = os.path.join(path, f)
-                filename, ext = os.path.splitext(track_path)
-
-                if ext in self.__holders.keys():
-                    try:
-                        self.__holders[ext].add_file(track_path)
-                    except:
-                        self.__unknown_errors.append('Error occured for track {0}'.format(track_path))
-                # elif f.endswith('.ogg'):
-                #    audio = OggVorbis(track_path)
+        self.__write_report(catalog)
+
+    def __run_serial(self, library_path):
+        # Progress is estimated on the fly by the walker, no look ahead is required
+        walker = LibraryWalker(library_path)
+        for album in walker:
+            print("Processing path {1}/~{2}\n{0} ".format(album.path, walker.scanned_dirs,
+                                                          walker.estimated_total_dirs()))
 
+            self.process_directory(album.path, album.files)
+
+    def __run_parallel(self, library_path, workers, cache_path):
+        # The walk is needed anyway in order to shard
+        directories = [(album.path, album.files) for album in LibraryWalker(library_path)]
+
+        print('Root directory contains: {0} folders'.format(len(directories)))
+
+        # Contiguous shards, a few per worker, so that a slow album does not stall a whole worker
+        shard_size = max(1, len(directories) // (workers * 4))
+        shards = [(self.__accepted_extensions, cache_path, directories[i:i + shard_size])
+                  for i in range(0, len(directories), shard_size)]
+
+        total_processed_dirs = 0
+        with Pool(workers) as pool:
+            # imap keeps the shard order, so merged lists end up in walk order
+            for n_dirs, partial_stats in pool.imap(_inspect_shard, shards):
+                total_processed_dirs += n_dirs
+                print("Processed {0}/{1} folders".format(total_processed_dirs, len(directories)))
+
+                self.merge(partial_stats)
+
+    def process_directory(self, path, files):
+        if len(files) == 0:
+            return
+
+        # Directory specific inspection, by examining the first file
+        track_path = os.path.join(path, files[0])
+        filename, ext = os.path.splitext(track_path)
+
+        if ext not in self.__accepted_extensions:
+            # Here we return, because we want to report only the invalid directory
+            self.__inconsistent_directories.append((path, 'Unsupported filetype'))
+            return
+
+        if ext not in self.__holders.keys():
+            return
+
+        # The first file is read once, both for the directory check and for the statistics
+        try:
+            first_tags = self.__read(track_path)
+            is_consistent, existing, expected = self.__holders[ext].directory_is_consistent(len(files), first_tags)
+        except:
+            first_tags = None
+            is_consistent, existing, expected = False, 0, 0
+            self.__unknown_errors.append('Error occured for track {0}'.format(track_path))
+
+        if not is_consistent:
+            self.__inconsistent_directories.append(
+                (path, 'Total tracks not consistent: {0}/{1} '.format(existing, expected)))
+
+        for i, f in enumerate(files):
+            track_path = os.path.join(path, f)
+            filename, ext = os.path.splitext(track_path)
+
+            if ext in self.__holders.keys():
+                try:
+                    if i == 0 and first_tags is None:
+                        raise MutagenError('Could not read {0}'.format(track_path))
+                    self.__holders[ext].add_file(first_tags if i == 0 else self.__read(track_path), self.__catalog)
+                except:
+                    self.__unreadable[self.__holders[ext].name()] += 1
+                    self.__unknown_errors.append('Error occured for track {0}'.format(track_path))
+            # elif f.endswith('.ogg'):
+            #    audio = OggVorbis(track_path)
+
+    def set_accepted_extensions(self, accepted_extensions):
+        self.__accepted_extensions = accepted_extensions
+
+    def use_cache(self, cache):
+        self.__read = cache.get if cache is not None else read_tags
+
+    def get_partial_stats(self):
+        return {
+            'catalog': self.__catalog,
+            'inconsistent_directories': self.__inconsistent_directories,
+            'unknown_errors': self.__unknown_errors,
+            'unreadable': self.__unreadable
+        }
+
+    def merge(self, partial_stats):
+        self.__catalog.extend(partial_stats['catalog'])
+        self.__inconsistent_directories.extend(partial_stats['inconsistent_directories'])
+        self.__unknown_errors.extend(partial_stats['unknown_errors'])
+        self.__unreadable.update(partial_stats['unreadable'])
+
+    def __write_report(self, catalog: LibraryCatalog):
         with open(self.__output_file, 'w') as f:
             f.write("------------ Stats ------------\n")
             for k, h in self.__holders.items():
-                f.write('\nNumber of {0} files: {1}\n'.format(h.name(), h.size()))
-                f.write('Bitrate stats:\n' + str(h.get_stats()))
-                untagged = h.get_untagged()
+                total_files = catalog.count(h.name()) + self.__unreadable[h.name()]
+                f.write('\nNumber of {0} files: {1}\n'.format(h.name(), total_files))
+                f.write('Bitrate stats:\n' + str(h.get_stats(catalog, total_files)))
+                untagged = catalog.untagged_paths(h.name())
                 f.write("\nFiles without musicbrainz tag:\n{0}".format('\n'.join('{}: {}'.format(*k) for k in enumerate(untagged))))
 
+            f.write("\n*****************************************\n")
+            f.write("Stream stats:\n")
+            durations = catalog.duration_per_format()
+            for k, h in self.__holders.items():
+                f.write('{0}: sample rates {1}, bit depths {2}, total duration {3:.1f} hours\n'.format(
+                    h.name(), catalog.sample_rate_histogram(h.name()), catalog.bit_depth_histogram(h.name()),
+                    durations.get(h.name(), 0) / 3600))
+
+            # Genres of each format in turn, so that ties keep the order of the format holders
             genres_counter = Counter()
             for k, h in self.__holders.items():
-                genres_counter += Counter(h.get_genres())
+                genres_counter.update(catalog.genre_counts(h.name()))
 
             f.write("\n*****************************************\n")
             f.write("Genres:\n")
@@ -297,21 +278,53 @@ class LibraryInspector:
                 '\n'.join('{}: {}'.format(*k) for k in enumerate(self.__unknown_errors))))
 
 
+
+def _inspect_shard(shard):
+    """ Worker entry point: inspects a shard of directories with a fresh (non singleton) inspector """
+    accepted_extensions, cache_path, directories = shard
+
+    inspector = LibraryInspector.klass()
+    inspector.set_accepted_extensions(accepted_extensions)
+
+    if cache_path is not None:
+        # Each worker holds its own connection, sqlite serializes the writers. Every miss is committed at once, an open
+        # write transaction would hold the lock of the shared file across the parses and stall the other workers.
+        with MetadataCache(cache_path, commit_every=1) as cache:
+            inspector.use_cache(cache)
+            for path, files in directories:
+                inspector.process_directory(path, files)
+    else:
+        for path, files in directories:
+            inspector.process_directory(path, files)
+
+    return len(directories), inspector.get_partial_stats()
+
+
 LibraryInspector = SingletonDecorator(LibraryInspector)
 
 
-def main(library_path, output_path):
+def main(library_path, output_path, workers=1, cache_path=None, catalog_path=None):
     config_file = './LibraryInspector.conf'
 
     inspector = LibraryInspector()
-    inspector.run( library_path, ['flac', 'mp3', 'ogg'], 1, output_path)
+    inspector.run( library_path, ['flac', 'mp3', 'ogg'], 1, output_path, workers, cache_path, catalog_path)
 
 
-if __name__ == "__main__":
+def cli(argv=None, prog=None):
     parser = argparse.ArgumentParser(
-        description='An inspector of a music library')
+        prog=prog, description='An inspector of a music library')
     parser.add_argument('--library_path', nargs='?', required=True, help='The directory which contains the music library.')
     parser.add_argument('--output_path', nargs='?', required=True, help='The filepath to store inspection output')
-    args = parser.parse_args()
+    parser.add_argument('--workers', nargs='?', type=int, default=1,
+                        help='Number of processes to scan the library with. The report is the same as a serial run.')
+    parser.add_argument('--cache_path', nargs='?', default=None,
+                        help='Metadata cache file. Only new or modified files are parsed on subsequent runs.')
+    parser.add_argument('--catalog_path', nargs='?', default=None,
+                        help='Directory to save the catalog of the scan, for later queries with library_catalog.py')
+    args = parser.parse_args(argv)
 
-    main(args.library_path, args.output_path)
+    main(args.library_path, args.output_path, args.workers, args.cache_path, args.catalog_path)
+
+
+if __name__ == "__main__":
+    cli()
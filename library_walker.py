@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A single pass walker of a music library, shared by the library tools.
+
+It is built on os.scandir and relies on the file type reported by the directory listing (d_type), so files are
+classified without any extra stat call, which is the dominant cost on NFS/RAID mounts. Directories are visited in the
+same (top-down) order as os.walk.
+"""
+
+import os
+from collections import namedtuple
+
+
+AUDIO_EXTENSIONS = ['.flac', '.mp3', '.ogg']
+
+# path: the directory, dirs/files: names of its subdirectories and files, audio_files: audio file names per extension
+Album = namedtuple('Album', ['path', 'dirs', 'files', 'audio_files'])
+
+
+def is_leaf(album: Album):
+    return len(album.dirs) == 0
+
+
+class LibraryWalker(object):
+    def __init__(self, library_path, audio_extensions=AUDIO_EXTENSIONS, prune=None):
+        """
+        :param prune: Optional callable which receives the path of a directory before it is listed. When it returns
+                      True, the directory and its subdirectories are neither listed nor yielded.
+        """
+        self._library_path = library_path
+        self._audio_extensions = audio_extensions
+        self._prune = prune
+
+        # Progress counters
+        self.scanned_dirs = 0
+        self.pending_dirs = 0
+        self.scanned_files = 0
+
+    def __iter__(self):
+        # Directories still to be visited, pushed in reverse order so that pop() preserves the listing order
+        stack = [self._library_path]
+        self.pending_dirs = 1
+
+        while stack:
+            path = stack.pop()
+            self.pending_dirs -= 1
+
+            if self._prune is not None and self._prune(path):
+                continue
+
+            dirs = []
+            descend = []
+            files = []
+            audio_files = {}
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            # Same semantics as os.walk: symbolic links to directories are reported but not followed
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+
+                        if is_dir:
+                            dirs.append(entry.name)
+                            if not entry.is_symlink():
+                                descend.append(entry.path)
+                        else:
+                            files.append(entry.name)
+                            _, ext = os.path.splitext(entry.name)
+                            if ext in self._audio_extensions:
+                                audio_files.setdefault(ext, []).append(entry.name)
+            except OSError:
+                continue
+
+            self.scanned_dirs += 1
+            self.scanned_files += len(files)
+
+            stack.extend(reversed(descend))
+            self.pending_dirs += len(descend)
+
+            yield Album(path, dirs, files, audio_files)
+
+    def estimated_total_dirs(self):
+        """
+        The directories visited plus the ones discovered but not visited yet. It is a lower bound which converges to
+        the real number as the walk proceeds.
+        """
+        return self.scanned_dirs + self.pending_dirs
+
+    def progress(self):
+        """ Estimated fraction of the library walked so far, without any look ahead """
+        return self.scanned_dirs / max(1, self.estimated_total_dirs())
+
+
+def walk_albums(library_path, audio_extensions=AUDIO_EXTENSIONS):
+    """ Yields only the leaf directories which contain files, i.e. the albums """
+    for album in LibraryWalker(library_path, audio_extensions):
+        if is_leaf(album) and len(album.files) > 0:
+            yield album
@@ -1,5 +1,6 @@
 import os
 from pathlib import Path
+from playlist_io import playlist_paths
 
 mappings = {
     'iouiou-tsoukoutsoukou.pls': 'iouiou-tsoukoutsoukou/iouiou-tsoukoutsoukou.pls',
@@ -33,16 +34,7 @@ mappings = {
 
 
 def read_pls(filepath):
-    with open(filepath, 'r') as f:
-        lines = f.readlines()
-
-    filtered_lines = []
-    for l in lines:
-        if not l.startswith('File') or 'Sorted' not in l:
-            continue
-        filtered_lines.append(l.split('=')[1])
-
-    return filtered_lines
+    return [p for p in playlist_paths(filepath) if 'Sorted' in p]
 
 
 wrong_zones_path = Path('/storage/Repository/Zones2.0')
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A persistent cache of the metadata extracted from the files of a music library.
+
+Entries are keyed by path and are considered valid as long as size, mtime and inode of the file are unchanged, so on
+a rescan only new or modified files are opened. The cache is a single SQLite file which can be shared by all the
+library tools.
+"""
+
+import os
+import json
+import sqlite3
+from tag_reader import TrackTags, read_tags
+
+
+# Bumped whenever the layout of TrackTags changes, which invalidates all the cached entries
+CACHE_VERSION = 2
+
+
+class MetadataCache(object):
+    def __init__(self, dbfile, commit_every=1000):
+        """
+        :param dbfile: The SQLite file of the cache
+        :param commit_every: Number of misses written per transaction. The write lock of the file is held until the
+                             commit, so processes which share the file concurrently should commit every miss.
+        """
+        self._commit_every = commit_every
+        self._pending = 0
+        self.hits = 0
+        self.misses = 0
+
+        # Several inspector processes may share the same cache file
+        self.db_handle = sqlite3.connect(dbfile, timeout=60)
+        self.db_handle.execute('PRAGMA journal_mode=WAL')
+        self.db_handle.execute('PRAGMA synchronous=NORMAL')
+        if self.db_handle.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+            self.db_handle.execute('DROP TABLE IF EXISTS metadata')
+            self.db_handle.execute('PRAGMA user_version = {0}'.format(CACHE_VERSION))
+        self.db_handle.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            "inode INTEGER, data TEXT)")
+        self.db_handle.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, track_path) -> TrackTags:
+        """ Returns the TrackTags of track_path, opening the file only if it is not cached or it has changed """
+        st = os.stat(track_path)
+
+        row = self.db_handle.execute(
+            "SELECT size, mtime_ns, inode, data FROM metadata WHERE path = ?", (track_path,)).fetchone()
+        if row is not None and row[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+            self.hits += 1
+            return TrackTags(*json.loads(row[3]))
+
+        self.misses += 1
+        metadata = read_tags(track_path)
+
+        self.db_handle.execute(
+            "INSERT OR REPLACE INTO metadata(path, size, mtime_ns, inode, data) VALUES(?, ?, ?, ?, ?)",
+            (track_path, st.st_size, st.st_mtime_ns, st.st_ino, json.dumps(metadata)))
+
+        # Batch the commits, one transaction per file would dominate a first scan
+        self._pending += 1
+        if self._pending >= self._commit_every:
+            self.commit()
+
+        return metadata
+
+    def commit(self):
+        self.db_handle.commit()
+        self._pending = 0
+
+    def close(self):
+        if self.db_handle is not None:
+            self.commit()
+            self.db_handle.close()
+            self.db_handle = None
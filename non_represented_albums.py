@@ -1,90 +1,221 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-(1) Loads a directory which contains playlist files in its subfolders.
+(1) Loads a directory which contains playlist files in its subfolders. Each top level subfolder is a zone.
 (2) Loads a directory which contains the music library from which those playlists are created. It is assumed that each
 leaf directory represents an album.
 (3) Albums that are not represented in any playlist are reported.
 
-Currently supported playlist extensions: .pls
+Both trees are materialized in a persistent coverage index: the albums of the library with their number of tracks,
+and for each playlist the albums it references with the number of referenced tracks. Only the playlists and the album
+directories whose mtime changed are read again on refresh, and with --no_refresh the queries are answered from the
+index alone:
+    unrepresented: albums which are not included in any playlist
+    single-zone: albums included in the playlists of exactly one zone
+    overlap: number of albums shared by each pair of zones
+
+Currently supported playlist extensions: .pls, .m3u, .m3u8
 """
 
 import os
+import sqlite3
 import argparse
+from collections import Counter
+from utils import prefix_range
+from library_walker import LibraryWalker, is_leaf
+from playlist_io import find_playlists, playlist_paths
+
+
+class CoverageIndex(object):
+    def __init__(self, dbfile):
+        self.db_handle = sqlite3.connect(dbfile)
+        self.db_handle.execute('PRAGMA journal_mode=WAL')
+        self.db_handle.execute('PRAGMA synchronous=NORMAL')
+
+        self.db_handle.execute(
+            "CREATE TABLE IF NOT EXISTS albums (path TEXT PRIMARY KEY, mtime_ns INTEGER, tracks INTEGER)")
+        self.db_handle.execute(
+            "CREATE TABLE IF NOT EXISTS playlists (id INTEGER PRIMARY KEY, path TEXT UNIQUE, zone TEXT, "
+            "mtime_ns INTEGER, size INTEGER)")
+        # Reverse index: the playlists which reference an album, with the number of tracks they reference
+        self.db_handle.execute(
+            "CREATE TABLE IF NOT EXISTS album_refs (album TEXT, playlist_id INTEGER, tracks INTEGER, "
+            "PRIMARY KEY (album, playlist_id)) WITHOUT ROWID")
+        self.db_handle.execute("CREATE INDEX IF NOT EXISTS album_refs_playlist ON album_refs(playlist_id)")
+        self.db_handle.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.db_handle is not None:
+            self.db_handle.close()
+            self.db_handle = None
+
+    def refresh_playlists(self, playlists_path):
+        """ Reads again the playlists which are new or modified and drops the deleted ones """
+        playlists_path = os.path.abspath(playlists_path)
+
+        on_disk = {}
+        for playlist_path in find_playlists(playlists_path):
+            st = os.stat(playlist_path)
+            on_disk[playlist_path] = (st.st_mtime_ns, st.st_size)
+
+        indexed = {path: (playlist_id, (mtime_ns, size)) for playlist_id, path, mtime_ns, size in self.db_handle.execute(
+            "SELECT id, path, mtime_ns, size FROM playlists WHERE path >= ? AND path < ?", prefix_range(playlists_path))}
+
+        stale = [playlist_id for path, (playlist_id, stat) in indexed.items() if on_disk.get(path) != stat]
+        updated = [path for path, stat in on_disk.items() if path not in indexed or indexed[path][1] != stat]
+
+        with self.db_handle:
+            for playlist_id in stale:
+                self.db_handle.execute("DELETE FROM album_refs WHERE playlist_id = ?", (playlist_id,))
+                self.db_handle.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
+
+            for playlist_path in updated:
+                mtime_ns, size = on_disk[playlist_path]
+                cur = self.db_handle.execute(
+                    "INSERT INTO playlists(path, zone, mtime_ns, size) VALUES(?, ?, ?, ?)",
+                    (playlist_path, _zone(playlists_path, playlist_path), mtime_ns, size))
+
+                albums = Counter(os.path.dirname(p) for p in playlist_paths(playlist_path))
+                self.db_handle.executemany(
+                    "INSERT INTO album_refs(album, playlist_id, tracks) VALUES(?, ?, ?)",
+                    [(album, cur.lastrowid, tracks) for album, tracks in albums.items()])
+
+        return len(updated), len(indexed.keys() - on_disk.keys())
+
+    def refresh_library(self, library_path):
+        """
+        Lists again the album directories which are new or whose mtime changed and drops the deleted ones. Adding or
+        removing files or subdirectories changes the mtime of a directory, so unchanged albums are not listed.
+        """
+        library_path = os.path.abspath(library_path)
+
+        known = dict(self.db_handle.execute(
+            "SELECT path, mtime_ns FROM albums WHERE path >= ? AND path < ?", prefix_range(library_path)))
+        unchanged = set()
+
+        def is_unchanged(path):
+            if path not in known:
+                return False
+            try:
+                if os.stat(path).st_mtime_ns != known[path]:
+                    return False
+            except OSError:
+                return False
+            unchanged.add(path)
+            return True
+
+        updated = []
+        for album in LibraryWalker(library_path, prune=is_unchanged):
+            # Each leaf directory which contains files is an album
+            if is_leaf(album) and len(album.files) > 0:
+                updated.append((album.path, os.stat(album.path).st_mtime_ns,
+                                sum(len(files) for files in album.audio_files.values())))
+
+        removed = known.keys() - unchanged - set(u[0] for u in updated)
+
+        with self.db_handle:
+            self.db_handle.executemany("INSERT OR REPLACE INTO albums(path, mtime_ns, tracks) VALUES(?, ?, ?)",
+                                       updated)
+            self.db_handle.executemany("DELETE FROM albums WHERE path = ?", [(p,) for p in removed])
+
+        return len(updated), len(removed)
+
+    def counts(self, playlists_path, library_path):
+        """ Number of albums referenced by the playlists and number of albums of the library """
+        referenced = self.db_handle.execute(
+            "SELECT COUNT(DISTINCT r.album) FROM album_refs r JOIN playlists p ON p.id = r.playlist_id "
+            "WHERE p.path >= ? AND p.path < ?", prefix_range(os.path.abspath(playlists_path))).fetchone()[0]
+        library = self.db_handle.execute(
+            "SELECT COUNT(*) FROM albums WHERE path >= ? AND path < ?",
+            prefix_range(os.path.abspath(library_path))).fetchone()[0]
+        return referenced, library
+
+    def unrepresented_albums(self, playlists_path, library_path):
+        """ The (album, tracks) of the library which are not referenced by any playlist """
+        return self.db_handle.execute(
+            "SELECT a.path, a.tracks FROM albums a WHERE a.path >= ? AND a.path < ? AND NOT EXISTS ("
+            "SELECT 1 FROM album_refs r JOIN playlists p ON p.id = r.playlist_id "
+            "WHERE r.album = a.path AND p.path >= ? AND p.path < ?) ORDER BY a.path",
+            prefix_range(os.path.abspath(library_path)) + prefix_range(os.path.abspath(playlists_path))).fetchall()
+
+    def single_zone_albums(self, playlists_path, library_path):
+        """ The (album, zone, referenced tracks, tracks) of the library which are referenced by exactly one zone """
+        return self.db_handle.execute(
+            "SELECT r.album, MIN(p.zone), MAX(r.tracks), a.tracks FROM album_refs r "
+            "JOIN playlists p ON p.id = r.playlist_id JOIN albums a ON a.path = r.album "
+            "WHERE p.path >= ? AND p.path < ? AND a.path >= ? AND a.path < ? "
+            "GROUP BY r.album HAVING COUNT(DISTINCT p.zone) = 1 ORDER BY r.album",
+            prefix_range(os.path.abspath(playlists_path)) + prefix_range(os.path.abspath(library_path))).fetchall()
+
+    def zone_overlap(self, playlists_path):
+        """ The (zone, zone, shared albums) of each pair of zones which share at least one album """
+        return self.db_handle.execute(
+            "WITH zone_albums AS (SELECT DISTINCT p.zone, r.album FROM album_refs r "
+            "JOIN playlists p ON p.id = r.playlist_id WHERE p.path >= ? AND p.path < ?) "
+            "SELECT a.zone, b.zone, COUNT(*) FROM zone_albums a JOIN zone_albums b "
+            "ON a.album = b.album AND a.zone < b.zone GROUP BY a.zone, b.zone ORDER BY COUNT(*) DESC",
+            prefix_range(os.path.abspath(playlists_path))).fetchall()
+
+
+def _zone(playlists_path, playlist_path):
+    # The top level folder of the playlist, playlists directly under playlists_path belong to no zone
+    relative_path = os.path.relpath(playlist_path, playlists_path)
+    return relative_path.split(os.sep)[0] if os.sep in relative_path else ''
+
+
+def main(playlists_path, library_path, index_path, query='unrepresented', refresh=True):
+    index_dir = os.path.dirname(index_path)
+    if index_dir != '' and not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    with CoverageIndex(index_path) as index:
+        if refresh:
+            updated, removed = index.refresh_playlists(playlists_path)
+            print('Parsed {0} new or modified playlists, dropped {1}.'.format(updated, removed))
+            updated, removed = index.refresh_library(library_path)
+            print('Listed {0} new or modified albums, dropped {1}.'.format(updated, removed))
+
+        referenced, library = index.counts(playlists_path, library_path)
+        print('{0} albums are included in at least one playlist.'.format(referenced))
+        print('{0} albums are included in the library.'.format(library))
+
+        # Album paths are printed relative to the music library directory
+        prefix_length = len(os.path.abspath(library_path)) + 1
+        if query == 'unrepresented':
+            albums = index.unrepresented_albums(playlists_path, library_path)
+            print('{0} albums are not included in any playlist.'.format(len(albums)))
+            for album_path, tracks in albums:
+                print('{0}.'.format(album_path[prefix_length:]))
+        elif query == 'single-zone':
+            albums = index.single_zone_albums(playlists_path, library_path)
+            print('{0} albums are included in exactly one zone.'.format(len(albums)))
+            for album_path, zone, referenced_tracks, tracks in albums:
+                print('{0}: {1} ({2}/{3} tracks)'.format(album_path[prefix_length:], zone, referenced_tracks, tracks))
+        elif query == 'overlap':
+            for zone_a, zone_b, shared in index.zone_overlap(playlists_path):
+                print('{0} - {1}: {2} albums'.format(zone_a, zone_b, shared))
+
+
+def cli(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Report albums that are not represented in any playlist.')
+    parser.add_argument('--playlists_path', nargs='?', required=True, help='Zones path')
+    parser.add_argument('--library_path', nargs='?', required=True, help='Library path')
+    parser.add_argument('--index_path', nargs='?', default=os.path.expanduser('~/.cache/ark/coverage_index.db'),
+                        help='Persistent coverage index of the albums')
+    parser.add_argument('--query', nargs='?', default='unrepresented', choices=['unrepresented', 'single-zone', 'overlap'])
+    parser.add_argument('--no_refresh', action='store_true',
+                        help='Answer from the index without checking the playlists and the library for changes')
+    args = parser.parse_args(argv)
 
-
-def get_pls_almbums(pls_path):
-    albums_set = set()
-    with open(pls_path, encoding='utf-8') as f:
-        lines = f.readlines()
-        for line in lines:
-            if line.startswith('File'):
-                line = line.strip('\n')
-                tokens = line.split('=')
-                albums_set.add(os.path.join(os.path.dirname(tokens[1])))
-
-    return albums_set
-
-
-def parse_playlists(playlists_path, accepted_extensions):
-    list_albums_set = set()
-    total_playlists = 0
-    # Parse playlists
-    for root, dirs, files in os.walk(playlists_path):
-        if len(files) == 0:
-            continue
-        else:
-            for f in files:
-                file_path = os.path.join(root, f)
-                filename, ext = os.path.splitext(file_path)
-
-                if ext in accepted_extensions:
-                    # set union
-                    total_playlists += 1
-                    list_albums_set |= get_pls_almbums(file_path)
-
-    print('Parsed {0} playlists in total.'.format(total_playlists))
-    return list_albums_set
-
-
-def parse_library(library_path):
-    library_albums_set = set()
-
-    # Parse library
-    for root, dirs, files in os.walk(library_path):
-        if len(files) == 0:
-            continue
-        else:
-            # Get the leaf directory
-            if not dirs:
-                # Add the album path without the trailing slash
-                library_albums_set.add(os.path.join(root, os.path.dirname(files[0]))[:-1])
-
-    return library_albums_set
-
-
-def main(playlists_path, library_path):
-    accepted_extensions = ['.pls']
-
-    list_albums_set = parse_playlists(playlists_path, accepted_extensions)
-    print('{0} albums are included in at least one playlist.'.format(len(list_albums_set)))
-
-    library_albums_set = parse_library(library_path)
-    print('{0} albums are included in the library.'.format(len(library_albums_set)))
-
-    unrepresented_albums_set = library_albums_set - list_albums_set
-    print('{0} albums are not included in any playlist.'.format(len(unrepresented_albums_set)))
-
-    for album_path in sorted(unrepresented_albums_set):
-        # print the album path relative to the music library directory
-        print('{0}.'.format(album_path[len(library_path)+1:]))
+    main(args.playlists_path, args.library_path, args.index_path, args.query, not args.no_refresh)
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description='Report albums that are not represented in any playlist.')
-    parser.add_argument('--playlists_path', nargs='?', required=True, help='Source library path')
-    parser.add_argument('--library_path', nargs='?', required=True, help='Target library path')
-    args = parser.parse_args()
-
-    main(args.source, args.target)
+    cli()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reading and writing of PLS, M3U and M3U8 playlists, shared by the playlist tools.
+
+Playlists are parsed line by line as a generator of entries, so the whole file is never loaded. Playlists are written
+to a temporary file next to the target which is then renamed over it, so a reader (e.g. the audio scheduler) sees
+either the old or the new playlist but never a half-written one.
+
+    python playlist_io.py --playlist_path zone.pls
+    python playlist_io.py --benchmark 100000
+"""
+
+import os
+import time
+import argparse
+import tempfile
+from collections import namedtuple
+
+
+PLAYLIST_EXTENSIONS = ['.pls', '.m3u', '.m3u8']
+
+# index is 1-based, title is None and length (seconds) is None when the playlist does not provide them
+PlaylistEntry = namedtuple('PlaylistEntry', ['index', 'path', 'title', 'length'])
+
+# Paths are kept as written, undecodable bytes are carried through as surrogates
+ENCODING = 'utf-8-sig'
+ERRORS = 'surrogateescape'
+
+_PLS_FIELDS = ('file', 'title', 'length')
+
+
+def is_playlist(path):
+    return os.path.splitext(path)[1].lower() in PLAYLIST_EXTENSIONS
+
+
+def _to_length(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _pls_key(key):
+    """ Splits keys of the form File12 into ('file', 12), returns None for the other keys """
+    key = key.strip().lower()
+    for field in _PLS_FIELDS:
+        if key.startswith(field) and key[len(field):].isdigit():
+            return field, int(key[len(field):])
+    return None
+
+
+def _read_pls(f):
+    # Entries are grouped by index (FileN, TitleN, LengthN), an entry is complete once a line of another index starts.
+    # Title and length lines of an entry which is already complete are ignored.
+    current = None
+    for line in f:
+        key, sep, value = line.rstrip('\r\n').partition('=')
+        field_index = _pls_key(key) if sep else None
+        if field_index is None:
+            continue
+
+        field, index = field_index
+        if current is None or current['index'] != index:
+            if current is not None and 'path' in current:
+                yield PlaylistEntry(current['index'], current['path'], current['title'], current['length'])
+            current = {'index': index, 'title': None, 'length': None}
+
+        if field == 'file':
+            current['path'] = value
+        elif field == 'title':
+            current['title'] = value
+        else:
+            current['length'] = _to_length(value)
+
+    if current is not None and 'path' in current:
+        yield PlaylistEntry(current['index'], current['path'], current['title'], current['length'])
+
+
+def _read_m3u(f):
+    index = 0
+    title = length = None
+    for line in f:
+        line = line.rstrip('\r\n')
+        if line.startswith('#EXTINF:'):
+            # #EXTINF:<length>,<title>
+            length, _, title = line[len('#EXTINF:'):].partition(',')
+            length = _to_length(length.strip())
+        elif line.startswith('#') or line.strip() == '':
+            continue
+        else:
+            index += 1
+            yield PlaylistEntry(index, line, title or None, length)
+            title = length = None
+
+
+def read_playlist(playlist_path):
+    """ Yields the PlaylistEntry of a playlist in order. Raises ValueError for unsupported formats. """
+    ext = os.path.splitext(playlist_path)[1].lower()
+    if ext not in PLAYLIST_EXTENSIONS:
+        raise ValueError('Unsupported playlist extension {0}'.format(ext))
+
+    with open(playlist_path, encoding=ENCODING, errors=ERRORS) as f:
+        yield from _read_pls(f) if ext == '.pls' else _read_m3u(f)
+
+
+def playlist_paths(playlist_path):
+    for entry in read_playlist(playlist_path):
+        yield entry.path
+
+
+def find_playlists(root_directory, extensions=PLAYLIST_EXTENSIONS):
+    """ Yields the paths of the playlists found under root_directory """
+    for root, dirs, files in os.walk(root_directory):
+        for f in files:
+            if os.path.splitext(f)[1].lower() in extensions:
+                yield os.path.join(root, f)
+
+
+def _as_entries(entries):
+    # Plain paths are accepted too
+    for i, e in enumerate(entries):
+        yield e if isinstance(e, PlaylistEntry) else PlaylistEntry(i + 1, str(e), None, None)
+
+
+def _pls_lines(entries):
+    yield '[playlist]\n'
+    yield 'NumberOfEntries={0}\n'.format(len(entries))
+    for i, e in enumerate(entries):
+        yield 'File{0}={1}\n'.format(i + 1, e.path)
+        if e.title is not None:
+            yield 'Title{0}={1}\n'.format(i + 1, e.title)
+        if e.length is not None:
+            yield 'Length{0}={1}\n'.format(i + 1, e.length)
+    yield 'Version=2\n'
+
+
+def _m3u_lines(entries):
+    yield '#EXTM3U\n'
+    for e in entries:
+        if e.title is not None or e.length is not None:
+            yield '#EXTINF:{0},{1}\n'.format(e.length if e.length is not None else -1, e.title or '')
+        yield '{0}\n'.format(e.path)
+
+
+def write_playlist(playlist_path, entries):
+    """
+    Atomically writes an iterable of PlaylistEntry, or of paths, as a playlist of the format of the extension of
+    playlist_path. Entries are renumbered in order. An existing playlist keeps its permissions.
+    """
+    ext = os.path.splitext(playlist_path)[1].lower()
+    if ext not in PLAYLIST_EXTENSIONS:
+        raise ValueError('Unsupported playlist extension {0}'.format(ext))
+
+    entries = list(_as_entries(entries))
+    lines = _pls_lines(entries) if ext == '.pls' else _m3u_lines(entries)
+
+    directory = os.path.dirname(os.path.abspath(playlist_path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(playlist_path) + '.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', errors=ERRORS) as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if os.path.exists(playlist_path):
+            os.chmod(tmp_path, os.stat(playlist_path).st_mode & 0o7777)
+        else:
+            # mkstemp creates the file as 0600, use the default permissions of a new file instead
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+
+        os.replace(tmp_path, playlist_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def benchmark(n_entries, repeat=3):
+    """ Parsing throughput, in entries/s, of synthetic playlists of n_entries per format """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        entries = [PlaylistEntry(i + 1, '/storage/Library/Sorted/Artist {0}/Album=Title {0}/{1:02d} Track.flac'.format(
+            i // 12, i % 12 + 1), 'Artist {0} - Track {1}'.format(i // 12, i % 12 + 1), 180 + i % 300)
+            for i in range(n_entries)]
+
+        for ext in PLAYLIST_EXTENSIONS:
+            playlist_path = os.path.join(directory, 'bench' + ext)
+            write_playlist(playlist_path, entries)
+
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                n = sum(1 for _ in read_playlist(playlist_path))
+                best = min(best, time.perf_counter() - start)
+            assert n == n_entries
+            results[ext] = n_entries / best
+
+    return results
+
+
+def main(playlist_path, n_benchmark_entries):
+    if n_benchmark_entries is not None:
+        for ext, rate in benchmark(n_benchmark_entries).items():
+            print('{0}: {1:.0f} entries/s'.format(ext, rate))
+        return
+
+    for e in read_playlist(playlist_path):
+        print('{0}\t{1}\t{2}\t{3}'.format(e.index, e.path, e.title or '', e.length if e.length is not None else ''))
+
+
+def cli(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Lists the entries of a PLS/M3U/M3U8 playlist, or benchmarks the playlist parser.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--playlist_path', nargs='?', help='Playlist path')
+    group.add_argument('--benchmark', nargs='?', type=int, const=100000, default=None, metavar='N_ENTRIES',
+                       help='Measure the parsing throughput on synthetic playlists of N_ENTRIES entries')
+    args = parser.parse_args(argv)
+
+    main(args.playlist_path, args.benchmark)
+
+
+if __name__ == "__main__":
+    cli()
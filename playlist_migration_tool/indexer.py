@@ -1,23 +1,64 @@
 import sqlite3
-from sqlite3 import Error
 from threading import Lock
+from itertools import islice
+from collections import Counter, defaultdict
 import os
 from fuzzywuzzy import fuzz
 
+
+# The OR of the release group and release ids is split into two probes, each one served by its composite index
+GET_TRACK_QUERY = \
+    "SELECT id, path, disc_idx, total_discs, recording_id, releasetrack_id, album_id FROM tracks " \
+    "WHERE releasegroup_id = ? AND track_idx = ? " \
+    "UNION " \
+    "SELECT id, path, disc_idx, total_discs, recording_id, releasetrack_id, album_id FROM tracks " \
+    "WHERE album_id = ? AND track_idx = ? " \
+    "ORDER BY id"
+
+UPSERT_QUERY = \
+    "INSERT INTO tracks(path, track_idx, releasegroup_id, album_id, disc_idx, total_discs, recording_id, " \
+    "releasetrack_id) VALUES(?, ?, ?, ?, ?, ?, ?, ?) " \
+    "ON CONFLICT(path) DO UPDATE SET track_idx = excluded.track_idx, " \
+    "releasegroup_id = excluded.releasegroup_id, album_id = excluded.album_id, " \
+    "disc_idx = excluded.disc_idx, total_discs = excluded.total_discs, " \
+    "recording_id = excluded.recording_id, releasetrack_id = excluded.releasetrack_id"
+
+# Columns added after the first version of the index, they are added to existing databases too
+EXTRA_COLUMNS = [('disc_idx', 'INTEGER'), ('total_discs', 'INTEGER'), ('recording_id', 'TEXT'),
+                 ('releasetrack_id', 'TEXT')]
+
+
 class TrackIndexer(object):
     def __init__(self, dbfile):
         self.db_handle = None
         self.lock = Lock()
+        self.stats = Counter()
 
         self.db_handle = sqlite3.connect(dbfile, check_same_thread=False)
 
-        try:
-            cur = self.db_handle.cursor()
-            cur.execute(
-                "CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, path TEXT,track_idx INTEGER(32),releasegroup_id TEXT,album_id TEXT)")
-            self.db_handle.commit()
-        except Error as e:
-            pass
+        # WAL journaling lets bulk ingestion commit large batches without an fsync per track
+        self.db_handle.execute('PRAGMA journal_mode=WAL')
+        self.db_handle.execute('PRAGMA synchronous=NORMAL')
+
+        cur = self.db_handle.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, path TEXT,track_idx INTEGER(32),releasegroup_id TEXT,album_id TEXT)")
+        columns = [r[1] for r in cur.execute("PRAGMA table_info(tracks)")]
+        for column, column_type in EXTRA_COLUMNS:
+            if column not in columns:
+                cur.execute("ALTER TABLE tracks ADD COLUMN {0} {1}".format(column, column_type))
+        # A unique index, rather than a table constraint, so that it is also added to existing databases. Tracks used to
+        # be added one by one, with a racy check for duplicate paths, the last indexed row of each path is kept.
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'tracks_path'")
+        if cur.fetchone() is None:
+            cur.execute("DELETE FROM tracks WHERE id NOT IN (SELECT MAX(id) FROM tracks GROUP BY path)")
+            cur.execute("CREATE UNIQUE INDEX tracks_path ON tracks(path)")
+        # Indexes of the lookups of get_track
+        cur.execute("CREATE INDEX IF NOT EXISTS tracks_album ON tracks(album_id, track_idx)")
+        cur.execute("CREATE INDEX IF NOT EXISTS tracks_releasegroup ON tracks(releasegroup_id, track_idx)")
+        # Albums whose tracks are already ingested, so that an interrupted ingestion resumes where it stopped
+        cur.execute("CREATE TABLE IF NOT EXISTS ingested_albums (path TEXT PRIMARY KEY)")
+        self.db_handle.commit()
 
     def __enter__(self):
         return self
@@ -26,59 +67,151 @@ class TrackIndexer(object):
         if self.db_handle is not None:
             self.db_handle.close()
         del self.db_handle
-        return True
 
-    def add_track(self, path, index, releasegroup_id, album_id):
-        # Check if album exists
-        exists = False
+    def add_tracks(self, track_infos, batch_size=10000):
+        """
+        Bulk ingestion of an iterable of TrackInfo. A track whose path is already indexed is updated. Tracks are
+        written with executemany, one transaction per batch. Returns the number of tracks ingested.
+        """
+        rows = (self._track_row(t) for t in track_infos)
 
+        total = 0
+        with self.lock:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if len(batch) == 0:
+                    break
+
+                with self.db_handle:
+                    self.db_handle.executemany(UPSERT_QUERY, batch)
+                total += len(batch)
+
+        return total
+
+    def ingest_albums(self, albums):
+        """
+        Writes the tracks of a batch of albums, given as (album path, TrackInfo list) pairs, and checkpoints the albums
+        as ingested in the same transaction. Returns the number of tracks written.
+        """
+        rows = [self._track_row(t) for _, track_infos in albums for t in track_infos]
+
+        with self.lock:
+            with self.db_handle:
+                self.db_handle.executemany(UPSERT_QUERY, rows)
+                self.db_handle.executemany("INSERT OR IGNORE INTO ingested_albums(path) VALUES(?)",
+                                           [(album_path,) for album_path, _ in albums])
+
+        return len(rows)
+
+    def is_ingested(self, album_path):
         cur = self.db_handle.cursor()
-        query = "SELECT path FROM tracks WHERE path = ?"
-        args = (path,)
-        cur.execute(query, args)
-        results = cur.fetchall()
-        for result in results:
-            if result[0] == path:
-                print('Track already exists on database')
-                exists = True
+        cur.execute("SELECT 1 FROM ingested_albums WHERE path = ?", (album_path,))
+        return cur.fetchone() is not None
 
-        results.clear()
-        del cur, query, args, results
+    def reset_progress(self):
+        with self.db_handle:
+            self.db_handle.execute("DELETE FROM ingested_albums")
 
-        if exists is True:
-            return
+    @staticmethod
+    def _track_row(t):
+        return (t.path, t.track_idx, t.group_id, t.album_id, t.disc_idx, t.total_discs, t.recording_id,
+                t.releasetrack_id)
 
-        # We need to serialize access to the db to avoid corruption
-        self.lock.acquire()
+    def get_track(self, index, releasegroup_id, album_id, filepath, disc_idx=None, recording_id='',
+                  releasetrack_id=''):
+        """
+        Resolves a track of a playlist to a path of the index. Candidates share the track index and the release
+        group or release id, and are narrowed down by exact keys: release track id, disc, recording id and release
+        id. Fuzzy scoring of the filenames is only the last resort.
+        """
+        self.stats['lookups'] += 1
 
         cur = self.db_handle.cursor()
-        query = "INSERT INTO tracks(path, track_idx, releasegroup_id, album_id) VALUES(?, ?, ?, ?)"
-        args = (path, index, releasegroup_id, album_id)
-        cur.execute(query, args)
-        self.db_handle.commit()
-        del cur, query, args
+        # Empty ids would match every track that misses the same tag
+        args = (releasegroup_id or None, index, album_id or None, index)
+        cur.execute(GET_TRACK_QUERY, args)
 
-        self.lock.release()
-        #print("Track added to database")
+        return self._choose(cur.fetchall(), filepath, disc_idx, recording_id, releasetrack_id, album_id)
+
+    def resolve_tracks(self, track_infos):
+        """
+        Batch version of get_track, for a whole collection of TrackInfo. The keys of all indexed tracks are loaded at
+        once into in-memory hash indexes and every track is resolved with a hash probe instead of a query.
+        Returns the resolved paths (None when not found), in the order of track_infos.
+        """
+        by_releasegroup = defaultdict(list)
+        by_album = defaultdict(list)
 
-    def get_track(self, index, releasegroup_id, album_id, filepath):
         cur = self.db_handle.cursor()
-        query = "SELECT path FROM tracks WHERE track_idx = ? AND (releasegroup_id = ? OR album_id = ?)"
-        args = (index, releasegroup_id, album_id)
-        cur.execute(query, args)
-        results = cur.fetchall()
+        cur.execute("SELECT id, path, disc_idx, total_discs, recording_id, releasetrack_id, album_id, "
+                    "releasegroup_id, track_idx FROM tracks ORDER BY id")
+        for row in cur:
+            candidate = row[:7]
+            if row[7]:
+                by_releasegroup[(row[7], row[8])].append(candidate)
+            if row[6]:
+                by_album[(row[6], row[8])].append(candidate)
+
+        resolved = []
+        for t in track_infos:
+            self.stats['lookups'] += 1
+
+            candidates = by_releasegroup.get((t.group_id, t.track_idx), []) + by_album.get((t.album_id, t.track_idx), [])
+            # Same candidates and order as the UNION of get_track
+            results = sorted({c[0]: c for c in candidates}.values())
+
+            resolved.append(self._choose(results, t.path, t.disc_idx, t.recording_id, t.releasetrack_id, t.album_id))
 
+        return resolved
+
+    def _choose(self, results, filepath, disc_idx, recording_id, releasetrack_id, album_id):
         if len(results) == 1:
-            return results[0][0]
+            return results[0][1]
         elif len(results) == 0:
+            self.stats['not_found'] += 1
             return None
-        else:
-            # Two disks case
-            query_filename = os.path.basename(filepath)
-            scores = []
-            for r in results:
-                filename = os.path.basename(r[0])
-                scores.append(fuzz.ratio(filename.lower(), query_filename.lower()))
-
-            ret = results[scores.index(max(scores))][0]
-            return ret
\ No newline at end of file
+
+        self.stats['ambiguous'] += 1
+
+        # Each key is used only when it is known and it keeps at least one candidate
+        keys = [('releasetrack_id', 5, releasetrack_id), ('disc', 2, disc_idx), ('recording_id', 4, recording_id),
+                ('album_id', 6, album_id)]
+        for name, column, value in keys:
+            if value is None or value == '':
+                continue
+
+            matching = [r for r in results if r[column] == value]
+            if len(matching) > 0:
+                results = matching
+            if len(results) == 1:
+                self.stats['resolved_by_' + name] += 1
+                return results[0][1]
+
+        # Two disks case, without the tags to tell them apart
+        self.stats['fuzzy_fallback'] += 1
+        query_filename = os.path.basename(filepath)
+        scores = []
+        for r in results:
+            filename = os.path.basename(r[1])
+            scores.append(fuzz.ratio(filename.lower(), query_filename.lower()))
+
+        ret = results[scores.index(max(scores))][1]
+        return ret
+
+    def report_stats(self):
+        lookups = max(1, self.stats['lookups'])
+        print('Track lookups: {0}, not found: {1}'.format(self.stats['lookups'], self.stats['not_found']))
+        print('Ambiguous: {0} ({1:.2%})'.format(self.stats['ambiguous'], self.stats['ambiguous'] / lookups))
+        for name in ['releasetrack_id', 'disc', 'recording_id', 'album_id']:
+            print('\tresolved by {0}: {1}'.format(name, self.stats['resolved_by_' + name]))
+        print('\tfuzzy fallback: {0} ({1:.2%})'.format(self.stats['fuzzy_fallback'],
+                                                      self.stats['fuzzy_fallback'] / lookups))
+
+    def explain(self):
+        """ Returns the query plan of get_track and whether every probe of it is served by an index """
+        cur = self.db_handle.cursor()
+        cur.execute('EXPLAIN QUERY PLAN ' + GET_TRACK_QUERY, (None, 0, None, 0))
+        plan = [r[3] for r in cur.fetchall()]
+
+        scans = [p for p in plan if p.startswith('SCAN') and 'tracks' in p]
+        return plan, len(scans) == 0
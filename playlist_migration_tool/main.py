@@ -1,30 +1,43 @@
 import os
+import sys
 from pathlib import Path
 import argparse
 from collections import namedtuple, defaultdict
-from mutagen.mp3 import MP3
-from mutagen.oggvorbis import OggVorbis
-from mutagen.id3 import ID3, TENC
-from mutagen.flac import FLAC
-from mutagen import MutagenError
 import pickle
 from tqdm import tqdm
-import re
 import errno
+import time
+from itertools import islice
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from indexer import TrackIndexer
 
+# Shared modules live in the root of the repository
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metadata_cache import MetadataCache
+from tag_reader import read_tags, is_supported
+from library_walker import LibraryWalker, AUDIO_EXTENSIONS
+from playlist_io import PLAYLIST_EXTENSIONS, playlist_paths, write_playlist
 
-# https://stackoverflow.com/a/16090640
-def natural_sort_key(s, _nsre=re.compile('([0-9]+)')):
-    return [int(text) if text.isdigit() else text.lower()
-            for text in _nsre.split(s)]
 
+# Disc and MusicBrainz track fields were added later, entries of older pickles get the defaults
+TrackInfo = namedtuple('TrackInfo', ['path', 'track_idx', 'album_id', 'group_id',
+                                     'disc_idx', 'total_discs', 'recording_id', 'releasetrack_id'],
+                       defaults=(None, None, '', ''))
 
-TrackInfo = namedtuple('TrackInfo', ['path', 'track_idx', 'album_id', 'group_id'])
+TRACKS_DB_PATH = '/home/studiouser/track_info/tracks.db'
+LIBRARY_PATH = '/storage/Library/Sorted'
+METADATA_CACHE_PATH = '/home/studiouser/track_info/metadata_cache.db'
 
 
 def convert_metadata_entry(t: TrackInfo):
+    # Entries read through tag_reader are already normalized, only entries of older pickles keep raw tag values
+    if t.track_idx is None:
+        return None
+    elif isinstance(t.track_idx, int):
+        return t
+
     _, ext = os.path.splitext(t.path)
 
     try:
@@ -45,45 +58,57 @@ def convert_metadata_entry(t: TrackInfo):
     return TrackInfo(t.path, track_idx, album_id, group_id)
 
 
-def get_track_info(track_path):
-    def get_info(meta, idx_key, release_key, release_group_key):
-        try:
-            track_idx = meta[idx_key]
-        except KeyError:
-            track_idx = ''
+def get_track_info(track_path, cache=None):
+    tags = cache.get(track_path) if cache is not None else read_tags(track_path)
+    return TrackInfo(track_path, tags.track_number, tags.album_id, tags.releasegroup_id,
+                     tags.disc_number, tags.total_discs, tags.recording_id, tags.releasetrack_id)
 
-        try:
-            album_id = meta[release_key]
-        except KeyError:
-            album_id = ''
 
-        try:
-            group_id = meta[release_group_key]
-        except KeyError:
-            group_id = ''
-
-        return track_idx, album_id, group_id
-
-    filename, ext = os.path.splitext(track_path)
-    if ext == '.flac':
-        meta = FLAC(track_path)
-        track_idx, album_id, group_id = \
-            get_info(meta, 'tracknumber', 'musicbrainz_albumid', 'musicbrainz_releasegroupid')
-        track_info = TrackInfo(track_path, track_idx, album_id, group_id)
-    elif ext == '.mp3':
-        meta = ID3(track_path)
-        track_idx, album_id, group_id = \
-            get_info(meta, 'TRCK', 'TXXX:MusicBrainz Album Id', 'TXXX:MusicBrainz Release Group Id')
-        track_info = TrackInfo(track_path, track_idx, album_id, group_id)
-    elif ext == '.ogg':
-        meta = OggVorbis(track_path)
-        track_idx, album_id, group_id = \
-            get_info(meta, 'tracknumber', 'musicbrainz_albumid', 'musicbrainz_releasegroupid')
-        track_info = TrackInfo(track_path, track_idx, album_id, group_id)
-    else:
-        assert False
+def classify_track(track_path):
+    """ Returns the PlaylistInfo category of a playlist entry, with the value stored under it """
+    if not os.path.exists(track_path):
+        return 'not_found', track_path
+    if not is_supported(track_path):
+        return 'wrong_ext', track_path
+
+    try:
+        track_info = get_track_info(track_path)
+    except Exception:
+        return 'problematic', track_path
+
+    if track_info.track_idx is None or (track_info.album_id == '' and track_info.group_id == ''):
+        return 'untagged', track_info
+    return 'found', track_info
+
+
+class TrackLookup(object):
+    """
+    Memoizes classify_track for a run over many playlists: the same track appears in dozens of zone playlists, but
+    its existence and tags are checked once. Misses are classified in a bounded thread pool, since the work is bound
+    by the I/O of the storage rather than by the CPU.
+    """
+    def __init__(self, workers=16):
+        self._results = {}
+        self._pool = ThreadPoolExecutor(workers)
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._pool.shutdown()
+
+    def classify(self, track_paths):
+        """ Returns the classify_track result of each path, in order """
+        misses = [p for p in dict.fromkeys(track_paths) if p not in self._results]
+        self.misses += len(misses)
+        self.hits += len(track_paths) - len(misses)
 
-    return track_info
+        for track_path, result in zip(misses, self._pool.map(classify_track, misses)):
+            self._results[track_path] = result
+
+        return [self._results[p] for p in track_paths]
 
 
 class PlaylistInfo:
@@ -95,96 +120,56 @@ class PlaylistInfo:
         self._not_found = []
         self._untagged = []
 
-    def add(self, track_path):
-        def get_info(meta, idx_key, release_key, release_group_key):
-            try:
-                track_idx = meta[idx_key]
-            except KeyError:
-                track_idx = ''
-
-            try:
-                album_id = meta[release_key]
-            except KeyError:
-                album_id = ''
-
-            try:
-                group_id = meta[release_group_key]
-            except KeyError:
-                group_id = ''
-
-            return track_idx, album_id, group_id
-
-        if os.path.exists(track_path):
-            filename, ext = os.path.splitext(track_path)
-            try:
-
-                if ext == '.flac':
-                    meta = FLAC(track_path)
-                    track_idx, album_id, group_id = \
-                        get_info(meta, 'tracknumber', 'musicbrainz_albumid', 'musicbrainz_releasegroupid')
-                elif ext == '.mp3':
-                    meta = ID3(track_path)
-                    track_idx, album_id, group_id = \
-                        get_info(meta, 'TRCK', 'TXXX:MusicBrainz Album Id', 'TXXX:MusicBrainz Release Group Id')
-                elif ext == '.ogg':
-                    meta = OggVorbis(track_path)
-                    track_idx, album_id, group_id = \
-                        get_info(meta, 'tracknumber', 'musicbrainz_albumid', 'musicbrainz_releasegroupid')
-                else:
-                    self._wrong_ext.append(track_path)
-                    return
-
-                track_info = TrackInfo(track_path, track_idx, album_id, group_id)
-                if track_idx == '' or (album_id == '' and group_id == ''):
-                    self._untagged.append(track_info)
-                else:
-                    self._found.append(track_info)
-
-            except Exception:
-                self._problematic.append(track_path)
-        else:
-            self._not_found.append(track_path)
+    def add(self, track_path, result=None):
+        """ result is the classify_track result of track_path, if it is already known """
+        category, value = result if result is not None else classify_track(track_path)
+        getattr(self, '_' + category).append(value)
 
 
-def get_pls_info(pls_path):
+def get_pls_info(pls_path, lookup=None):
     print('Parsing', pls_path)
     pls_info = PlaylistInfo(pls_path)
-    with open(pls_path, encoding='utf-8') as f:
-        lines = f.readlines()
-        for line in lines:
-            if line.startswith('File'):
-                line = line.strip('\n')
-                tokens = line.split('=')
-                pls_info.add(tokens[1])
+    track_paths = list(playlist_paths(pls_path))
+
+    if lookup is None:
+        with TrackLookup() as lookup:
+            results = lookup.classify(track_paths)
+    else:
+        results = lookup.classify(track_paths)
+
+    for track_path, result in zip(track_paths, results):
+        pls_info.add(track_path, result)
 
     return pls_info
 
 
-def parse_playlists(playlists_path, accepted_extensions):
+def parse_playlists(playlists_path, accepted_extensions, workers=16):
     playlist_infos = list()
     total_playlists = 0
-    # Parse playlists
-    for root, dirs, files in os.walk(playlists_path):
-        if len(files) == 0:
-            continue
-        else:
-            for f in files:
-                file_path = os.path.join(root, f)
-                filename, ext = os.path.splitext(file_path)
+    # Parse playlists, sharing the lookups of their tracks
+    with TrackLookup(workers) as lookup:
+        for root, dirs, files in os.walk(playlists_path):
+            if len(files) == 0:
+                continue
+            else:
+                for f in files:
+                    file_path = os.path.join(root, f)
+                    filename, ext = os.path.splitext(file_path)
 
-                if ext in accepted_extensions:
-                    # set union
-                    total_playlists += 1
-                    playlist_infos.append(get_pls_info(file_path))
+                    if ext in accepted_extensions:
+                        # set union
+                        total_playlists += 1
+                        playlist_infos.append(get_pls_info(file_path, lookup))
 
-    #print('Parsed {0} playlists in total.'.format(total_playlists))
+    print('Parsed {0} playlists, {1} unique tracks read for {2} entries'.format(
+        total_playlists, lookup.misses, lookup.misses + lookup.hits))
     return playlist_infos
 
 
-def main(playlists_path):
-    accepted_extensions = ['.pls']
+def main(playlists_path, workers=16):
+    accepted_extensions = PLAYLIST_EXTENSIONS
 
-    playlist_infos = parse_playlists(playlists_path, accepted_extensions)
+    playlist_infos = parse_playlists(playlists_path, accepted_extensions, workers)
     pickle.dump(playlist_infos, open('/home/studiouser/track_info/plsinfos-powonly.pkl', 'wb'))
     return
     cases = {'alexis': [], 'makris': [], 'rest': []}
@@ -202,25 +187,80 @@ def main(playlists_path):
 
 
 
-def track_gen(path):
-    for root, dirs, files in os.walk(path):
-        for filename in files:
-            ext = os.path.splitext(filename)[1]
-            if ext in [".mp3", ".ogg", ".flac"]:
-                yield os.path.join(root, filename)
+# Metadata cache of a parse_new_library worker process
+_worker_cache = None
+
 
+def _open_worker_cache(cache_path):
+    global _worker_cache
+    _worker_cache = MetadataCache(cache_path)
 
-def parse_new_library():
-    path = '/storage/Library/Sorted'
-    all_track_info = []
-    for i, track_path in enumerate(tqdm(track_gen(path), total=118643)):
-        all_track_info.append(get_track_info(track_path))
 
-        if i > 0 and i % 10000 == 0:
-            pickle.dump(all_track_info, open(f'/home/studiouser/track_info/all_track_info_{i}.pkl', 'wb'))
-            all_track_info.clear()
+def read_album(album):
+    """ Worker of parse_new_library: reads and normalizes the tracks of an album """
+    album_path, filenames = album
 
-    pickle.dump(all_track_info, open(f'/home/studiouser/track_info/all_track_info_last.pkl', 'wb'))
+    track_infos = []
+    errors = []
+    for filename in filenames:
+        track_path = os.path.join(album_path, filename)
+        try:
+            track_info = convert_metadata_entry(get_track_info(track_path, _worker_cache))
+        except Exception:
+            errors.append(track_path)
+            continue
+
+        if track_info:
+            track_infos.append(track_info)
+
+    _worker_cache.commit()
+    return album_path, track_infos, errors
+
+
+def parse_new_library(library_path=LIBRARY_PATH, cache_path=METADATA_CACHE_PATH, workers=8, batch_albums=256,
+                      restart=False):
+    """
+    Walks the new library, reads the tags of its albums in a process pool and writes them straight into the track
+    index. Albums are checkpointed in the index together with their tracks, so an interrupted run resumes where it
+    stopped. An album with tracks which could not be read is not checkpointed, so that they are read again on the next
+    run. Only a batch of albums is in flight at any time, which bounds the memory regardless of library size.
+    """
+    indexer = TrackIndexer(TRACKS_DB_PATH)
+    if restart:
+        indexer.reset_progress()
+
+    walker = LibraryWalker(library_path)
+    pending_albums = ((album.path, [f for f in album.files if os.path.splitext(f)[1] in AUDIO_EXTENSIONS])
+                      for album in walker if len(album.audio_files) > 0 and not indexer.is_ingested(album.path))
+
+    total = 0
+    start = time.time()
+    with Pool(workers, initializer=_open_worker_cache,
+              initargs=(cache_path,)) as pool, tqdm(unit='dirs') as pbar:
+        while True:
+            batch = list(islice(pending_albums, batch_albums))
+            if len(batch) == 0:
+                break
+
+            albums = []
+            incomplete_tracks = []
+            for album_path, track_infos, errors in pool.imap(read_album, batch):
+                if len(errors) == 0:
+                    albums.append((album_path, track_infos))
+                else:
+                    # Not checkpointed, so that the tracks which could not be read are tried again on the next run
+                    incomplete_tracks.extend(track_infos)
+                for track_path in errors:
+                    tqdm.write(f'Could not read {track_path}')
+
+            total += indexer.ingest_albums(albums) + indexer.add_tracks(incomplete_tracks)
+
+            # Progress is measured in walked directories, the only total known before the walk ends
+            pbar.total = walker.estimated_total_dirs()
+            pbar.update(walker.scanned_dirs - pbar.n)
+
+    elapsed = time.time() - start
+    print(f'Ingested {total} tracks in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} tracks/s)')
 
 
 def squeeze(l):
@@ -232,25 +272,6 @@ def squeeze(l):
         return ''
 
 
-def process_new_library():
-    data_path = '/home/studiouser/track_info/new_library'
-
-    indexer = TrackIndexer('/home/studiouser/track_info/tracks.db')
-    all_track_info = []
-    for p in sorted(os.listdir(data_path), key=natural_sort_key):
-        infos_path = os.path.join(data_path, p)
-        with open(infos_path, 'rb') as f:
-            data = pickle.load(f)
-
-        print(f'Processing {p}')
-        # fix mp3/vorbis data
-        for t in data:
-            track_info = convert_metadata_entry(t)
-            if track_info:
-                all_track_info.append(track_info)
-                indexer.add_track(track_info.path, track_info.track_idx, track_info.group_id, track_info.album_id)
-
-
 # def fix_playlist_infos():
 #     plsifno = pickle.load(open('/home/studiouser/track_info/plsinfos.pkl', 'rb'))
 #     for playlist in plsifno:
@@ -269,12 +290,13 @@ def process_new_library():
 
 def associate():
     plsifno = pickle.load(open('/home/studiouser/track_info/plsinfos-powonly.pkl', 'rb'))
-    indexer = TrackIndexer('/home/studiouser/track_info/tracks.db')
+    indexer = TrackIndexer(TRACKS_DB_PATH)
 
-    not_found = 0
     files_per_playlist = {}
     lost_and_found = []
 
+    # Collect the tracks of all playlists, in order to resolve them in a single pass
+    entries = []
     for playlist in plsifno:
         playlist_name = os.path.basename(playlist._name)
         playlist_folder = os.path.basename(Path(playlist._name).parent)
@@ -282,35 +304,31 @@ def associate():
             continue
 
         playlist_key = f'{playlist_folder}/{playlist_name}'
-
-        print(f'Processing {playlist_key}')
         files_per_playlist[playlist_key] = []
 
-        for track in tqdm(playlist._found):
-            track_info = convert_metadata_entry(track)
-            try:
-                ret = indexer.get_track(track_info.track_idx, track_info.group_id, track_info.album_id, track_info.path)
-                if ret:
-                    files_per_playlist[playlist_key].append(ret)
-                else:
-                    lost_and_found.append((playlist_key, track.path))
-            except Exception:
-                lost_and_found.append((playlist_key, track.path))
+        for track in playlist._found:
+            entries.append((playlist_key, track.path, convert_metadata_entry(track)))
+
+    track_infos = [track_info for _, _, track_info in entries if track_info is not None]
+    print(f'Resolving {len(track_infos)} tracks of {len(files_per_playlist)} playlists')
+    start = time.time()
+    resolved = iter(indexer.resolve_tracks(track_infos))
+    print(f'Resolved in {time.time() - start:.1f}s')
+
+    for playlist_key, path, track_info in entries:
+        ret = next(resolved) if track_info is not None else None
+        if ret:
+            files_per_playlist[playlist_key].append(ret)
+        else:
+            lost_and_found.append((playlist_key, path))
 
+    indexer.report_stats()
 
     pickle.dump(files_per_playlist, open('/home/studiouser/track_info/new_playlists-powonly.pkl', 'wb'))
     pickle.dump(lost_and_found, open('/home/studiouser/track_info/lost_and_found-powonly.pkl', 'wb'))
 
 
 def pls_writer(root_directory, playlist_tag, filepaths):
-    lines = [
-        '[playlist]\n',
-        f'NumberOfEntries={len(filepaths)}\n'
-    ]
-
-    for i, p in enumerate(filepaths):
-        lines.append(f'File{i+1}={p}\n')
-
     playlist_filepath = os.path.join(root_directory, playlist_tag)
 
     if not os.path.exists(os.path.dirname(playlist_filepath)):
@@ -320,8 +338,7 @@ def pls_writer(root_directory, playlist_tag, filepaths):
             if exc.errno != errno.EEXIST:
                 raise
 
-    with open(playlist_filepath, 'w') as f:
-        f.writelines(lines)
+    write_playlist(playlist_filepath, filepaths)
 
 
 def export_playlists():
@@ -393,18 +410,64 @@ def report_missing(with_leaks=False):
             print(f'\t{e}')
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description='Migrate playlists into new library.')
-    parser.add_argument('--playlists-path', nargs='?', required=True, help='Zones path')
-    args = parser.parse_args()
+def explain():
+    plan, uses_indexes = TrackIndexer(TRACKS_DB_PATH).explain()
+    print('\n'.join(plan))
+    print('Track lookups use the indexes.' if uses_indexes else 'Track lookups scan the whole table!')
+
+
+# The migration steps, in the order they are meant to run
+MIGRATION_STEPS = ['playlists', 'parse-library', 'associate', 'export', 'report']
+
 
+def run_step(step, playlists_path=None, workers=8, restart=False, threads=16, library_path=LIBRARY_PATH,
+             cache_path=METADATA_CACHE_PATH):
     # 1.
-    #main(args.playlists_path)
-    #fix_playlist_infos()
+    if step == 'playlists':
+        main(playlists_path, threads)
+        #fix_playlist_infos()
     # 2.
-    #parse_new_library()
-    #process_new_library()
-    #associate()
-    #export_playlists()
-    report_missing()
+    elif step == 'parse-library':
+        parse_new_library(library_path, cache_path, workers, restart=restart)
+    elif step == 'associate':
+        associate()
+    elif step == 'export':
+        export_playlists()
+    elif step == 'report':
+        report_missing()
+    else:
+        raise ValueError('Unknown migration step {0}'.format(step))
+
+
+def cli(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Migrate playlists into new library.')
+    parser.add_argument('--playlists-path', nargs='?', help='Zones path, required by the playlists step')
+    parser.add_argument('--library-path', nargs='?', default=LIBRARY_PATH,
+                        help='New library, parsed by the parse-library step')
+    parser.add_argument('--cache-path', nargs='?', default=METADATA_CACHE_PATH,
+                        help='Metadata cache file of the parse-library step')
+    parser.add_argument('--step', nargs='?', default='report', choices=MIGRATION_STEPS, help='Migration step to run')
+    parser.add_argument('--workers', nargs='?', type=int, default=8,
+                        help='Number of processes reading tags in the parse-library step')
+    parser.add_argument('--threads', nargs='?', type=int, default=16,
+                        help='Number of threads reading the tags of the playlist tracks in the playlists step')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ingest the library from scratch instead of resuming the previous parse-library run')
+    parser.add_argument('--explain', action='store_true',
+                        help='Print the query plan of the track lookups, to confirm that they use the indexes')
+    args = parser.parse_args(argv)
+
+    if args.explain:
+        explain()
+        return
+
+    if args.step == 'playlists' and args.playlists_path is None:
+        parser.error('--playlists-path is required by the playlists step')
+
+    run_step(args.step, args.playlists_path, args.workers, args.restart, args.threads, args.library_path,
+             args.cache_path)
+
+
+if __name__ == "__main__":
+    cli()
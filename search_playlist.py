@@ -1,34 +1,197 @@
-import sys
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Finds the playlists, and their entries, which contain a search term.
+
+The entries of all the playlists are kept in a persistent SQLite full text index, with a trigram index for substring
+terms and a word index for prefix and short terms. Only the playlists added or modified (by mtime and size) since the last
+search are reindexed, so a search does not reread the zones directory:
+
+    python search_playlist.py --zones_dir /storage/Repository/Zones2.0 --search_term dub reggae*
+
+Every term must match the path or the title of an entry. Terms of at least 3 characters match anywhere (substring),
+terms ending with '*' match the beginning of a word (prefix) and shorter terms match whole words only. Matching is
+case insensitive.
+"""
+
 import os
-from subprocess import call
+import re
+import time
+import sqlite3
 import argparse
+from playlist_io import find_playlists, read_playlist
+from utils import prefix_range
+
+
+class PlaylistIndex(object):
+    def __init__(self, dbfile):
+        self.db_handle = sqlite3.connect(dbfile)
+        self.db_handle.execute('PRAGMA journal_mode=WAL')
+        self.db_handle.execute('PRAGMA synchronous=NORMAL')
+
+        self.db_handle.execute(
+            "CREATE TABLE IF NOT EXISTS playlists (id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime_ns INTEGER, "
+            "size INTEGER)")
+        self.db_handle.execute(
+            "CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, playlist_id INTEGER, idx INTEGER, "
+            "path TEXT, title TEXT)")
+        self.db_handle.execute("CREATE INDEX IF NOT EXISTS entries_playlist ON entries(playlist_id)")
+        # Both full text indexes take their content from the entries table
+        self.db_handle.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS entries_trigrams USING fts5(path, title, content='entries', "
+            "content_rowid='id', tokenize='trigram')")
+        self.db_handle.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS entries_words USING fts5(path, title, content='entries', "
+            "content_rowid='id', prefix='2 3')")
+        self.db_handle.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.db_handle is not None:
+            self.db_handle.close()
+            self.db_handle = None
+
+    def refresh(self, zones_dir):
+        """ Reindexes the playlists of zones_dir which are new or modified and drops the deleted ones """
+        zones_dir = os.path.abspath(zones_dir)
+
+        on_disk = {}
+        for playlist_path in find_playlists(zones_dir):
+            st = os.stat(playlist_path)
+            on_disk[playlist_path] = (st.st_mtime_ns, st.st_size)
+
+        # Playlists under zones_dir only, the index may be shared by several zones directories
+        indexed = {path: (playlist_id, (mtime_ns, size)) for playlist_id, path, mtime_ns, size in self.db_handle.execute(
+            "SELECT id, path, mtime_ns, size FROM playlists WHERE path >= ? AND path < ?",
+            prefix_range(zones_dir))}
+
+        stale = [playlist_id for path, (playlist_id, stat) in indexed.items() if on_disk.get(path) != stat]
+        updated = [path for path, stat in on_disk.items() if path not in indexed or indexed[path][1] != stat]
+
+        with self.db_handle:
+            for playlist_id in stale:
+                self._remove(playlist_id)
+            for playlist_path in updated:
+                self._add(playlist_path, *on_disk[playlist_path])
+
+        return len(updated), len(stale)
+
+    def _remove(self, playlist_id):
+        # External content indexes are updated by deleting the old values, which must be read before the rows go
+        for fts in ['entries_trigrams', 'entries_words']:
+            self.db_handle.execute(
+                "INSERT INTO {0}({0}, rowid, path, title) SELECT 'delete', id, path, title FROM entries "
+                "WHERE playlist_id = ?".format(fts), (playlist_id,))
+        self.db_handle.execute("DELETE FROM entries WHERE playlist_id = ?", (playlist_id,))
+        self.db_handle.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
 
+    def _add(self, playlist_path, mtime_ns, size):
+        cur = self.db_handle.execute("INSERT INTO playlists(path, mtime_ns, size) VALUES(?, ?, ?)",
+                                     (playlist_path, mtime_ns, size))
+        playlist_id = cur.lastrowid
 
-def main(zones_dir, search_term):
-    # list all directories inside zones_root_dir
-    for (dir_names) in os.walk(zones_dir):
+        self.db_handle.executemany(
+            "INSERT INTO entries(playlist_id, idx, path, title) VALUES(?, ?, ?, ?)",
+            ((playlist_id, e.index, _text(e.path), _text(e.title)) for e in read_playlist(playlist_path)))
 
-        # keep only 1st leaf dirs
-        zone_path = dir_names[0]
-        zone_name = os.path.basename(dir_names[0])
+        for fts in ['entries_trigrams', 'entries_words']:
+            self.db_handle.execute(
+                "INSERT INTO {0}(rowid, path, title) SELECT id, path, title FROM entries "
+                "WHERE playlist_id = ?".format(fts), (playlist_id,))
 
-        for zone_file in os.listdir(zone_path):
-            if (os.path.isdir(zone_path + "/" + zone_file)):
+    def search(self, terms):
+        """ Returns the (playlist path, entry index, entry path) of the entries which match all the terms """
+        # Prefix terms are answered by the word index. When there are substring terms too, the prefix terms of at
+        # least 3 characters join them in a single trigram query, so that FTS5 intersects the posting lists itself,
+        # and are checked for a word start afterwards.
+        has_substrings = any(len(t) >= 3 and not t.endswith('*') for t in terms)
+        substrings = []
+        words = []
+        prefixes = []
+        for term in terms:
+            is_prefix = term.endswith('*')
+            term = term.rstrip('*')
+            if len(term) == 0:
                 continue
-            with open(zone_path + "/" + zone_file) as plsFile:
-                song_entry = plsFile.readline()
-                while song_entry:
-                    if search_term in song_entry:
-                        print(zone_path + "/" + zone_file)
-                        break
-                    song_entry = plsFile.readline()
+            elif len(term) >= 3 and (not is_prefix or has_substrings):
+                substrings.append(_quote(term))
+                if is_prefix:
+                    prefixes.append(re.compile(r'(?<![^\W_])' + re.escape(term), re.IGNORECASE))
+            else:
+                words.append(_quote(term) + ('*' if is_prefix else ''))
 
+        selects = []
+        args = []
+        if len(substrings) > 0:
+            selects.append("SELECT rowid FROM entries_trigrams WHERE entries_trigrams MATCH ?")
+            args.append(' AND '.join(substrings))
+        if len(words) > 0:
+            selects.append("SELECT rowid FROM entries_words WHERE entries_words MATCH ?")
+            args.append(' AND '.join(words))
+        if len(selects) == 0:
+            return []
 
-if __name__ == "__main__":
+        rows = self.db_handle.execute(
+            "SELECT p.path, e.idx, e.path, e.title FROM entries e JOIN playlists p ON p.id = e.playlist_id "
+            "WHERE e.id IN ({0}) ORDER BY p.path, e.idx".format(' INTERSECT '.join(selects)), args)
+
+        return [(playlist_path, entry_index, entry_path) for playlist_path, entry_index, entry_path, title in rows
+                if all(p.search(entry_path) or (title is not None and p.search(title)) for p in prefixes)]
+
+
+def _quote(term):
+    # A quoted FTS5 string, so that the term is never parsed as query syntax
+    return '"{0}"'.format(term.replace('"', '""'))
+
+
+def _text(value):
+    # Undecodable bytes of a playlist are kept as surrogates, which SQLite cannot store
+    if value is None:
+        return None
+    return value.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
+
+
+def main(zones_dir, search_terms, index_path):
+    index_dir = os.path.dirname(index_path)
+    if index_dir != '' and not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    with PlaylistIndex(index_path) as index:
+        start = time.perf_counter()
+        updated, removed = index.refresh(zones_dir)
+        refreshed = time.perf_counter()
+        matches = index.search(search_terms)
+        searched = time.perf_counter()
+
+    current_playlist = None
+    for playlist_path, entry_index, entry_path in matches:
+        if playlist_path != current_playlist:
+            print(playlist_path)
+            current_playlist = playlist_path
+        print('\t{0}: {1}'.format(entry_index, entry_path))
+
+    print('{0} entries in {1} playlists. Refresh: {2} reindexed, {3} dropped in {4:.1f} ms, search: {5:.1f} ms'.format(
+        len(matches), len(set(m[0] for m in matches)), updated, removed, (refreshed - start) * 1000,
+        (searched - refreshed) * 1000))
+
+
+def cli(argv=None, prog=None):
     parser = argparse.ArgumentParser(
-        description='Report albums that are not represented in any playlist.')
-    parser.add_argument('--zones_dir', nargs='?', required=True, help='A directory containing Zone folders. Each folder may contain multiple PLS playlist files')
-    parser.add_argument('--search_term', nargs='?', required=True, help='Search term')
-    args = parser.parse_args()
+        prog=prog, description='Find the playlists, and their entries, which contain all the search terms.')
+    parser.add_argument('--zones_dir', nargs='?', required=True, help='A directory containing Zone folders. Each folder may contain multiple PLS/M3U playlist files')
+    parser.add_argument('--search_term', nargs='+', required=True,
+                        help='Search terms. A term ending with * matches the beginning of a word')
+    parser.add_argument('--index_path', nargs='?', default=os.path.expanduser('~/.cache/ark/playlist_index.db'),
+                        help='Persistent index of the playlist entries')
+    args = parser.parse_args(argv)
+
+    main(args.zones_dir, args.search_term, args.index_path)
 
-    main(args.zones_dir, args.search_term)
+
+if __name__ == "__main__":
+    cli()
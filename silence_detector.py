@@ -1,133 +1,531 @@
 #!/usr/bin/env python3
+"""
+Detects silence on one or more streams and runs an action, e.g. restarts the scheduler, when a stream stays silent.
+
+All streams are supervised concurrently by a single asyncio event loop, which waits on the ffmpeg pipes and timers, so
+the process uses no CPU between checks. A stream is either recorded and analyzed every check_interval seconds (file
+mode) or decoded continuously (stream mode). Each stream has its own threshold, action and backoff, and errors of one
+stream (e.g. the server is unreachable) are logged and retried with an exponential backoff without affecting the
+others.
+
+The streams are read over HTTP by the event loop, which measures the connect and first byte times. These, the levels,
+the detection latencies and the results of the actions are published in the Prometheus text format at
+http://metrics_host:metrics_port/metrics when --metrics_port is given.
+
+The latest aircheck_minutes of each stream are kept in memory, as received (see air_check). A silence, a restart or a
+dropout saves an incident clip from clip_before seconds before the event to clip_after seconds after it in
+incident_path, without re-encoding.
+
+The streams are given on the command line (a single stream) or in an INI file with one section per stream, whose keys
+are the options of the command line, e.g.
+
+    [DEFAULT]
+    action = systemctl --user restart audio-scheduler
+
+    [uoc_128]
+    stream_url = http://rs.radio.uoc.gr:8000/uoc_128.mp3
+    mode = stream
+    threshold_db = -55
+"""
+import asyncio
 import configparser
 import datetime
-import errno
 import logging
 import logging.handlers
 import os
+import random
 import re
-import traceback
+import shlex
+import signal
 import subprocess
 import sys
-import threading
+import time
+import traceback
+import urllib.parse
+from collections import namedtuple
 from shutil import which
 import argparse
+from stream_levels import LevelMeter, SilenceGate, FLOOR_DB
+from stream_metrics import Registry, serve
+from air_check import AirCheck, write_clip
 
-"""
-<Code from timeshift/download.py - ported to python 3>
-"""
-# Original source: https://pypi.python.org/pypi/timeshift
-import time
-import urllib.request
 
+# Continuous mode: the stream is decoded to 16 bit mono PCM at a rate which is enough for level metering
+PCM_SAMPLE_RATE = 8000
+LEVEL_WINDOW = 0.1
+# Seconds without any data or decoded audio after which the stream is considered stalled
+STALL_TIMEOUT = 5
+# Seconds that ffmpeg may take in addition to the recording, and that the action may take
+FFMPEG_TIMEOUT = 5
+ACTION_TIMEOUT = 5
+MAX_REDIRECTS = 5
+# kbps for the size of the air check buffer of a stream which does not advertise its bitrate (icy-br)
+ASSUMED_BITRATE = 320
 
-class TimeLimitElapsed(RuntimeError):
-    pass
+StreamConfig = namedtuple('StreamConfig', ['name', 'stream_url', 'mode', 'rec_duration', 'check_interval', 'action',
+                                           'threshold_db', 'hysteresis_db', 'onset', 'backoff_min', 'backoff_max',
+                                           'aircheck_minutes', 'clip_before', 'clip_after'])
 
+# Type of each option of a stream
+STREAM_OPTIONS = {'stream_url': str, 'mode': str, 'rec_duration': int, 'check_interval': int, 'action': str,
+                  'threshold_db': float, 'hysteresis_db': float, 'onset': float, 'backoff_min': float,
+                  'backoff_max': float, 'aircheck_minutes': float, 'clip_before': float, 'clip_after': float}
 
-def download_time_limit(url, filename=None, time_limit=0):
-    def callback(count, blocksize, filesize):
-        pass
 
-    starttime = time.time()
-    if time_limit > 0:
-        def callback(count, blocksize, filesize):
-            elapsed = time.time() - starttime
-            if elapsed > time_limit:
-                raise TimeLimitElapsed
+def decoder_command():
+    # Packets are flushed to the pipe as soon as they are decoded, otherwise output buffering alone adds seconds
+    return ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-fflags', 'nobuffer', '-i', 'pipe:0',
+            '-vn', '-ac', '1', '-ar', str(PCM_SAMPLE_RATE), '-f', 's16le', '-flush_packets', '1', 'pipe:1']
 
-    try:
-        f = open(filename, 'w')
-    except IOError:
-        raise IOError('Cannot write to {0}'.format(filename))
-    else:
-        f.close()
 
-    try:
-        urllib.request.urlretrieve(url, filename=filename, reporthook=callback)
-    except TimeLimitElapsed:
-        pass
-"""
-</Code from timeshift/download.py - ported to python 3>
-"""
+def analysis_command(rec_duration, threshold_db):
+    return ['ffmpeg', '-hide_banner', '-i', 'pipe:0',
+            '-af', 'silencedetect=n={0}dB:d={1},volumedetect'.format(threshold_db, rec_duration), '-f', 'null', '-']
+
+
+class Backoff(object):
+    """ Exponentially growing delays between the retries of a failing stream, with jitter """
+    def __init__(self, initial=5.0, maximum=300.0, factor=2.0):
+        self._initial = initial
+        self._maximum = maximum
+        self._factor = factor
+        self.failures = 0
+
+    def next(self):
+        delay = min(self._maximum, self._initial * self._factor ** self.failures)
+        # The exponent stops growing at the maximum, so that it never overflows however long a stream fails
+        if delay < self._maximum:
+            self.failures += 1
+        # Streams of the same server which failed together do not retry together
+        return delay * random.uniform(0.8, 1.0)
+
+    def reset(self):
+        self.failures = 0
+
+
+async def kill(process):
+    if process.returncode is None:
+        process.kill()
+        await process.wait()
+
+
+class DetectorMetrics(object):
+    """ The metrics of all the detectors, labelled by stream """
+    def __init__(self):
+        self.registry = Registry()
+        r = self.registry
+        self.rms = r.gauge('silence_detector_rms_dbfs',
+                           'RMS level of the latest window (stream mode) or recording (file mode)', ['stream'])
+        self.peak = r.gauge('silence_detector_peak_dbfs',
+                            'Peak level of the latest window (stream mode) or recording (file mode)', ['stream'])
+        self.silent = r.gauge('silence_detector_silent', '1 while the stream is silent', ['stream'])
+        self.since_audio = r.gauge('silence_detector_seconds_since_audio',
+                                   'Seconds since the level of the stream was last above the threshold', ['stream'])
+        self.up = r.gauge('silence_detector_up', '1 while the stream is received', ['stream'])
+        self.latency = r.histogram('silence_detector_detection_latency_seconds',
+                                   'Seconds from the arrival of the first silent audio to the detection of the silence',
+                                   ['stream'])
+        self.connect = r.histogram('silence_detector_connect_seconds',
+                                   'Seconds to connect to the server of the stream', ['stream'])
+        self.first_byte = r.histogram('silence_detector_first_byte_seconds',
+                                      'Seconds from the request of the stream to the first byte of the response',
+                                      ['stream'])
+        self.errors = r.counter('silence_detector_errors_total',
+                                'Checks which failed and connections which ended or stalled', ['stream'])
+        self.restarts = r.counter('silence_detector_restarts_total', 'Actions run, by result', ['stream', 'result'])
+        self.last_restart_success = r.gauge('silence_detector_last_restart_success',
+                                            '1 if the latest action succeeded, 0 if it failed', ['stream'])
+        self.last_restart_time = r.gauge('silence_detector_last_restart_timestamp_seconds',
+                                         'Time of the latest action', ['stream'])
+        self.clips = r.counter('silence_detector_incident_clips_total', 'Incident clips saved, by event',
+                               ['stream', 'event'])
 
 
 class SilenceDetector:
-    def __init__(self, stream_url, rec_duration, check_interval, restart_command, logging_path):
-        self._stream_url = stream_url
-        self._rec_duration = rec_duration
-        self._check_interval = check_interval
-        self._restart_command = restart_command
-        self._logging_path = logging_path
-        self._logger = logging.getLogger('SilenceDetector')
-
-        # Folder for the temporary files
-        if not os.path.exists(logging_path):
-            os.mkdir(logging_path)
-
-        self.initialize_logging(os.path.join(logging_path, 'silence.log'))
-
-    # TODO create logging file as suggested in: https://fangpenlin.com/posts/2012/08/26/good-logging-practice-in-python/
-    def initialize_logging(self, log_filepath):
-        self._logger.setLevel(logging.DEBUG)
-        handler = logging.handlers.RotatingFileHandler(log_filepath, maxBytes=100000, backupCount=5)
-        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s', datefmt='%d/%m/%Y %I:%M:%S %p'))
-        self._logger.addHandler(handler)
-
-    def do_work(self):
-        # Download chunk
-        filename = 'UOC-{:%Y-%m-%d_%H:%M:%S}.mp3'.format(datetime.datetime.now())
-        filepath = os.path.join(self._logging_path, filename)
+    def __init__(self, config: StreamConfig, metrics: DetectorMetrics = None, incident_path=None):
+        self.config = config
+        self._logger = logging.getLogger('SilenceDetector').getChild(config.name)
+        self._backoff = Backoff(config.backoff_min, config.backoff_max)
+
+        self._metrics = metrics if metrics is not None else DetectorMetrics()
+        # Time the stream was last heard above the threshold, the start of the detector until it is heard
+        self.last_audio = time.time()
+        self._metrics.since_audio.set_function(lambda: time.time() - self.last_audio, stream=config.name)
+        self._metrics.up.set(0, stream=config.name)
+        self._metrics.silent.set(0, stream=config.name)
+
+        # Allocated on the first connection, when the bitrate is known
+        self.air_check = None
+        self._clip_extension = '.mp3'
+        self._clip_task = None
+        self._incident_path = incident_path
+
+    async def run(self):
+        """ Checks the stream until cancelled """
+        try:
+            while True:
+                try:
+                    if self.config.mode == 'stream':
+                        await self.monitor()
+                        self._metrics.errors.inc(stream=self.config.name)
+                        delay = self._backoff.next()
+                        self._logger.info('Reconnecting in {0:.0f} seconds.'.format(delay))
+                    else:
+                        await self.check_recording()
+                        self._backoff.reset()
+                        delay = self.config.check_interval
+                except asyncio.CancelledError:
+                    raise
+                except (OSError, asyncio.TimeoutError) as e:
+                    self._metrics.errors.inc(stream=self.config.name)
+                    delay = self._backoff.next()
+                    self._logger.error('{0}. Retrying in {1:.0f} seconds.'.format(e or 'Timeout', delay))
+                except Exception:
+                    self._metrics.errors.inc(stream=self.config.name)
+                    delay = self._backoff.next()
+                    self._logger.error('Unexpected error. Retrying in {0:.0f} seconds.'.format(delay))
+                    self._logger.error(traceback.format_exc())
+
+                self._metrics.up.set(0, stream=self.config.name)
+                await asyncio.sleep(delay)
+        finally:
+            if self._clip_task is not None and not self._clip_task.done():
+                # The pending clip is saved with the audio received so far
+                self._clip_task.cancel()
+                await asyncio.gather(self._clip_task, return_exceptions=True)
+
+    async def connect(self):
+        """
+        Requests the stream over HTTP and reads the response headers. Returns the reader and the writer of the
+        connection, positioned at the start of the audio, and the headers.
+        """
+        url = self.config.stream_url
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ['http', 'https']:
+                raise IOError('Unsupported stream URL {0}'.format(url))
+
+            start = time.monotonic()
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80),
+                ssl=parts.scheme == 'https'), STALL_TIMEOUT)
+            connected = time.monotonic()
+            self._metrics.connect.observe(connected - start, stream=self.config.name)
+
+            try:
+                # HTTP/1.0, so the audio is never chunked. Shoutcast/Icecast answer with 'ICY 200 OK' or 'HTTP/1.x'.
+                writer.write('GET {0} HTTP/1.0\r\nHost: {1}\r\nUser-Agent: ark-silence-detector\r\n\r\n'.format(
+                    urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, '')), parts.netloc).encode())
+                await writer.drain()
+
+                status = await asyncio.wait_for(reader.readline(), STALL_TIMEOUT)
+                self._metrics.first_byte.observe(time.monotonic() - connected, stream=self.config.name)
 
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), STALL_TIMEOUT)
+                    if line in [b'\r\n', b'\n', b'']:
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+            except BaseException:
+                writer.close()
+                raise
+
+            fields = status.decode('latin-1').split()
+            code = fields[1] if len(fields) > 1 else ''
+            if code == '200':
+                self._open_air_check(headers)
+                return reader, writer, headers
+
+            writer.close()
+            if code in ['301', '302', '303', '307', '308'] and 'location' in headers:
+                url = urllib.parse.urljoin(url, headers['location'])
+                continue
+            raise IOError('The server answered {0}'.format(status.decode('latin-1').strip() or 'nothing'))
+
+        raise IOError('Too many redirects')
+
+    async def check_recording(self):
+        """ File mode: records rec_duration seconds of the stream and restarts if all of it is silent """
+        loop = asyncio.get_running_loop()
+        reader, writer, _ = await self.connect()
+        self._metrics.up.set(1, stream=self.config.name)
+
+        self._logger.debug('Preparing downloading.')
+        recording = bytearray()
+        first_data_at = None
         try:
-            self._logger.debug('Preparing downloading.')
-            download_time_limit(self._stream_url, filepath, self._rec_duration)
-            self._logger.debug('The file was downloaded.')
-        except IOError:
-            self._logger.error('IO error while downloading file. Exiting.')
-            sys.exit(errno.EIO)
-        except:
-            self._logger.error('Unexpected error while downloading file. Exiting.')
-            self._logger.error(traceback.format_exc())
-            sys.exit(1)
+            deadline = loop.time() + self.config.rec_duration
+            while loop.time() < deadline:
+                try:
+                    data = await asyncio.wait_for(reader.read(1 << 16), min(STALL_TIMEOUT, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    if loop.time() < deadline:
+                        raise IOError('No data for {0} seconds, the stream stalled'.format(STALL_TIMEOUT))
+                    break
+                if not data:
+                    raise IOError('The stream ended')
+                if first_data_at is None:
+                    first_data_at = time.time()
+                recording += data
+                self._receive(data)
+        finally:
+            writer.close()
+        self._logger.debug('The file was downloaded.')
 
         self._logger.debug('Preparing ffmpeg call.')
-        cmd = ['ffmpeg', '-i', filepath, '-af', 'silencedetect=n=-60dB:d={}'.
-            format(self._rec_duration), '-f', 'null', '-']
+        process = await asyncio.create_subprocess_exec(
+            *analysis_command(self.config.rec_duration, self.config.threshold_db),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         try:
-            out = subprocess.check_output(cmd, stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT, timeout=5)
-        except subprocess.TimeoutExpired:
-            self._logger.error('ffmpeg call timeout. Exiting.')
-            sys.exit(errno.EIO)
-        except:
-            self._logger.error('Unexpected error while calling ffmpeg. Exiting.')
-            self._logger.error(traceback.format_exc())
-            sys.exit(1)
+            out, _ = await asyncio.wait_for(process.communicate(bytes(recording)), FFMPEG_TIMEOUT)
+        finally:
+            await kill(process)
 
+        if process.returncode != 0:
+            lines = out.decode(errors='replace').strip().splitlines()
+            raise IOError('ffmpeg failed: {0}'.format(lines[-1] if lines else process.returncode))
         self._logger.debug('ffmpeg result received.')
 
+        for name, gauge in [(b'mean_volume', self._metrics.rms), (b'max_volume', self._metrics.peak)]:
+            match = re.search(name + rb': (-?[\d.]+|-inf) dB', out)
+            if match is not None:
+                gauge.set(max(FLOOR_DB, float(match.group(1))), stream=self.config.name)
+
         # We have silence if exactly one silence element (which is always silence_start) is reported.
         # Of course capture length should be reasonable in order to bypass cases of silence between tracks when
         # crossfade is not enabled.
         is_silent = len(re.findall(b'silence_(start|end)', out)) == 1
-
-        # Cleanup
-        os.remove(filepath)
-
+        self._metrics.silent.set(int(is_silent), stream=self.config.name)
         if is_silent:
-            out = subprocess.check_output(self._restart_command.split(' '), stdin=subprocess.DEVNULL,
-                                          stderr=subprocess.STDOUT, timeout=5)
-
-            if out == b'':
-                self._logger.warning('Silence detected. The scheduler was succesfully restarted')
-            else:
-                self._logger.error('Silence detected. The scheduler was not restarted due to {}'.format(out.decode()))
+            # The silence started where ffmpeg reports it in the recording, which started with the first data received
+            match = re.search(rb'silence_start: (-?[\d.]+)', out)
+            silence_start = max(0.0, float(match.group(1))) if match is not None else 0.0
+            self._metrics.latency.observe(time.time() - (first_data_at + silence_start), stream=self.config.name)
+            await self.restart()
         else:
+            self.last_audio = time.time()
             self._logger.info('Stream is in good state')
 
-        # Call the working thread normally every check_interval seconds or 2*check_interval seconds
-        # if a restart was required
-        threading.Timer(self._check_interval if not is_silent else self._check_interval, self.do_work).start()
+    async def monitor(self):
+        """
+        Stream mode: the stream is piped to a long-lived ffmpeg which decodes it to PCM, and the levels are measured as
+        the audio arrives, so the start of a silence is logged within about onset seconds. The action runs once the
+        silence lasts rec_duration seconds, and again every check_interval seconds while it lasts. Returns when the
+        stream ends or stalls.
+        """
+        meter = LevelMeter(PCM_SAMPLE_RATE, LEVEL_WINDOW)
+        gate = SilenceGate(self.config.threshold_db, self.config.hysteresis_db, self.config.onset)
+        chunk_size = 2 * meter.window_samples
+        last_restart = None
+        receiving = False
+
+        reader, writer, _ = await self.connect()
+        self._logger.debug('Starting the decoder.')
+        decoder = await asyncio.create_subprocess_exec(
+            *decoder_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        async def feed():
+            try:
+                while True:
+                    data = await reader.read(1 << 14)
+                    if not data:
+                        break
+                    self._receive(data)
+                    decoder.stdin.write(data)
+                    await decoder.stdin.drain()
+            finally:
+                decoder.stdin.close()
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            while True:
+                try:
+                    pcm = await asyncio.wait_for(decoder.stdout.read(chunk_size), STALL_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self._logger.error('No audio for {0} seconds, the stream stalled.'.format(STALL_TIMEOUT))
+                    self._incident('stall')
+                    return
+                if not pcm:
+                    self._logger.error('The stream ended.')
+                    self._incident('dropout')
+                    return
+
+                if not receiving:
+                    receiving = True
+                    self._logger.info('Receiving audio.')
+                    self._metrics.up.set(1, stream=self.config.name)
+                    self._backoff.reset()
+
+                rms_db, peak_db = meter.feed(pcm)
+                if len(rms_db) == 0:
+                    continue
+                self._metrics.rms.set(float(rms_db[-1]), stream=self.config.name)
+                self._metrics.peak.set(float(peak_db[-1]), stream=self.config.name)
+                if rms_db.max() >= self.config.threshold_db:
+                    self.last_audio = time.time()
+
+                events = gate.update(rms_db, meter.window, time.time())
+                self._metrics.silent.set(int(gate.is_silent), stream=self.config.name)
+                for event in events:
+                    if event == 'start':
+                        # Wall clock time since the first silent window arrived, i.e. the onset plus the delays of the
+                        # decoder and of the pipe
+                        latency = time.time() - gate.started_at
+                        self._metrics.latency.observe(latency, stream=self.config.name)
+                        self._logger.warning('Silence started {0:.1f} seconds ago.'.format(latency))
+                        self._incident('silence')
+                    else:
+                        self._logger.info('Silence ended after {0:.1f} seconds.'.format(gate.silent_for))
+                        last_restart = None
+
+                if gate.is_silent and gate.silent_for >= self.config.rec_duration and \
+                        (last_restart is None or gate.silent_for - last_restart >= self.config.check_interval):
+                    last_restart = gate.silent_for
+                    await self.restart()
+        finally:
+            feeder.cancel()
+            await asyncio.gather(feeder, return_exceptions=True)
+            writer.close()
+            await kill(decoder)
+
+    async def restart(self):
+        """ Runs the action. Returns whether it succeeded, i.e. exited with 0 and printed nothing. """
+        self._metrics.last_restart_time.set(time.time(), stream=self.config.name)
+        self._incident('restart')
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *shlex.split(self.config.action),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            try:
+                out, _ = await asyncio.wait_for(process.communicate(), ACTION_TIMEOUT)
+            finally:
+                await kill(process)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._logger.error('Silence detected. The scheduler was not restarted due to {0}'.format(e or 'a timeout'))
+            return self._restarted(False)
+
+        if process.returncode == 0 and out.strip() == b'':
+            self._logger.warning('Silence detected. The scheduler was succesfully restarted')
+            return self._restarted(True)
+
+        self._logger.error('Silence detected. The scheduler was not restarted due to {0}'.format(
+            out.decode(errors='replace').strip() or 'exit code {0}'.format(process.returncode)))
+        return self._restarted(False)
+
+    def _restarted(self, success):
+        self._metrics.restarts.inc(stream=self.config.name, result='success' if success else 'failure')
+        self._metrics.last_restart_success.set(int(success), stream=self.config.name)
+        return success
+
+    def _open_air_check(self, headers):
+        if self.config.aircheck_minutes <= 0 or self._incident_path is None:
+            return
+
+        if self.air_check is None:
+            bitrate = headers.get('icy-br', '').split(',')[0]
+            bitrate = int(bitrate) if bitrate.isdigit() else ASSUMED_BITRATE
+            duration = self.config.aircheck_minutes * 60
+            content_type = headers.get('content-type', '')
+            container = 'ogg' if 'ogg' in content_type else 'mp3'
+            self._clip_extension = '.ogg' if container == 'ogg' else '.aac' if 'aac' in content_type else '.mp3'
+
+            # A margin for variable bitrates
+            self.air_check = AirCheck(int(duration * bitrate * 125 * 1.25), duration, container=container)
+            self._logger.debug('Air check of {0:.0f} minutes, {1:.1f} MB.'.format(
+                self.config.aircheck_minutes, self.air_check.capacity / 1e6))
+
+        self.air_check.new_stream()
+
+    def _receive(self, data):
+        if self.air_check is not None:
+            self.air_check.write(data)
+
+    def _incident(self, event):
+        """ Saves a clip from clip_before seconds before the event to clip_after seconds after it """
+        if self.air_check is None or (self._clip_task is not None and not self._clip_task.done()):
+            # An event during the clip of another one is in that clip
+            return
+
+        start = self.air_check.offset_at(time.time() - self.config.clip_before)
+        name = '{0}-{1:%Y-%m-%d_%H:%M:%S}-{2}{3}'.format(self.config.name, datetime.datetime.now(), event,
+                                                        self._clip_extension)
+        self._clip_task = asyncio.ensure_future(self._save_clip(os.path.join(self._incident_path, name), event, start))
+
+    async def _save_clip(self, path, event, start):
+        cancelled = False
+        try:
+            await asyncio.sleep(self.config.clip_after)
+        except asyncio.CancelledError:
+            cancelled = True
+
+        data = self.air_check.clip(start)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write_clip, path, data)
+            self._metrics.clips.inc(stream=self.config.name, event=event)
+            self._logger.info('Saved the incident clip {0} ({1:.1f} MB).'.format(path, len(data) / 1e6))
+        except OSError as e:
+            self._logger.error('Could not save the incident clip {0}: {1}'.format(path, e))
+
+        if cancelled:
+            raise asyncio.CancelledError
+
+
+class Supervisor(object):
+    """ Runs the detectors of all streams until SIGINT or SIGTERM, and serves their metrics """
+    def __init__(self, streams, metrics_host='127.0.0.1', metrics_port=None, incident_path=None):
+        self.metrics = DetectorMetrics()
+        self.detectors = [SilenceDetector(stream, self.metrics, incident_path) for stream in streams]
+        self._metrics_address = (metrics_host, metrics_port)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        tasks = [asyncio.ensure_future(detector.run()) for detector in self.detectors]
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, lambda: [task.cancel() for task in tasks])
+
+        server = None
+        if self._metrics_address[1] is not None:
+            server = await serve(self.metrics.registry, *self._metrics_address)
+            logging.getLogger('SilenceDetector').info('Serving metrics at http://{0}:{1}/metrics'.format(
+                *self._metrics_address))
+
+        await asyncio.wait(tasks)
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+
+def stream_name(stream_url):
+    return os.path.basename(urllib.parse.urlparse(stream_url).path) or stream_url
+
+
+def load_streams(config_path, defaults):
+    """ The StreamConfig of each section of an INI file, with the options it omits taken from defaults """
+    parser = configparser.ConfigParser(defaults={k: str(v) for k, v in defaults.items()}, interpolation=None)
+    if len(parser.read(config_path)) == 0:
+        raise IOError('Cannot read {0}'.format(config_path))
+
+    streams = []
+    for name in parser.sections():
+        section = parser[name]
+        streams.append(StreamConfig(name=name, **{k: t(section[k]) for k, t in STREAM_OPTIONS.items()}))
+
+    return streams
+
+
+# TODO create logging file as suggested in: https://fangpenlin.com/posts/2012/08/26/good-logging-practice-in-python/
+def initialize_logging(logging_path):
+    if not os.path.exists(logging_path):
+        os.mkdir(logging_path)
+
+    logger = logging.getLogger('SilenceDetector')
+    logger.setLevel(logging.DEBUG)
+    handler = logging.handlers.RotatingFileHandler(os.path.join(logging_path, 'silence.log'),
+                                                   maxBytes=100000, backupCount=5)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s', datefmt='%d/%m/%Y %I:%M:%S %p'))
+    logger.addHandler(handler)
 
 
 def main(args):
@@ -135,35 +533,78 @@ def main(args):
     if not which('ffmpeg'):
         sys.exit('ffmpeg executable not found in the system. Please install it through your package manager.')
 
-    # Find if ffmpeg has the required filter
-    out = subprocess.check_output(['ffmpeg', '-filters'], stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT, timeout=5)
-    if re.search(b'silencedetect', out) is None:
-        sys.exit('Installed ffmpeg version does not provide the required \'silencedetect\' filter.')
+    defaults = {k: getattr(args, k) for k in STREAM_OPTIONS}
+    if args.config is not None:
+        streams = load_streams(args.config, defaults)
+        if len(streams) == 0:
+            sys.exit('No streams in {0}'.format(args.config))
+    else:
+        streams = [StreamConfig(name=stream_name(args.stream_url), **defaults)]
 
-    parser = configparser.ConfigParser()
+    for stream in streams:
+        if stream.mode not in ['file', 'stream']:
+            sys.exit('Unknown mode \'{0}\' of stream {1}'.format(stream.mode, stream.name))
 
-    # Initialize the detector object and start working
-    silence_detector = SilenceDetector(args.stream_url, int(args.rec_duration), int(args.check_interval), args.action, args.logging_path)
-    silence_detector.do_work()
+    # Find if ffmpeg has the required filter
+    if any(stream.mode == 'file' for stream in streams):
+        out = subprocess.check_output(['ffmpeg', '-filters'], stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                                      timeout=5)
+        if re.search(b'silencedetect', out) is None:
+            sys.exit('Installed ffmpeg version does not provide the required \'silencedetect\' filter.')
 
-    # Block the main thread
-    while True:
-        pass
+    initialize_logging(args.logging_path)
+    incident_path = args.incident_path or os.path.join(args.logging_path, 'incidents')
+    if not os.path.exists(incident_path):
+        os.makedirs(incident_path)
 
+    # Initialize the detectors and start working
+    asyncio.run(Supervisor(streams, args.metrics_host, args.metrics_port, incident_path).run())
 
-if __name__ == "__main__":
+
+def cli(argv=None, prog=None):
     parser = argparse.ArgumentParser(
-        description='A silence detector using ffmpeg')
+        prog=prog, description='A silence detector using ffmpeg')
+    parser.add_argument('--config', nargs='?', type=str, default=None,
+                        help='INI file with a section per stream, the options below are the defaults of its keys')
     parser.add_argument('--rec_duration', nargs='?', type=int, default=10,
-                        help='The directory which contains the music library.')
+                        help='Seconds of silence after which the action runs')
     parser.add_argument('--check_interval', nargs='?', type=int, default=30,
-                        help='The filepath to store inspection output')
+                        help='Seconds between checks, or between actions during a silence in stream mode')
     parser.add_argument('--stream_url', nargs='?', type=str, default='http://rs.radio.uoc.gr:8000/uoc_128.mp3',
-                        help='The filepath to store inspection output')
+                        help='The stream to check')
     parser.add_argument('--action', nargs='?', type=str, default='systemctl --user restart audio-scheduler',
                         help='E.g. a command to execute on silence detection')
     parser.add_argument('--logging_path', nargs='?', type=str, default='/tmp/silence_detector',
                         help='Path to store the log')
-    args = parser.parse_args()
+    parser.add_argument('--mode', nargs='?', default='file', choices=['file', 'stream'],
+                        help='file: record rec_duration seconds every check_interval seconds and analyze the recording, '
+                             'stream: decode the stream continuously and measure its level as it arrives')
+    parser.add_argument('--threshold_db', nargs='?', type=float, default=-60.0,
+                        help='Level (dBFS) below which the stream is silent')
+    parser.add_argument('--hysteresis_db', nargs='?', type=float, default=6.0,
+                        help='Stream mode: a silence ends when the level exceeds the threshold by that much')
+    parser.add_argument('--onset', nargs='?', type=float, default=1.0,
+                        help='Stream mode: seconds below the threshold before a silence is reported')
+    parser.add_argument('--backoff_min', nargs='?', type=float, default=5.0,
+                        help='Seconds before the first retry of a failing stream, doubled on each failure')
+    parser.add_argument('--backoff_max', nargs='?', type=float, default=300.0,
+                        help='Maximum seconds between the retries of a failing stream')
+    parser.add_argument('--aircheck_minutes', nargs='?', type=float, default=5.0,
+                        help='Minutes of the received stream kept in memory for the incident clips, 0 disables them')
+    parser.add_argument('--clip_before', nargs='?', type=float, default=60.0,
+                        help='Seconds before a silence, restart or dropout in its incident clip')
+    parser.add_argument('--clip_after', nargs='?', type=float, default=30.0,
+                        help='Seconds after a silence, restart or dropout in its incident clip')
+    parser.add_argument('--incident_path', nargs='?', type=str, default=None,
+                        help='Directory of the incident clips, logging_path/incidents by default')
+    parser.add_argument('--metrics_port', nargs='?', type=int, default=None,
+                        help='Serve Prometheus metrics at http://metrics_host:metrics_port/metrics')
+    parser.add_argument('--metrics_host', nargs='?', type=str, default='127.0.0.1',
+                        help='Address of the metrics endpoint')
+    args = parser.parse_args(argv)
 
     main(args)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-in stream server and benchmark of the silence detector, so it can be tested without the real stream.
+
+The server plays a scripted scenario in a loop, like a radio station: program audio, short gaps between tracks, quiet
+passages, long silences, stalls (the server stops sending) and dropouts (the server closes the connections and refuses
+new ones). The audio is synthesized with NumPy and encoded once to mp3 and Ogg Vorbis with ffmpeg, and every listener
+receives it paced in real time from the current position of the scenario, at http://host:port/bench.mp3 and
+http://host:port/bench.ogg.
+
+The benchmark runs silence_detector.py against the server, in each mode and format, with a number of streams, and polls
+its metrics endpoint. The silent gauge of each stream is compared to the scenario:
+- latency: seconds from the start of each long silence to its detection,
+- missed: long silences which were not detected,
+- false positives: detections during audio, gaps or quiet passages,
+- CPU and memory of the detector and its ffmpeg processes, per stream.
+The results are written as JSON, so that runs can be compared.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import tempfile
+import argparse
+import threading
+import subprocess
+import urllib.request
+import numpy as np
+from air_check import ogg_header_length
+
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+
+SAMPLE_RATE = 44100
+BITRATE = 128
+
+# (kind, seconds). The audio of stall and dropout is program audio, which the listeners do not receive.
+DEFAULT_SCENARIO = [('audio', 20), ('gap', 0.5), ('audio', 15), ('quiet', 10), ('audio', 10), ('silence', 45),
+                    ('audio', 15), ('stall', 8), ('audio', 10), ('dropout', 10), ('audio', 15)]
+SEGMENT_KINDS = ['audio', 'gap', 'quiet', 'silence', 'stall', 'dropout']
+
+# Seconds between the writes to a listener
+SEND_INTERVAL = 0.05
+# Seconds between the polls of the metrics of the detector
+POLL_INTERVAL = 0.1
+
+ENCODERS = {'mp3': ['-c:a', 'libmp3lame', '-b:a', '{0}k'.format(BITRATE), '-id3v2_version', '0', '-write_xing', '0'],
+            'ogg': ['-c:a', 'libvorbis', '-b:a', '{0}k'.format(BITRATE)]}
+CONTENT_TYPES = {'mp3': 'audio/mpeg', 'ogg': 'application/ogg'}
+
+
+class Scenario(object):
+    def __init__(self, segments=DEFAULT_SCENARIO):
+        for kind, _ in segments:
+            if kind not in SEGMENT_KINDS:
+                raise ValueError('Unknown segment \'{0}\', one of {1}'.format(kind, ', '.join(SEGMENT_KINDS)))
+
+        self.segments = [(kind, float(seconds)) for kind, seconds in segments]
+        self.starts = np.cumsum([0] + [seconds for _, seconds in self.segments])
+        self.length = float(self.starts[-1])
+
+    def windows(self, kind):
+        """ The (start, end) of the segments of a kind, in seconds from the start of the scenario """
+        return [(float(self.starts[i]), float(self.starts[i + 1])) for i, (k, _) in enumerate(self.segments) if k == kind]
+
+    def at(self, position):
+        return self.segments[int(np.searchsorted(self.starts, position % self.length, side='right')) - 1][0]
+
+    def pcm(self, seed=0):
+        """ The audio of the scenario, float mono """
+        rng = np.random.default_rng(seed)
+        parts = []
+        for kind, seconds in self.segments:
+            n = int(round(seconds * SAMPLE_RATE))
+            if kind == 'gap':
+                parts.append(np.zeros(n))
+            elif kind == 'silence':
+                # Dither, as the output of a sound card
+                parts.append(rng.normal(0, 10 ** (-90 / 20), n))
+            else:
+                parts.append(program(n, rng) * (10 ** (-27 / 20) if kind == 'quiet' else 1))
+        return np.concatenate(parts)
+
+
+def program(n, rng):
+    """ Music-like audio around -18 dBFS RMS: chords changing every half second, with a little noise """
+    t = np.arange(n) / SAMPLE_RATE
+    out = np.zeros(n)
+    step = SAMPLE_RATE // 2
+    for start in range(0, n, step):
+        part = slice(start, min(n, start + step))
+        for f in 110 * 2 ** (rng.integers(0, 36, 3) / 12):
+            out[part] += np.sin(2 * np.pi * f * t[part])
+    out += rng.normal(0, 0.05, n)
+    return out * 0.18 / np.sqrt(np.mean(np.square(out)))
+
+
+class Track(object):
+    """ An encoded scenario and the time at which each of its byte offsets is due """
+    def __init__(self, data, container, length):
+        self.data = data
+        self.container = container
+        self.header = data[:ogg_header_length(data) or 0] if container == 'ogg' else b''
+
+        if container == 'ogg':
+            # The end of each page is due at its granule position
+            offsets, times = [0], [0.0]
+            offset = 0
+            while offset + 27 <= len(data) and data[offset:offset + 4] == b'OggS':
+                granule = int.from_bytes(data[offset + 6:offset + 14], 'little', signed=True)
+                n_segments = data[offset + 26]
+                offset += 27 + n_segments + sum(data[offset + 27:offset + 27 + n_segments])
+                offsets.append(offset)
+                times.append(max(times[-1], granule / SAMPLE_RATE))
+        else:
+            # Constant bitrate
+            offsets = list(range(0, len(data), 1024)) + [len(data)]
+            times = [o * length / len(data) for o in offsets]
+
+        self._offsets = np.array(offsets)
+        self._times = np.array(times)
+
+    def offset_at(self, position):
+        return int(self._offsets[np.searchsorted(self._times, position, side='right') - 1])
+
+
+def encode(pcm, fmt, work_dir):
+    pcm_path = os.path.join(work_dir, 'scenario.pcm')
+    if not os.path.exists(pcm_path):
+        with open(pcm_path, 'wb') as f:
+            f.write((np.clip(pcm, -1, 1) * 32767).astype('<i2').tobytes())
+
+    path = os.path.join(work_dir, 'scenario.' + fmt)
+    subprocess.check_output(['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-f', 's16le', '-ar',
+                             str(SAMPLE_RATE), '-ac', '1', '-i', pcm_path, '-map_metadata', '-1'] + ENCODERS[fmt] +
+                            [path], stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class StationServer(object):
+    """ Serves the tracks of a scenario at /bench.<format>, every listener at the current position of the scenario """
+    def __init__(self, scenario: Scenario, tracks):
+        self.scenario = scenario
+        self.tracks = tracks
+        self.start_time = time.time()
+
+    def position(self):
+        return (time.time() - self.start_time) % self.scenario.length
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in [b'\r\n', b'\n', b'']:
+                pass
+
+            fields = request.decode('latin-1').split()
+            fmt = os.path.splitext(fields[1])[1][1:] if len(fields) > 1 and fields[1].startswith('/bench.') else ''
+            if fmt not in self.tracks:
+                writer.write(b'HTTP/1.0 404 Not Found\r\n\r\n')
+            elif self.scenario.at(self.position()) == 'dropout':
+                writer.write(b'HTTP/1.0 503 Service Unavailable\r\n\r\n')
+            else:
+                writer.write('ICY 200 OK\r\nContent-Type: {0}\r\nicy-br: {1}\r\nicy-name: bench\r\n\r\n'.format(
+                    CONTENT_TYPES[fmt], BITRATE).encode())
+                await self.send(writer, self.tracks[fmt])
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, writer, track: Track):
+        position = self.position()
+        offset = track.offset_at(position)
+        writer.write(track.header)
+
+        while True:
+            await asyncio.sleep(SEND_INTERVAL)
+            previous, position = position, self.position()
+            kind = self.scenario.at(position)
+            if kind == 'dropout':
+                return
+
+            if position < previous:
+                # Looped, the next Ogg pages are the header pages of the track
+                writer.write(track.data[offset:])
+                offset = 0
+
+            end = track.offset_at(position)
+            if kind != 'stall':
+                writer.write(track.data[offset:end])
+                await writer.drain()
+            # Listeners miss the data of a stall
+            offset = end
+
+    async def serve(self, host, port, started=None):
+        server = await asyncio.start_server(self.handle, host, port)
+        if started is not None:
+            started.set()
+        async with server:
+            await server.serve_forever()
+
+    def start_in_thread(self, host, port):
+        started = threading.Event()
+        threading.Thread(target=asyncio.run, args=(self.serve(host, port, started),), daemon=True).start()
+        if not started.wait(10):
+            raise RuntimeError('The stream server did not start')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_tree_usage(pid):
+    """ CPU seconds and resident bytes of a process and its descendants, from /proc """
+    processes = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(entry)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # Fields after the command: state, ppid, ... utime (14), stime, cutime, cstime ... rss (24)
+        processes[int(entry)] = (int(fields[1]), [int(x) for x in fields[11:15]], int(fields[21]))
+
+    tree = {pid}
+    changed = True
+    while changed:
+        children = {p for p, (ppid, _, _) in processes.items() if ppid in tree} - tree
+        tree |= children
+        changed = len(children) > 0
+
+    ticks = 0
+    rss = 0
+    for p in tree & processes.keys():
+        _, (utime, stime, cutime, cstime), pages = processes[p]
+        # The exited children which were waited for are included in cutime and cstime
+        ticks += utime + stime + cutime + cstime
+        rss += pages
+    return ticks / os.sysconf('SC_CLK_TCK'), rss * os.sysconf('SC_PAGE_SIZE')
+
+
+def read_metrics(url):
+    """ {(name, stream): value} of the metrics of the detector """
+    values = {}
+    with urllib.request.urlopen(url, timeout=1) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith('#') or '{' not in line:
+                continue
+            name, rest = line.split('{', 1)
+            labels, value = rest.rsplit('} ', 1)
+            stream = labels.split('stream="', 1)[1].split('"', 1)[0] if 'stream="' in labels else ''
+            key = (name, stream)
+            values[key] = values.get(key, 0) + float(value)
+    return values
+
+
+def run_detector(server_url, fmt, mode, n_streams, duration, detector_options, work_dir):
+    """ Runs the detector for duration seconds. Returns the rising edges of the silent gauge and the usage samples. """
+    config_path = os.path.join(work_dir, 'streams.ini')
+    with open(config_path, 'w') as f:
+        for i in range(n_streams):
+            f.write('[s{0}]\nstream_url = {1}/bench.{2}\nmode = {3}\naction = true\n\n'.format(i, server_url, fmt, mode))
+
+    metrics_port = free_port()
+    metrics_url = 'http://127.0.0.1:{0}/metrics'.format(metrics_port)
+    cmd = [sys.executable, os.path.join(ROOT, 'silence_detector.py'), '--config', config_path,
+           '--logging_path', os.path.join(work_dir, 'log-{0}-{1}'.format(mode, fmt)),
+           '--metrics_port', str(metrics_port)] + detector_options
+    detector = subprocess.Popen(cmd, stdin=subprocess.DEVNULL)
+
+    edges = []
+    silent = {}
+    cpu_samples = []
+    rss_peak = 0
+    metrics = {}
+    start = time.time()
+    next_sample = start
+    try:
+        while time.time() - start < duration:
+            if detector.poll() is not None:
+                raise RuntimeError('The detector exited with {0}'.format(detector.returncode))
+            try:
+                metrics = read_metrics(metrics_url)
+            except OSError:
+                # Not listening yet
+                metrics = {}
+            now = time.time()
+            for (name, stream), value in metrics.items():
+                if name == 'silence_detector_silent':
+                    if value == 1 and silent.get(stream, 0) == 0:
+                        edges.append((stream, now))
+                    silent[stream] = value
+
+            if now >= next_sample:
+                cpu, rss = process_tree_usage(detector.pid)
+                cpu_samples.append((now, cpu))
+                rss_peak = max(rss_peak, rss)
+                next_sample += 1
+            time.sleep(POLL_INTERVAL)
+    finally:
+        detector.send_signal(signal.SIGTERM)
+        try:
+            detector.wait(10)
+        except subprocess.TimeoutExpired:
+            detector.kill()
+            detector.wait()
+
+    return edges, cpu_samples, rss_peak, metrics
+
+
+def evaluate(scenario: Scenario, server_start, edges, n_streams, start, end, grace):
+    """ Matches the detections to the long silences of the scenario """
+    # The silences of the run, in wall clock time
+    silences = []
+    loop = int((start - server_start) // scenario.length)
+    while server_start + loop * scenario.length < end:
+        for s, e in scenario.windows('silence'):
+            s, e = server_start + loop * scenario.length + s, server_start + loop * scenario.length + e
+            # Only the silences which the detector could detect during the run
+            if s >= start and e + grace <= end:
+                silences.append((s, e))
+        loop += 1
+
+    latencies = []
+    false_positives = 0
+    for i in range(n_streams):
+        stream = 's{0}'.format(i)
+        times = sorted(t for name, t in edges if name == stream)
+        matched = set()
+        for t in times:
+            match = next((w for w in silences if w[0] <= t <= w[1] + grace and w not in matched), None)
+            if match is None:
+                if any(w[0] <= t <= w[1] + grace for w in silences):
+                    # A second detection of the same silence, e.g. after a reconnection
+                    continue
+                false_positives += 1
+            else:
+                matched.add(match)
+                latencies.append(t - match[0])
+
+    return len(silences) * n_streams, latencies, false_positives
+
+
+def benchmark(modes, formats, n_streams, duration, scenario: Scenario, detector_options, output_path, grace):
+    work_dir = tempfile.mkdtemp(prefix='stream_bench-')
+    print('Encoding {0:.0f} seconds of audio'.format(scenario.length))
+    pcm = scenario.pcm()
+    tracks = {}
+    for fmt in formats:
+        data = encode(pcm, fmt, work_dir)
+        tracks[fmt] = Track(data, fmt, scenario.length)
+
+    server = StationServer(scenario, tracks)
+    port = free_port()
+    server.start_in_thread('127.0.0.1', port)
+    server_url = 'http://127.0.0.1:{0}'.format(port)
+
+    results = []
+    for mode in modes:
+        for fmt in formats:
+            print('{0} mode, {1}, {2} streams, {3:.0f} seconds'.format(mode, fmt, n_streams, duration))
+            start = time.time()
+            edges, cpu_samples, rss_peak, metrics = run_detector(server_url, fmt, mode, n_streams, duration,
+                                                                 detector_options, work_dir)
+            end = time.time()
+            n_silences, latencies, false_positives = evaluate(scenario, server.start_time, edges, n_streams, start,
+                                                              end, grace)
+
+            # CPU after the startup (imports, first connection)
+            samples = [s for s in cpu_samples if s[0] >= start + 5] or cpu_samples
+            cpu_percent = 100 * (samples[-1][1] - samples[0][1]) / max(1e-9, samples[-1][0] - samples[0][0]) \
+                if len(samples) > 1 else float('nan')
+
+            result = {
+                'mode': mode, 'format': fmt, 'streams': n_streams, 'duration': round(end - start, 1),
+                'silences': n_silences, 'detected': len(latencies), 'missed': n_silences - len(latencies),
+                'latency_mean': float(np.mean(latencies)) if latencies else None,
+                'latency_median': float(np.median(latencies)) if latencies else None,
+                'latency_max': float(np.max(latencies)) if latencies else None,
+                'false_positives': false_positives,
+                'false_positives_per_stream_hour': false_positives / n_streams / ((end - start) / 3600),
+                'restarts': sum(v for (name, _), v in metrics.items() if name == 'silence_detector_restarts_total'),
+                'errors': sum(v for (name, _), v in metrics.items() if name == 'silence_detector_errors_total'),
+                'cpu_percent': cpu_percent,
+                'cpu_percent_per_stream': cpu_percent / n_streams,
+                'rss_mb_peak': rss_peak / 1e6,
+                'rss_mb_per_stream': rss_peak / 1e6 / n_streams,
+            }
+            results.append(result)
+            print('\t{0}/{1} silences detected, latency {2}, {3} false positives, {4:.1f}% CPU and {5:.1f} MB per '
+                  'stream'.format(result['detected'], n_silences,
+                                  '{0:.2f}s mean, {1:.2f}s max'.format(result['latency_mean'], result['latency_max'])
+                                  if latencies else '-', false_positives, result['cpu_percent_per_stream'],
+                                  result['rss_mb_per_stream']))
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'scenario': scenario.segments,
+              'detector_options': detector_options, 'results': results}
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to {0}'.format(output_path))
+
+
+def load_scenario(path):
+    if path is None:
+        return Scenario()
+    with open(path) as f:
+        return Scenario([tuple(segment) for segment in json.load(f)])
+
+
+def cli(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog, description='Stand-in stream server with scripted silences, stalls and dropouts, and benchmark of '
+                               'the silence detector against it.')
+    parser.add_argument('--serve', action='store_true', help='Only serve the streams, until interrupted')
+    parser.add_argument('--port', nargs='?', type=int, default=8000, help='Port of the server, with --serve')
+    parser.add_argument('--scenario', nargs='?', default=None,
+                        help='JSON list of [kind, seconds] segments, the kinds are {0}'.format(', '.join(SEGMENT_KINDS)))
+    parser.add_argument('--modes', nargs='+', default=['file', 'stream'], choices=['file', 'stream'])
+    parser.add_argument('--formats', nargs='+', default=['mp3', 'ogg'], choices=list(ENCODERS))
+    parser.add_argument('--streams', nargs='?', type=int, default=1, help='Number of streams monitored by the detector')
+    parser.add_argument('--duration', nargs='?', type=float, default=None,
+                        help='Seconds of each run, one loop of the scenario by default')
+    parser.add_argument('--grace', nargs='?', type=float, default=45.0,
+                        help='Seconds after the end of a silence in which its detection still counts')
+    parser.add_argument('--output', nargs='?', default='stream_bench.json', help='JSON results file')
+    parser.add_argument('--detector_options', nargs=argparse.REMAINDER, default=[],
+                        help='Options passed to silence_detector.py, e.g. --check_interval 10 --onset 2')
+    args = parser.parse_args(argv)
+
+    scenario = load_scenario(args.scenario)
+    if args.serve:
+        work_dir = tempfile.mkdtemp(prefix='stream_bench-')
+        pcm = scenario.pcm()
+        server = StationServer(scenario, {fmt: Track(encode(pcm, fmt, work_dir), fmt, scenario.length)
+                                          for fmt in args.formats})
+        print('Serving a {0:.0f} second scenario at {1}'.format(
+            scenario.length, ', '.join('http://127.0.0.1:{0}/bench.{1}'.format(args.port, fmt)
+                                       for fmt in args.formats)))
+        asyncio.run(server.serve('0.0.0.0', args.port))
+        return
+
+    benchmark(args.modes, args.formats, args.streams, args.duration or scenario.length, scenario,
+              args.detector_options, args.output, args.grace)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Level metering and silence gating of a decoded audio stream.
+
+The decoder delivers signed 16 bit little endian mono PCM in chunks of any size. LevelMeter cuts it into fixed windows
+and computes the RMS and peak level of each window (dBFS) with NumPy, keeping only the remainder of an incomplete window
+and a fixed size ring buffer of the latest levels, so memory does not grow with the running time. SilenceGate turns the
+window levels into silence start/end events, with a threshold and a hysteresis.
+"""
+
+import numpy as np
+
+
+# Level reported for digital silence, instead of -inf
+FLOOR_DB = -120.0
+
+# Tolerance of the sums of window lengths, e.g. ten windows of 0.1 add up to slightly less than 1.0
+TIME_EPSILON = 1e-9
+
+
+def to_db(values):
+    return 20 * np.log10(np.maximum(values, 10 ** (FLOOR_DB / 20)))
+
+
+class LevelMeter(object):
+    def __init__(self, sample_rate=8000, window=0.1, history=60.0):
+        """
+        :param sample_rate: Sample rate of the PCM
+        :param window: Window length in seconds
+        :param history: Seconds of window levels kept in the ring buffer
+        """
+        self.sample_rate = sample_rate
+        self.window = window
+        self.window_samples = int(round(sample_rate * window))
+
+        self._remainder = b''
+        self._pending = np.zeros(0, dtype=np.float32)
+
+        n_windows = max(1, int(round(history / window)))
+        self.rms_db = np.full(n_windows, FLOOR_DB)
+        self.peak_db = np.full(n_windows, FLOOR_DB)
+        # Total number of windows measured, the latest one is at (windows - 1) % len(rms_db)
+        self.windows = 0
+
+    def feed(self, pcm: bytes):
+        """ Measures the windows completed by a chunk of PCM. Returns their (rms_db, peak_db) arrays. """
+        pcm = self._remainder + pcm
+        usable = len(pcm) - len(pcm) % 2
+        self._remainder = pcm[usable:]
+
+        samples = np.frombuffer(pcm[:usable], dtype='<i2').astype(np.float32) / 32768
+        if len(self._pending) > 0:
+            samples = np.concatenate([self._pending, samples])
+
+        n = len(samples) // self.window_samples
+        self._pending = samples[n * self.window_samples:].copy()
+        if n == 0:
+            return np.zeros(0), np.zeros(0)
+
+        blocks = samples[:n * self.window_samples].reshape(n, self.window_samples)
+        rms_db = to_db(np.sqrt(np.mean(np.square(blocks), axis=1)))
+        peak_db = to_db(np.max(np.abs(blocks), axis=1))
+
+        idx = (self.windows + np.arange(n)) % len(self.rms_db)
+        self.rms_db[idx] = rms_db
+        self.peak_db[idx] = peak_db
+        self.windows += n
+
+        return rms_db, peak_db
+
+    def latest(self):
+        """ The (rms_db, peak_db) of the latest window """
+        if self.windows == 0:
+            return FLOOR_DB, FLOOR_DB
+        i = (self.windows - 1) % len(self.rms_db)
+        return float(self.rms_db[i]), float(self.peak_db[i])
+
+
+class SilenceGate(object):
+    """
+    Silence starts when the RMS level stays below threshold_db for onset seconds and ends when it stays above
+    threshold_db + hysteresis_db for release seconds, so a level hovering around the threshold does not flap.
+    """
+    def __init__(self, threshold_db=-60.0, hysteresis_db=6.0, onset=1.0, release=0.5):
+        self.threshold_db = threshold_db
+        self.hysteresis_db = hysteresis_db
+        self.onset = onset
+        self.release = release
+
+        self.is_silent = False
+        # Seconds the level has been on the other side of the threshold of the current state
+        self._candidate = 0.0
+        # Seconds since the silence started, measured in stream time
+        self.silent_for = 0.0
+        # Arrival time of the first window below the threshold, of the current candidate and of the latest silence
+        self._candidate_since = None
+        self.started_at = None
+
+    def update(self, rms_db, window, now=None):
+        """
+        Feeds the levels of consecutive windows of window seconds, which arrived at time now. Returns the events of the
+        windows in order, each one 'start' or 'end', e.g. both when a whole silence is in the windows.
+        """
+        events = []
+        for level in np.atleast_1d(rms_db):
+            if self.is_silent:
+                self.silent_for += window
+                if level > self.threshold_db + self.hysteresis_db:
+                    self._candidate += window
+                    if self._candidate >= self.release - TIME_EPSILON:
+                        self.is_silent = False
+                        self._candidate = 0.0
+                        events.append('end')
+                else:
+                    self._candidate = 0.0
+            else:
+                if level < self.threshold_db:
+                    if self._candidate == 0.0:
+                        self._candidate_since = now
+                    self._candidate += window
+                    if self._candidate >= self.onset - TIME_EPSILON:
+                        self.is_silent = True
+                        # The silence started when the level first dropped
+                        self.silent_for = self._candidate
+                        self.started_at = self._candidate_since
+                        self._candidate = 0.0
+                        events.append('start')
+                else:
+                    self._candidate = 0.0
+
+        return events
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gauges, counters and histograms in the Prometheus text exposition format, and a minimal HTTP endpoint which serves them
+from an asyncio event loop, so a monitored process needs no thread and no dependency for its metrics.
+
+Each metric has a fixed list of label names, and a value per combination of label values, e.g.
+
+    registry = Registry()
+    restarts = registry.counter('restarts_total', 'Actions run', ['stream', 'result'])
+    restarts.inc(stream='uoc_128.mp3', result='success')
+"""
+
+import math
+import asyncio
+from bisect import bisect_left
+
+
+def _format_value(value):
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped = ('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{0} has the labels {1}, not {2}'.format(self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[k]) for k in self.labelnames)
+
+    def samples(self):
+        """ The (suffix, labels, value) of each sample """
+        for key, value in sorted(self._values.items()):
+            yield '', list(zip(self.labelnames, key)), value() if callable(value) else value
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('{0}{1}{2} {3}'.format(self.name, suffix, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """ The value is function() at the time of each scrape """
+        self._values[self._key(labels)] = function
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self._values:
+            # Per bucket (not cumulative) counts, the last one is +Inf, and the sum
+            self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts = self._values[key]
+        counts[0][bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+
+    def samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                yield '_bucket', labels + [('le', _format_value(bound))], cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._add(Gauge(name, help_text, labelnames))
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), **kwargs):
+        return self._add(Histogram(name, help_text, labelnames, **kwargs))
+
+    def render(self):
+        return ''.join(metric.render() for metric in self._metrics)
+
+
+async def serve(registry: Registry, host='127.0.0.1', port=9400):
+    """ Starts serving the metrics at http://host:port/metrics. Returns the asyncio server. """
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Skip the headers
+            while (await asyncio.wait_for(reader.readline(), 5)) not in [b'\r\n', b'\n', b'']:
+                pass
+
+            fields = request.decode('latin-1').split()
+            if len(fields) >= 2 and fields[0] in ['GET', 'HEAD'] and fields[1].split('?')[0] in ['/', '/metrics']:
+                status, body = '200 OK', registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+
+            writer.write('HTTP/1.0 {0}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         'Content-Length: {1}\r\nConnection: close\r\n\r\n'.format(status, len(body)).encode())
+            if fields[:1] != ['HEAD']:
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
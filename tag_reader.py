@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A format dispatching tag reader shared by all the library tools.
+
+Each file is opened exactly once, with the mutagen class of its format, and both the tags and the stream info are
+taken from that single parse. The result is a compact record with the same fields for every format, so the tools do
+not need to know about vorbis comment or ID3 frame names.
+"""
+
+import os
+import re
+from collections import namedtuple
+from mutagen.mp3 import MP3
+from mutagen.oggvorbis import OggVorbis
+from mutagen.flac import FLAC
+
+
+# Numbers are int or None when missing, identifiers and names are '' when missing, genres is a list of strings.
+# artist is the album artist, or the track artist when the album artist is missing.
+# has_tags is False when the file carries no tag header at all.
+TrackTags = namedtuple('TrackTags', ['path', 'format', 'has_tags',
+                                     'album_id', 'releasegroup_id', 'recording_id', 'releasetrack_id',
+                                     'track_number', 'total_tracks', 'disc_number', 'total_discs',
+                                     'artist', 'album', 'genres',
+                                     'bitrate', 'sample_rate', 'bits_per_sample', 'channels', 'length'])
+
+
+def _first(values):
+    return str(values[0]).strip() if values else ''
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _split_number(value):
+    """ Splits values of the form '3/12' into (3, 12) """
+    number, _, total = value.partition('/')
+    return _to_int(number), _to_int(total)
+
+
+def _split_genres(values):
+    genres = []
+    for g in values:
+        genres.extend(re.split('; |;', str(g)))  # handle additional splits
+    return genres
+
+
+def _from_vorbis(tags):
+    def get(*keys):
+        for k in keys:
+            if k in tags and len(tags[k]) > 0:
+                return tags[k]
+        return []
+
+    track_number, total_tracks = _split_number(_first(get('tracknumber')))
+    disc_number, total_discs = _split_number(_first(get('discnumber')))
+
+    return {
+        'album_id': _first(get('musicbrainz_albumid')),
+        'releasegroup_id': _first(get('musicbrainz_releasegroupid')),
+        'recording_id': _first(get('musicbrainz_trackid')),
+        'releasetrack_id': _first(get('musicbrainz_releasetrackid')),
+        'track_number': track_number,
+        'total_tracks': _to_int(_first(get('totaltracks', 'tracktotal'))) or total_tracks,
+        'disc_number': disc_number,
+        'total_discs': _to_int(_first(get('totaldiscs', 'disctotal'))) or total_discs,
+        'artist': _first(get('albumartist', 'album artist', 'artist')),
+        'album': _first(get('album')),
+        'genres': _split_genres(get('genre'))
+    }
+
+
+def _from_id3(tags):
+    def get(key):
+        return tags[key].text if key in tags else []
+
+    track_number, total_tracks = _split_number(_first(get('TRCK')))
+    disc_number, total_discs = _split_number(_first(get('TPOS')))
+
+    # The recording id is stored as an unique file identifier rather than as text
+    ufid = tags.get('UFID:http://musicbrainz.org')
+
+    return {
+        'album_id': _first(get('TXXX:MusicBrainz Album Id')),
+        'releasegroup_id': _first(get('TXXX:MusicBrainz Release Group Id')),
+        'recording_id': ufid.data.decode('ascii', 'replace') if ufid is not None else '',
+        'releasetrack_id': _first(get('TXXX:MusicBrainz Release Track Id')),
+        'track_number': track_number,
+        'total_tracks': total_tracks,
+        'disc_number': disc_number,
+        'total_discs': total_discs,
+        'artist': _first(get('TPE2')) or _first(get('TPE1')),
+        'album': _first(get('TALB')),
+        'genres': _split_genres(get('TCON'))
+    }
+
+
+READERS = {
+    '.flac': (FLAC, _from_vorbis),
+    '.ogg': (OggVorbis, _from_vorbis),
+    '.mp3': (MP3, _from_id3)
+}
+
+EMPTY_TAGS = {
+    'album_id': '', 'releasegroup_id': '', 'recording_id': '', 'releasetrack_id': '',
+    'track_number': None, 'total_tracks': None, 'disc_number': None, 'total_discs': None,
+    'artist': '', 'album': '', 'genres': []
+}
+
+
+def is_supported(track_path):
+    return os.path.splitext(track_path)[1] in READERS
+
+
+def read_tags(track_path) -> TrackTags:
+    """ Opens the file once and returns its TrackTags. Raises ValueError for unsupported formats. """
+    ext = os.path.splitext(track_path)[1]
+    if ext not in READERS:
+        raise ValueError('Unsupported file extension {0}'.format(ext))
+
+    file_type, from_tags = READERS[ext]
+    audio = file_type(track_path)
+    info = audio.info
+
+    fields = from_tags(audio.tags) if audio.tags is not None else EMPTY_TAGS
+
+    return TrackTags(path=track_path, format=ext[1:], has_tags=audio.tags is not None,
+                     bitrate=info.bitrate, sample_rate=info.sample_rate,
+                     bits_per_sample=getattr(info, 'bits_per_sample', 0), channels=info.channels,
+                     length=info.length, **fields)
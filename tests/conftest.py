@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The tools are plain modules run from the root of the repository or from their own directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in [ROOT, os.path.join(ROOT, 'playlist_migration_tool'), os.path.join(ROOT, 'dynamic_playlist')]:
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
@@ -0,0 +1,88 @@
+import struct
+
+from air_check import AirCheck, ogg_header_length, write_clip
+
+
+def ogg_page(granule, payload):
+    """ An Ogg page of a single segment (CRC not set, it is not checked) """
+    return b'OggS' + bytes([0, 0]) + struct.pack('<qII', granule, 1, 0) + b'\0\0\0\0' + bytes([1, len(payload)]) + \
+        payload
+
+
+def test_write_and_read_across_the_end_of_the_buffer():
+    air_check = AirCheck(capacity=10, duration=10)
+    air_check.write(b'0123456', now=0)
+    air_check.write(b'789ab', now=1)
+
+    assert air_check.written == 12 and air_check.oldest == 2
+    assert air_check.read(0) == b'23456789ab'
+    assert air_check.read(5, 9) == b'5678'
+    assert air_check.read(20) == b''
+
+
+def test_chunk_larger_than_the_buffer():
+    air_check = AirCheck(capacity=4, duration=10)
+    air_check.write(b'xy', now=0)
+    air_check.write(b'0123456789', now=1)
+
+    assert air_check.read(0) == b'6789'
+
+
+def test_offsets_of_times():
+    air_check = AirCheck(capacity=100, duration=10, mark_interval=1.0)
+    for second in range(5):
+        air_check.write(bytes(10), now=100 + second)
+        # Writes within the mark interval add no mark
+        air_check.write(bytes(5), now=100 + second + 0.5)
+
+    assert air_check.offset_at(99) == 0
+    assert air_check.offset_at(102.7) == 30
+    assert air_check.offset_at(200) == 60
+
+
+def test_offsets_of_overwritten_data():
+    air_check = AirCheck(capacity=20, duration=2, mark_interval=1.0)
+    for second in range(10):
+        air_check.write(bytes(10), now=second)
+
+    # The oldest marks are dropped, and an offset is never older than the buffer
+    assert air_check.offset_at(0) == 80
+    assert air_check.offset_at(9) == 90
+
+
+def test_mp3_clip_is_a_byte_range():
+    air_check = AirCheck(capacity=100, duration=10)
+    air_check.write(b'frames', now=0)
+
+    assert air_check.clip(2) == b'ames'
+
+
+def test_ogg_clip_starts_with_the_header_pages():
+    header = ogg_page(0, b'id') + ogg_page(0, b'setup')
+    audio = [ogg_page(48000 * (i + 1), bytes([i]) * 8) for i in range(3)]
+
+    assert ogg_header_length(header[:10]) is None
+    assert ogg_header_length(header + audio[0]) == len(header)
+
+    air_check = AirCheck(capacity=1000, duration=10, container='ogg')
+    air_check.write(header[:20], now=0)
+    air_check.write(header[20:] + audio[0], now=0)
+    air_check.write(audio[1] + audio[2], now=1)
+    assert air_check.header == header
+
+    # A clip from within the second page resumes at the third one
+    start = len(header) + len(audio[0]) + 3
+    assert air_check.clip(start) == header + audio[2]
+
+    # A new connection brings its own header
+    air_check.new_stream()
+    air_check.write(ogg_page(0, b'new') + audio[0], now=2)
+    assert air_check.header == ogg_page(0, b'new')
+
+
+def test_write_clip(tmp_path):
+    path = tmp_path / 'incident.mp3'
+    write_clip(str(path), b'clip')
+
+    assert path.read_bytes() == b'clip'
+    assert [p.name for p in tmp_path.iterdir()] == ['incident.mp3']
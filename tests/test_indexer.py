@@ -0,0 +1,124 @@
+import sqlite3
+
+import pytest
+
+from indexer import TrackIndexer
+from main import TrackInfo
+
+
+@pytest.fixture
+def indexer(tmp_path):
+    with TrackIndexer(str(tmp_path / 'tracks.db')) as indexer:
+        yield indexer
+
+
+def test_duplicate_paths_of_an_old_index_are_removed(tmp_path):
+    dbfile = str(tmp_path / 'tracks.db')
+    db = sqlite3.connect(dbfile)
+    db.execute("CREATE TABLE tracks (id INTEGER PRIMARY KEY, path TEXT,track_idx INTEGER(32),releasegroup_id TEXT,"
+               "album_id TEXT)")
+    db.executemany("INSERT INTO tracks(path, track_idx) VALUES(?, ?)", [('/a.flac', 1), ('/b.flac', 2), ('/a.flac', 3)])
+    db.commit()
+    db.close()
+
+    with TrackIndexer(dbfile) as indexer:
+        rows = indexer.db_handle.execute("SELECT path, track_idx FROM tracks ORDER BY path").fetchall()
+        assert rows == [('/a.flac', 3), ('/b.flac', 2)]
+        with pytest.raises(sqlite3.IntegrityError):
+            indexer.db_handle.execute("INSERT INTO tracks(path) VALUES('/b.flac')")
+
+    # Opening the migrated index again leaves it as is
+    with TrackIndexer(dbfile) as indexer:
+        assert indexer.db_handle.execute("SELECT COUNT(*) FROM tracks").fetchone()[0] == 2
+
+
+def test_ingest_albums_updates_tracks_and_checkpoints_albums(indexer):
+    assert indexer.ingest_albums([('/lib/A', [TrackInfo('/lib/A/01.flac', 1, 'alb', 'rg')])]) == 1
+    assert indexer.ingest_albums([('/lib/A', [TrackInfo('/lib/A/01.flac', 2, 'alb', 'rg')])]) == 1
+
+    assert indexer.db_handle.execute("SELECT path, track_idx FROM tracks").fetchall() == [('/lib/A/01.flac', 2)]
+    assert indexer.is_ingested('/lib/A') and not indexer.is_ingested('/lib/B')
+
+    indexer.reset_progress()
+    assert not indexer.is_ingested('/lib/A')
+
+
+def test_add_tracks_upserts_in_batches(indexer):
+    tracks = (TrackInfo('/lib/A/{0:02d}.flac'.format(i), i, 'alb', 'rg') for i in range(1, 6))
+    assert indexer.add_tracks(tracks, batch_size=2) == 5
+
+    assert indexer.add_tracks([TrackInfo('/lib/A/01.flac', 1, 'alb', 'rg', 1, 1, 'rec', 'trk')]) == 1
+    assert indexer.db_handle.execute("SELECT COUNT(*) FROM tracks").fetchone()[0] == 5
+    assert indexer.db_handle.execute("SELECT recording_id, releasetrack_id FROM tracks WHERE path = '/lib/A/01.flac'"
+                                     ).fetchone() == ('rec', 'trk')
+
+
+def test_exceptions_are_not_swallowed_by_the_context_manager(tmp_path):
+    with pytest.raises(KeyError):
+        with TrackIndexer(str(tmp_path / 'tracks.db')):
+            raise KeyError('path')
+
+
+@pytest.fixture
+def two_discs(indexer):
+    # Two discs of the same release, the tracks of disc 2 also carry the id of the release group only
+    indexer.ingest_albums([('/lib/A', [
+        TrackInfo('/lib/A/CD1/01 Intro.flac', 1, 'alb', 'rg', 1, 2, 'rec-1', 'trk-1'),
+        TrackInfo('/lib/A/CD2/01 Outro.flac', 1, 'alb', 'rg', 2, 2, 'rec-2', 'trk-2'),
+        TrackInfo('/lib/A/CD1/02 Song.flac', 2, 'alb', 'rg', 1, 2, 'rec-3', 'trk-3'),
+        TrackInfo('/lib/B/01 Other.flac', 1, 'alb-b', '', None, None, '', ''),
+        TrackInfo('/lib/C/01 Untagged.flac', 1, '', '', None, None, '', '')])])
+    return indexer
+
+
+def test_get_track_matches_the_release_group_or_the_release(two_discs):
+    # Found through the release group, and through the release, and listed once when both match
+    assert two_discs.get_track(2, 'rg', 'other-release', '02 Song.flac') == '/lib/A/CD1/02 Song.flac'
+    assert two_discs.get_track(2, 'other-group', 'alb', '02 Song.flac') == '/lib/A/CD1/02 Song.flac'
+    assert two_discs.get_track(2, 'rg', 'alb', '02 Song.flac') == '/lib/A/CD1/02 Song.flac'
+    assert two_discs.stats['ambiguous'] == 0
+
+
+def test_get_track_does_not_match_missing_ids(two_discs):
+    assert two_discs.get_track(1, '', '', '01 Untagged.flac') is None
+    assert two_discs.get_track(1, '', 'alb-b', '01 Other.flac') == '/lib/B/01 Other.flac'
+    assert two_discs.stats['not_found'] == 1
+
+
+@pytest.mark.parametrize('keys, name', [
+    ({'releasetrack_id': 'trk-2'}, 'releasetrack_id'),
+    ({'disc_idx': 2}, 'disc'),
+    ({'recording_id': 'rec-2'}, 'recording_id'),
+    # Unknown values are skipped rather than discarding every candidate
+    ({'releasetrack_id': 'trk-unknown', 'disc_idx': 2}, 'disc'),
+])
+def test_ambiguous_tracks_are_resolved_by_exact_keys(two_discs, keys, name):
+    # The filename would pick disc 1
+    assert two_discs.get_track(1, 'rg', 'alb', '01 Intro.flac', **keys) == '/lib/A/CD2/01 Outro.flac'
+    assert two_discs.stats['resolved_by_' + name] == 1
+    assert two_discs.stats['fuzzy_fallback'] == 0
+
+
+def test_ambiguous_tracks_without_keys_fall_back_to_the_filename(two_discs):
+    assert two_discs.get_track(1, 'rg', 'alb', '01 - Outro.mp3') == '/lib/A/CD2/01 Outro.flac'
+    assert two_discs.get_track(1, 'rg', 'alb', '01 - Intro.mp3') == '/lib/A/CD1/01 Intro.flac'
+    assert two_discs.stats['fuzzy_fallback'] == 2
+
+
+def test_resolve_tracks_agrees_with_get_track(two_discs):
+    queries = [TrackInfo('/old/01 Intro.flac', 1, 'alb', 'rg'),
+               TrackInfo('/old/01 x.flac', 1, 'alb', 'rg', 2),
+               TrackInfo('/old/02 Song.flac', 2, 'other', 'rg'),
+               TrackInfo('/old/01 Other.flac', 1, 'alb-b', ''),
+               TrackInfo('/old/01 Untagged.flac', 1, '', ''),
+               TrackInfo('/old/09 Missing.flac', 9, 'alb', 'rg')]
+
+    expected = [two_discs.get_track(t.track_idx, t.group_id, t.album_id, t.path, t.disc_idx, t.recording_id,
+                                    t.releasetrack_id) for t in queries]
+    assert two_discs.resolve_tracks(queries) == expected
+    assert expected[-2:] == [None, None]
+
+
+def test_get_track_is_served_by_indexes(indexer):
+    plan, indexed = indexer.explain()
+    assert indexed, plan
@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+import metadata_cache
+from metadata_cache import MetadataCache
+from tag_reader import EMPTY_TAGS, TrackTags
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """ Replaces the tag reader with one which records the paths it opens """
+    opened = []
+
+    def read_tags(track_path):
+        opened.append(track_path)
+        return TrackTags(path=track_path, format='flac', has_tags=True, bitrate=0, sample_rate=44100,
+                         bits_per_sample=16, channels=2, length=float(os.path.getsize(track_path)),
+                         **dict(EMPTY_TAGS, album='Album'))
+
+    monkeypatch.setattr(metadata_cache, 'read_tags', read_tags)
+    return opened
+
+
+@pytest.fixture
+def track(tmp_path):
+    path = tmp_path / '01 track.flac'
+    path.write_bytes(b'x' * 10)
+    return str(path)
+
+
+def test_unchanged_file_is_served_from_the_cache(tmp_path, track, reads):
+    with MetadataCache(str(tmp_path / 'cache.db')) as cache:
+        first = cache.get(track)
+        second = cache.get(track)
+
+    assert reads == [track]
+    assert second == first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_persists_across_connections(tmp_path, track, reads):
+    with MetadataCache(str(tmp_path / 'cache.db')) as cache:
+        cache.get(track)
+    with MetadataCache(str(tmp_path / 'cache.db')) as cache:
+        tags = cache.get(track)
+
+    assert reads == [track]
+    assert tags.album == 'Album' and tags.genres == []
+
+
+def test_modified_file_is_read_again(tmp_path, track, reads):
+    with MetadataCache(str(tmp_path / 'cache.db')) as cache:
+        cache.get(track)
+        with open(track, 'ab') as f:
+            f.write(b'more')
+        tags = cache.get(track)
+
+    assert reads == [track, track]
+    assert tags.length == 14.0
+
+
+def test_touched_file_is_read_again(tmp_path, track, reads):
+    with MetadataCache(str(tmp_path / 'cache.db')) as cache:
+        cache.get(track)
+        st = os.stat(track)
+        os.utime(track, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        cache.get(track)
+
+    assert reads == [track, track]
+
+
+def test_replaced_file_is_read_again(tmp_path, track, reads):
+    with MetadataCache(str(tmp_path / 'cache.db')) as cache:
+        cache.get(track)
+        st = os.stat(track)
+        # Same size and mtime, but another inode
+        replacement = tmp_path / 'replacement'
+        replacement.write_bytes(b'y' * 10)
+        os.utime(replacement, ns=(st.st_atime_ns, st.st_mtime_ns))
+        keep = tmp_path / 'keep'
+        os.rename(track, keep)
+        os.rename(replacement, track)
+        cache.get(track)
+
+    assert reads == [track, track]
+
+
+def test_version_change_drops_the_cached_entries(tmp_path, track, reads, monkeypatch):
+    with MetadataCache(str(tmp_path / 'cache.db')) as cache:
+        cache.get(track)
+
+    monkeypatch.setattr(metadata_cache, 'CACHE_VERSION', metadata_cache.CACHE_VERSION + 1)
+    with MetadataCache(str(tmp_path / 'cache.db')) as cache:
+        cache.get(track)
+        assert cache.db_handle.execute('PRAGMA user_version').fetchone()[0] == metadata_cache.CACHE_VERSION
+
+    assert reads == [track, track]
+
+
+def test_shared_cache_committing_every_miss_does_not_hold_the_lock(tmp_path, reads):
+    tracks = []
+    for name in ['01.flac', '02.flac']:
+        (tmp_path / name).write_bytes(b'x')
+        tracks.append(str(tmp_path / name))
+
+    with MetadataCache(str(tmp_path / 'cache.db'), commit_every=1) as first, \
+            MetadataCache(str(tmp_path / 'cache.db'), commit_every=1) as second:
+        second.db_handle.execute('PRAGMA busy_timeout = 100')
+        first.get(tracks[0])
+        # Would raise "database is locked" if the first connection still held its write transaction
+        second.get(tracks[1])
+        assert first.get(tracks[1]) == second.get(tracks[1])
+
+    assert reads == tracks
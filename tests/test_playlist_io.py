@@ -0,0 +1,85 @@
+import os
+import stat
+
+import pytest
+
+import playlist_io
+from playlist_io import PlaylistEntry, read_playlist, write_playlist
+
+
+def test_read_pls(tmp_path):
+    path = tmp_path / 'zone.pls'
+    path.write_text('[playlist]\r\nNumberOfEntries=3\r\n'
+                    'File1=/music/a.flac\r\nTitle1=A = B\r\nLength1=125\r\n'
+                    'file2=/music/b.mp3\r\nLength2=unknown\r\n'
+                    'Title3=No file\r\n'
+                    'File4=/music/c.ogg\r\nVersion=2\r\n', encoding='utf-8')
+
+    assert list(read_playlist(str(path))) == [PlaylistEntry(1, '/music/a.flac', 'A = B', 125),
+                                              PlaylistEntry(2, '/music/b.mp3', None, None),
+                                              PlaylistEntry(4, '/music/c.ogg', None, None)]
+
+
+def test_read_m3u(tmp_path):
+    path = tmp_path / 'zone.m3u8'
+    path.write_bytes('\ufeff#EXTM3U\n#EXTINF:61,Café\n/music/é.flac\n\n# comment\n/music/b.mp3\n'.encode('utf-8'))
+
+    assert list(read_playlist(str(path))) == [PlaylistEntry(1, '/music/é.flac', 'Café', 61),
+                                              PlaylistEntry(2, '/music/b.mp3', None, None)]
+
+
+def test_undecodable_paths_are_kept(tmp_path):
+    path = tmp_path / 'zone.m3u'
+    path.write_bytes(b'/music/\xe9t\xe9.mp3\n')
+
+    entries = list(read_playlist(str(path)))
+    assert os.fsencode(entries[0].path) == b'/music/\xe9t\xe9.mp3'
+
+    write_playlist(str(path), entries)
+    assert path.read_bytes() == b'#EXTM3U\n/music/\xe9t\xe9.mp3\n'
+
+
+@pytest.mark.parametrize('name', ['zone.pls', 'zone.m3u'])
+def test_written_playlists_read_back(tmp_path, name):
+    path = str(tmp_path / name)
+    entries = [PlaylistEntry(7, '/music/a.flac', 'A', 125), PlaylistEntry(8, '/music/b.mp3', None, None),
+               '/music/c.ogg']
+
+    write_playlist(path, entries)
+
+    assert list(read_playlist(path)) == [PlaylistEntry(1, '/music/a.flac', 'A', 125),
+                                         PlaylistEntry(2, '/music/b.mp3', None, None),
+                                         PlaylistEntry(3, '/music/c.ogg', None, None)]
+
+
+def test_unsupported_extension(tmp_path):
+    with pytest.raises(ValueError):
+        list(read_playlist(str(tmp_path / 'zone.txt')))
+    with pytest.raises(ValueError):
+        write_playlist(str(tmp_path / 'zone.txt'), [])
+
+
+def test_write_keeps_the_permissions_of_the_playlist(tmp_path):
+    path = tmp_path / 'zone.pls'
+    path.write_text('[playlist]\n')
+    os.chmod(path, 0o640)
+
+    write_playlist(str(path), ['/music/a.flac'])
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+
+
+def test_failed_write_leaves_the_playlist(tmp_path, monkeypatch):
+    path = tmp_path / 'zone.pls'
+    write_playlist(str(path), ['/music/a.flac'])
+    before = path.read_bytes()
+
+    def replace(src, dst):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(playlist_io.os, 'replace', replace)
+    with pytest.raises(OSError):
+        write_playlist(str(path), ['/music/b.flac'])
+
+    assert path.read_bytes() == before
+    assert os.listdir(tmp_path) == ['zone.pls']
@@ -0,0 +1,38 @@
+import pytest
+
+from silence_detector import Backoff, stream_name
+
+
+def test_backoff_grows_exponentially_with_jitter():
+    backoff = Backoff(initial=5.0, maximum=300.0, factor=2.0)
+
+    for expected in [5.0, 10.0, 20.0, 40.0]:
+        assert expected * 0.8 <= backoff.next() <= expected
+
+
+def test_backoff_stops_at_the_maximum():
+    backoff = Backoff(initial=5.0, maximum=300.0, factor=2.0)
+
+    # Would overflow a float if the exponent kept growing
+    delays = [backoff.next() for _ in range(5000)]
+
+    assert max(delays) <= 300.0
+    assert min(delays[10:]) >= 300.0 * 0.8
+    assert backoff.failures == 6
+
+
+def test_backoff_reset():
+    backoff = Backoff(initial=5.0, maximum=300.0)
+    for _ in range(10):
+        backoff.next()
+
+    backoff.reset()
+
+    assert backoff.next() <= 5.0
+
+
+@pytest.mark.parametrize('url, name', [('http://radio.example:8000/uoc_128.mp3', 'uoc_128.mp3'),
+                                       ('http://radio.example:8000/live.ogg?token=1', 'live.ogg'),
+                                       ('http://radio.example:8000/', 'http://radio.example:8000/')])
+def test_stream_name(url, name):
+    assert stream_name(url) == name
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from stream_levels import FLOOR_DB, LevelMeter, SilenceGate
+
+
+def pcm(amplitude, seconds, sample_rate=8000):
+    """ A full scale fraction amplitude square wave, whose RMS and peak are both amplitude """
+    n = int(sample_rate * seconds)
+    samples = np.where(np.arange(n) % 2 == 0, amplitude, -amplitude) * 32767
+    return samples.astype('<i2').tobytes()
+
+
+def test_windows_are_measured_across_chunks():
+    meter = LevelMeter(sample_rate=8000, window=0.1)
+    data = pcm(0.5, 0.25)
+
+    # Odd sized chunks split samples and windows
+    levels = [meter.feed(data[i:i + 333]) for i in range(0, len(data), 333)]
+    rms_db = np.concatenate([rms for rms, _ in levels])
+
+    assert meter.windows == 2
+    assert rms_db == pytest.approx([-6.02, -6.02], abs=0.01)
+    assert meter.latest()[1] == pytest.approx(-6.02, abs=0.01)
+
+
+def test_digital_silence_is_reported_at_the_floor():
+    meter = LevelMeter()
+    assert meter.latest() == (FLOOR_DB, FLOOR_DB)
+
+    rms_db, peak_db = meter.feed(pcm(0, 0.1))
+    assert rms_db == pytest.approx([FLOOR_DB]) and peak_db == pytest.approx([FLOOR_DB])
+
+
+def test_history_is_a_ring_buffer():
+    meter = LevelMeter(window=0.1, history=0.5)
+    meter.feed(pcm(0.5, 0.3))
+    meter.feed(pcm(0.05, 0.4))
+
+    assert meter.windows == 7
+    assert len(meter.rms_db) == 5
+    # The two latest windows have overwritten the two oldest ones
+    assert meter.rms_db == pytest.approx([-26.02] * 2 + [-6.02] + [-26.02] * 2, abs=0.01)
+    assert meter.latest()[0] == pytest.approx(-26.02, abs=0.01)
+
+
+def test_gate_reports_silence_after_the_onset():
+    gate = SilenceGate(threshold_db=-60, hysteresis_db=6, onset=1.0, release=0.5)
+
+    assert gate.update([-20] * 10 + [-70] * 9, 0.1) == []
+    assert gate.update([-70], 0.1) == ['start']
+    assert gate.is_silent and gate.silent_for == pytest.approx(1.0)
+
+    assert gate.update([-70] * 20, 0.1) == []
+    assert gate.silent_for == pytest.approx(3.0)
+
+
+def test_gate_does_not_flap_around_the_threshold():
+    gate = SilenceGate(threshold_db=-60, hysteresis_db=6, onset=1.0, release=0.5)
+    gate.update([-70] * 10, 0.1)
+
+    # Above the threshold but within the hysteresis, and short bursts above it
+    assert gate.update([-57] * 20 + ([-50] * 4 + [-70]) * 3, 0.1) == []
+    assert gate.is_silent
+
+    assert gate.update([-50] * 5, 0.1) == ['end']
+    assert not gate.is_silent
+
+
+def test_gate_ignores_short_drops():
+    gate = SilenceGate(threshold_db=-60, onset=1.0)
+    assert gate.update(([-70] * 9 + [-20]) * 5, 0.1) == []
+    assert not gate.is_silent
+
+
+def test_gate_reports_every_event_of_a_batch():
+    gate = SilenceGate(threshold_db=-60, hysteresis_db=6, onset=1.0, release=0.5)
+
+    assert gate.update([-90] * 9, 0.1) == []
+    assert gate.update([-90] + [0] * 5, 0.1) == ['start', 'end']
+    assert not gate.is_silent
+
+    assert gate.update(([-90] * 10 + [0] * 5) * 2, 0.1) == ['start', 'end', 'start', 'end']
+
+
+def test_gate_keeps_the_arrival_time_of_the_first_silent_window():
+    gate = SilenceGate(threshold_db=-60, onset=1.0)
+
+    gate.update([-20, -70], 0.1, now=100.0)
+    gate.update([-20] + [-70] * 5, 0.1, now=101.0)
+    assert gate.update([-70] * 5, 0.1, now=102.0) == ['start']
+
+    assert gate.started_at == 101.0
@@ -0,0 +1,84 @@
+import asyncio
+import math
+
+import pytest
+
+from stream_metrics import Registry, serve
+
+
+def test_counter_and_gauge_render():
+    registry = Registry()
+    actions = registry.counter('actions_total', 'Actions run', ['stream', 'result'])
+    level = registry.gauge('level_dbfs', 'Latest level', ['stream'])
+    up = registry.gauge('up', 'Whether the process runs')
+
+    actions.inc(stream='b.mp3', result='success')
+    actions.inc(2, stream='a.ogg', result='failure')
+    actions.inc(stream='b.mp3', result='success')
+    level.set(-12.5, stream='a "quoted"\\stream\n')
+    level.set(-math.inf, stream='b.mp3')
+    up.set_function(lambda: 1)
+
+    assert registry.render() == (
+        '# HELP actions_total Actions run\n'
+        '# TYPE actions_total counter\n'
+        'actions_total{stream="a.ogg",result="failure"} 2\n'
+        'actions_total{stream="b.mp3",result="success"} 2\n'
+        '# HELP level_dbfs Latest level\n'
+        '# TYPE level_dbfs gauge\n'
+        'level_dbfs{stream="a \\"quoted\\"\\\\stream\\n"} -12.5\n'
+        'level_dbfs{stream="b.mp3"} -Inf\n'
+        '# HELP up Whether the process runs\n'
+        '# TYPE up gauge\n'
+        'up 1\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'Detection latency', buckets=(1, 5, 2))
+
+    for value in [0.5, 1, 3, 60]:
+        latency.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{le="1"} 2',
+        'latency_seconds_bucket{le="2"} 2',
+        'latency_seconds_bucket{le="5"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 64.5',
+        'latency_seconds_count 4']
+
+
+def test_labels_must_match():
+    counter = Registry().counter('restarts_total', 'Restarts', ['stream'])
+    with pytest.raises(ValueError):
+        counter.inc(stream='a.mp3', result='success')
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_serve():
+    registry = Registry()
+    registry.gauge('up', 'Up').set(1)
+
+    async def get(port, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('GET {0} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(path).encode())
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def scrape():
+        server = await serve(registry, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await get(port, '/metrics'), await get(port, '/other')
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    metrics, other = asyncio.run(scrape())
+
+    assert metrics.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert metrics.endswith(b'\r\n\r\n# HELP up Up\n# TYPE up gauge\nup 1\n')
+    assert other.startswith(b'HTTP/1.0 404 Not Found\r\n')
@@ -0,0 +1,111 @@
+import os
+import time
+
+import pytest
+
+from update_playlist import ShowInventory, ShowScheduler, ShowSource, is_partial
+
+
+def age(path, seconds=10):
+    """ Moves the mtime of a directory back, out of the racy window of the inventory """
+    t = time.time() - seconds
+    os.utime(path, (t, t))
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / 'source'
+    (source / '2024').mkdir(parents=True)
+    (source / 'show1.mp3').touch()
+    (source / '2024' / 'show2.mp3').touch()
+    age(source)
+    age(source / '2024')
+    return source
+
+
+@pytest.fixture
+def scheduler(tmp_path, source):
+    root = tmp_path / 'root'
+    (root / 'upcoming').mkdir(parents=True)
+    (root / 'scheduled').mkdir()
+    (root / 'priority.txt').touch()
+    (tmp_path / 'show.pls').write_text('[playlist]\nFile1=/shows/old.mp3\n')
+    return ShowScheduler(root, tmp_path / 'show.pls', ShowSource(local_source=str(source), online_source=None))
+
+
+@pytest.mark.parametrize('name, partial', [('show.mp3', False), ('show.mp3.part', True), ('show.ytdl', True),
+                                           ('.show.mp3', True), ('show.tmp', True), ('show.crdownload', True)])
+def test_is_partial(name, partial):
+    assert is_partial(name) == partial
+
+
+def test_refresh_lists_only_changed_directories(tmp_path, source):
+    inventory = ShowInventory(source, tmp_path / 'inventory.json')
+    assert set(inventory.refresh()) == {'show1.mp3', 'show2.mp3'}
+    assert inventory.rescanned == 2
+    inventory.save()
+
+    inventory = ShowInventory(source, tmp_path / 'inventory.json')
+    assert set(inventory.shows()) == {'show1.mp3', 'show2.mp3'}
+    inventory.refresh()
+    assert inventory.rescanned == 0
+
+    (source / '2024' / 'show3.mp3').touch()
+    (source / 'show1.mp3').unlink()
+    shows = inventory.refresh()
+    assert inventory.rescanned == 2
+    assert shows == {'show2.mp3': source / '2024' / 'show2.mp3', 'show3.mp3': source / '2024' / 'show3.mp3'}
+
+
+def test_recently_modified_directories_are_listed_again(tmp_path, source):
+    (source / 'show4.mp3').touch()
+    inventory = ShowInventory(source, tmp_path / 'inventory.json')
+    inventory.refresh()
+
+    inventory.refresh()
+    assert inventory.rescanned == 1
+
+
+def test_partial_and_hidden_files_are_not_shows(tmp_path, source):
+    (source / 'show5.mp3.part').touch()
+    (source / '.show6.mp3').touch()
+    inventory = ShowInventory(source, tmp_path / 'inventory.json')
+
+    assert set(inventory.refresh()) == {'show1.mp3', 'show2.mp3'}
+
+
+def test_snapshot_of_another_source_is_ignored(tmp_path, source):
+    inventory = ShowInventory(source, tmp_path / 'inventory.json')
+    inventory.refresh()
+    inventory.save()
+
+    assert ShowInventory(source / '2024', tmp_path / 'inventory.json').shows() == {}
+
+
+def test_added_files_are_known(tmp_path, source):
+    inventory = ShowInventory(source, tmp_path / 'inventory.json')
+    inventory.refresh()
+
+    (source / 'new').mkdir()
+    (source / 'new' / 'show7.mp3').touch()
+    inventory.add(source / 'new' / 'show7.mp3')
+
+    assert inventory.shows()['show7.mp3'] == source / 'new' / 'show7.mp3'
+
+
+def test_populate_links_new_shows_once(scheduler, source):
+    upcoming = scheduler._upcoming_dir
+
+    scheduler.populate_shows()
+    assert sorted(os.listdir(upcoming)) == ['show1.mp3', 'show2.mp3']
+    assert os.readlink(upcoming / 'show2.mp3') == str(source / '2024' / 'show2.mp3')
+
+    # A show which was aired and removed is not linked again, a new one is
+    (upcoming / 'show1.mp3').unlink()
+    (source / 'show3.mp3.part').touch()
+    scheduler.populate_shows()
+    assert sorted(os.listdir(upcoming)) == ['show2.mp3']
+
+    os.rename(source / 'show3.mp3.part', source / 'show3.mp3')
+    scheduler.populate_shows()
+    assert sorted(os.listdir(upcoming)) == ['show2.mp3', 'show3.mp3']
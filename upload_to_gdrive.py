@@ -105,16 +105,7 @@ def run_once(filepath):
     rec_pub.upload_file(filepath)
 
 
-def main():
-    # initiate the parser
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--mode", "-m", help="Set mode. Options: watch, once")
-    parser.add_argument("--path", "-p", help="Path for file to be uploaded.")
-    parser.add_argument("--recordings-path", "-r", help="Recordings path.")
-
-    # read arguments from the command line
-    args = parser.parse_args()
-
+def main(args):
     # check for --width
     if args.mode:
         print("Set mode to %s" % args.mode)
@@ -127,5 +118,18 @@ def main():
         raise ValueError("Invalid mode.")
 
 
+def cli(argv=None, prog=None):
+    # initiate the parser
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--mode", "-m", help="Set mode. Options: watch, once")
+    parser.add_argument("--path", "-p", help="Path for file to be uploaded.")
+    parser.add_argument("--recordings-path", "-r", help="Recordings path.")
+
+    # read arguments from the command line
+    args = parser.parse_args(argv)
+
+    main(args)
+
+
 if __name__ == "__main__":
-    main()
+    cli()
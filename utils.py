@@ -1,3 +1,6 @@
+import os
+
+
 class SingletonDecorator:
     # from: http://python-3-patterns-idioms-test.readthedocs.org/en/latest/Singleton.html
     def __init__(self, klass):
@@ -24,3 +27,8 @@ class bcolors:
     @ staticmethod
     def print(out, c):
         print(c + str(out) + bcolors.ENDC)
+
+
+def prefix_range(directory):
+    """ Bounds of the paths under directory, for a range scan of a path index: path >= low AND path < high """
+    return directory + os.sep, directory + chr(ord(os.sep) + 1)